@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+"""The benchmark suite: loaders, rules and rendering.
+
+    python benchmark.py                      # run everything, print a table
+    python benchmark.py rules frame          # only some groups
+    python benchmark.py --out results.json   # also save the results
+    python benchmark.py --baseline results.json --tolerance .2
+
+Every benchmark is the best time of one operation, in seconds. With a
+baseline, anything slower than the baseline by more than the tolerance is a
+regression, and the exit status is 1.
+
+The groups:
+
+    models    parsing every model under skins/ (`OBJ`), and adding it to a
+              batch (`OBJ.add_to`)
+    rules     loading boards, moving pieces and checking for victory, on
+              the default board and on synthetic boards with lots of pieces
+    frame     the queries the board makes every frame, from the indices of
+              the game (`indexed`) against scanning every piece (`scan`)
+    protocol  encoding and decoding snapshots and deltas for the network,
+              in JSON and in binary (`game.protocol`)
+    pieces    `PieceList.load_from_file`, `PieceList.filter` and picking the
+              piece under the cursor
+    render    drawing a frame, with the pieces drawn one by one and batched;
+              boards bigger than 8x8 are tiled, and culled to the view
+
+`models` adding to a batch, `pieces` and `render` need a GL context. They
+are skipped when a window can't be opened (e.g. without a display).
+"""
+from __future__ import division, print_function
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import timeit
+
+import pyglet
+# The headless benchmarks don't need a window, so don't make one on import
+pyglet.options['shadow_window'] = False
+
+from game.rules import Game, Piece, PIECE_TYPES
+
+KINDS = sorted(PIECE_TYPES)
+PIECE_COUNTS = (15, 100, 300, 1000)
+RENDER_COUNTS = (15, 300, 2000)
+
+
+class Skipped(Exception):
+    pass
+
+
+def make_game(count, seed=0, moved=True):
+    """A square board about half full of `count` random pieces, split over
+    two players, with a commander for every eight pieces. Unless `moved` is
+    off, half the first player's pieces have moved already.
+    """
+    rng = random.Random(seed)
+    size = max(8, int((count * 2) ** .5) + 1)
+    game = Game(size, size, 2)
+    squares = rng.sample([(x, y) for x in range(size) for y in range(size)],
+                         count)
+    for i, (x, y) in enumerate(squares):
+        kind = 'B0' if i % 8 < 2 else rng.choice(KINDS[1:])
+        game.add(Piece(kind, i % 2, x, y, rng.randrange(8)))
+    # halfway through the move phase, where the frame does the most work
+    if moved:
+        for piece in sorted(game.pieces_of(0), key=lambda _: _.square)[::2]:
+            game.move(piece)
+    return game
+
+
+def measure(function, repeat=5, target=.05):
+    """The best time of a call in seconds, calling it often enough per
+    repeat to take about `target` seconds.
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= target / 10 or number >= 1 << 20:
+            break
+        number *= 10
+    number = max(1, int(number * target / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat, number)) / number
+
+
+def measure_each(setup, function, repeat=5):
+    """The best time of `function(setup())`, for operations that change
+    what they work on. Only the call is timed.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        argument = setup()
+        start = time.time()
+        function(argument)
+        best = min(best, time.time() - start)
+    return best
+
+
+def gl_window():
+    """A game window, or Skipped if there's no display to open one on."""
+    try:
+        from game.renderer import GameWindow3d
+        from game.states import MainMenuState
+        window = GameWindow3d(MainMenuState, visible=False)
+    except Exception as ex:
+        raise Skipped('no GL context ({})'.format(ex))
+    # the menu only creates the board once it's on the screen
+    window.gamestate.create_board()
+    if window.gamestate.board.model is None:
+        window.gamestate.board.load_model()
+    return window
+
+
+# benchmarks; each yields (name, seconds) pairs
+def bench_models(context):
+    from game.obj_batch import OBJ, find_models
+    filenames = sorted(find_models())
+    objs = []
+    for filename in filenames:
+        yield 'models.parse[{}]'.format(filename), measure(
+            lambda: OBJ(filename, load_textures=False), repeat=3)
+        objs.append((filename, OBJ(filename, load_textures=False)))
+    window = context.window()
+    window.switch_to()
+    from pyglet.graphics import Batch
+
+    def add_to(obj):
+        for vertex_list in obj.add_to(Batch()):
+            vertex_list.delete()
+    for filename, obj in objs:
+        yield 'models.add_to[{}]'.format(filename), measure(
+            lambda: add_to(obj), repeat=3)
+
+
+def bench_rules(context):
+    game = Game()
+    yield 'rules.load[default]', measure(lambda: game.load_file('default'))
+    for count in PIECE_COUNTS:
+        records = make_game(count, moved=False).to_records()
+        size = max(8, int((count * 2) ** .5) + 1)
+
+        def load():
+            Game(size, size, 2).load(records)
+        yield 'rules.load[{}]'.format(count), measure(load)
+
+        def move_all(game):
+            for piece in game.unmoved(game.active_player):
+                game.move(piece)
+        yield 'rules.move_chain[{}]'.format(count), measure_each(
+            lambda: make_game(count, moved=False), move_all)
+        game = make_game(count)
+        yield 'rules.check_victory[{}]'.format(count), measure(
+            lambda: game.check_victory(force=True))
+
+
+def indexed_frame(game):
+    player = game.active_player
+    unmoved = game.unmoved(player)
+    if not unmoved:
+        game.commanders(player)
+        game.rotated(player)
+    game.check_victory()
+
+
+def scan_frame(game):
+    player = game.active_player
+    mine = [_ for _ in game.pieces if _.player == player]
+    unmoved = [_ for _ in mine if not _.moved]
+    if not unmoved:
+        [_ for _ in mine if _.command_count > 0]
+        [_ for _ in mine if _.rotated]
+    for other in range(game.player_count):
+        mine = [_ for _ in game.pieces if _.player == other]
+        if not [_ for _ in mine if _.command_count > 0]:
+            return
+    [_ for _ in game.pieces if _.player == player]
+
+
+def bench_frame(context):
+    for count in PIECE_COUNTS:
+        game = make_game(count)
+        yield 'frame.indexed[{}]'.format(count), measure(
+            lambda: indexed_frame(game))
+        yield 'frame.scan[{}]'.format(count), measure(
+            lambda: scan_frame(game))
+
+
+def bench_protocol(context):
+    from game import network, protocol
+    for count in PIECE_COUNTS:
+        game = make_game(count)
+        message = {'type': 'snapshot', 'seq': 1,
+                   'snapshot': network.snapshot(game, game.pieces)}
+        encoded = network.encode(message), protocol.encode_message(message)
+        for format_, data in zip(('json', 'binary'), encoded):
+            yield 'protocol.encode_snapshot.{}[{}]'.format(
+                format_, count), measure(
+                lambda: network.encode_for(message, format_ == 'binary'))
+            yield 'protocol.decode_snapshot.{}[{}]'.format(
+                format_, count), measure(lambda: network.decode(data))
+        yield 'protocol.checksum[{}]'.format(count), measure(
+            lambda: protocol.checksum(network.snapshot(game, game.pieces)))
+    # a move that captured
+    delta = {'type': 'delta', 'seq': 12, 'crc': 0xdeadbeef,
+             'events': [['capture', 14], ['move', 3, 4, 5, 2]]}
+    for format_ in ('json', 'binary'):
+        data = network.encode_for(delta, format_ == 'binary')
+        yield 'protocol.encode_delta.{}'.format(format_), measure(
+            lambda: network.encode_for(delta, format_ == 'binary'))
+        yield 'protocol.decode_delta.{}'.format(format_), measure(
+            lambda: network.decode(data))
+
+
+def bench_pieces(context):
+    from euclid import Vector3
+    window = context.window()
+    board = window.gamestate.board
+    pieces = board.pieces
+    yield 'pieces.load_from_file[default]', measure(
+        lambda: pieces.load_from_file(board, 'default', board.players),
+        repeat=3)
+    for count in PIECE_COUNTS:
+        board.set_game(make_game(count))
+        yield 'pieces.load_from_game[{}]'.format(count), measure(
+            lambda: pieces.load_from_game(board, board.players), repeat=3)
+        player = board.players[0]
+        yield 'pieces.filter[{}]'.format(count), measure(
+            lambda: pieces.filter(player=player, moved=False))
+        # a ray from above one side, down across the board
+        origin = Vector3(board.width / 2., 0, 4)
+        direction = (board.position - origin).normalized()
+        yield 'pieces.pick[{}]'.format(count), measure(
+            lambda: board.pick(origin, direction))
+
+
+def bench_render(context):
+    from pyglet import gl
+    from euclid import Vector3
+    window = context.window()
+    board = window.gamestate.board
+    for count in RENDER_COUNTS:
+        board.set_game(make_game(count))
+        window.camera.position = Vector3(board.width, 0, board.width / 2.)
+        window.camera.looking_at = board.position
+        for batched in (False, True):
+            board.set_batched(batched)
+            window.switch_to()
+
+            def frame():
+                window.on_draw()
+                gl.glFinish()
+            frame()  # upload everything before timing
+            yield 'render.{}[{}]'.format(
+                'batched' if batched else 'per_piece', count), measure(
+                frame, repeat=3)
+        board.set_batched(board.batched)
+
+
+BENCHMARKS = [('models', bench_models), ('rules', bench_rules),
+              ('frame', bench_frame), ('protocol', bench_protocol),
+              ('pieces', bench_pieces),
+              ('render', bench_render)]
+
+
+class Context(object):
+    """Shares one window between the benchmarks that need GL."""
+    def __init__(self):
+        self._window = None
+
+    def window(self):
+        if self._window is None:
+            self._window = gl_window()
+        return self._window
+
+    def close(self):
+        if self._window is not None:
+            self._window.close()
+
+
+def run(groups):
+    results, skipped = {}, {}
+    context = Context()
+    try:
+        for group, benchmark in BENCHMARKS:
+            if groups and group not in groups:
+                continue
+            try:
+                for name, seconds in benchmark(context):
+                    results[name] = seconds
+                    print('{:<60} {:>12}'.format(name, format_time(seconds)))
+            except Skipped as ex:
+                skipped[group] = str(ex)
+                print('{:<60} {:>12}'.format(group + ' (skipped)', ''),
+                      str(ex))
+    finally:
+        context.close()
+    return results, skipped
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:.3f} {}'.format(seconds / scale, unit)
+    return '{:.3f} us'.format(seconds / 1e-6)
+
+
+def compare(results, baseline, tolerance):
+    """Print how the results compare to a baseline, and return the names
+    of the regressions.
+    """
+    regressions = []
+    print('\n{:<60} {:>8}'.format('compared to baseline', 'ratio'))
+    for name in sorted(set(results) & set(baseline)):
+        ratio = results[name] / max(baseline[name], 1e-12)
+        mark = ''
+        if ratio > 1 + tolerance:
+            mark = ' REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / (1 + tolerance):
+            mark = ' faster'
+        print('{:<60} {:>7.2f}x{}'.format(name, ratio, mark))
+    # benchmarks of the groups that ran, but not in the results this time
+    groups = set(_.split('.')[0] for _ in results)
+    for name in sorted(set(baseline) - set(results)):
+        if name.split('.')[0] in groups:
+            print('{:<60} {:>8}'.format(name, 'missing'))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('groups', nargs='*',
+                        help="groups to run: " +
+                        ', '.join(_ for _, __ in BENCHMARKS))
+    parser.add_argument('--out', help="write the results to this JSON file")
+    parser.add_argument('--baseline',
+                        help="compare against the results in this JSON file")
+    parser.add_argument('--tolerance', type=float, default=.2,
+                        help="slowdown allowed before it's a regression")
+    args = parser.parse_args()
+
+    results, skipped = run(args.groups)
+    if args.out:
+        with open(args.out, 'w') as outfile:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'time': time.time(),
+                       'results': results,
+                       'skipped': skipped}, outfile, indent=1,
+                      sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)['results']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+"""Computer opponents. Everything in here is headless, so it can run in a
+worker process (see `game.board.AIPlayer`) or in batch simulations.
+
+The search is an iterative deepening alpha-beta (negamax) over single
+actions, but its depth counts whole turns: a turn is a sequence of actions by
+the same player, so only passing it uses up depth and negates the score.
+Every piece has to move before anything else happens, so searching a fixed
+number of actions would rarely get past the moves of the side to move.
+
+The evaluation adds to the material what the next move phases will capture
+(see `outlook`): the pieces of both sides are bound to slide the way they
+face, so that's mostly known in advance.
+"""
+from __future__ import division, print_function
+import random
+import time
+
+from game.rules import STEPS
+from game.position import (
+    KINDS, EMPTY, CAPTURED, COMMAND, SPEED, ROTATION_STEP, kind_of,
+    player_of, direction_of, old_direction_of, remaining_of, is_moved)
+from game.movegen import legal_actions, make, unmake, MOVE, ROTATE, PASS
+
+WIN = 1000000
+# material values by kind; commanders are valued through COMMAND_VALUE
+PIECE_VALUES = {'B0': 0, 'O1': 30, 'O2': 40, 'D1': 30, 'D2': 40, 'A1': 40,
+                'A2': 50}
+KIND_VALUES = [PIECE_VALUES[_] for _ in KINDS]
+COMMAND_VALUE = 150
+# how much of the value of the pieces that are about to be captured counts:
+# the side to move captures before anything can be done about it, while the
+# other side gets to move and rotate its pieces out of the way first
+ATTACK_WEIGHT = .8
+DEFENSE_WEIGHT = .4
+# per square between the pieces that can move and the closest enemy
+# commander, so there's a way forward when nothing can be captured yet
+DISTANCE_WEIGHT = 1
+
+# transposition table entry flags
+EXACT, LOWER, UPPER = 0, 1, 2
+
+
+class Timeout(Exception):
+    pass
+
+
+def piece_value(code):
+    return (KIND_VALUES[kind_of(code)] +
+            COMMAND_VALUE * COMMAND[kind_of(code)])
+
+
+def outlook(position):
+    """What the next move phases look like, sliding every piece that still
+    has to move the way it faces, one at a time as if nothing else moved.
+    Returns, for each player, the value of the pieces it would capture (a
+    player about to lose all of its commanders stands to lose everything),
+    and how many squares its pieces that can move would end up from the
+    closest enemy commander, added up.
+    """
+    width, height = position.width, position.height
+    board, codes = position.board, position.codes
+    active = position.active_player
+    threatened = [set() for _ in range(position.player_count)]
+    movers = []
+    commanders = [[] for _ in range(position.player_count)]
+    for pid, square in enumerate(position.squares):
+        if square == CAPTURED:
+            continue
+        code = codes[pid]
+        player = player_of(code)
+        x, y = position.coordinates(square)
+        if COMMAND[kind_of(code)]:
+            commanders[player].append((x, y))
+        if not SPEED[kind_of(code)]:
+            continue
+        if player != active:
+            steps = SPEED[kind_of(code)]
+        elif is_moved(code):
+            steps = 0
+        else:
+            steps = remaining_of(code)
+        direction = direction_of(code)
+        dx, dy = STEPS[direction]
+        for _ in range(steps):
+            tx, ty = x + dx, y + dy
+            if not (0 <= tx < width and 0 <= ty < height):
+                break
+            other = board[ty * width + tx]
+            if other != EMPTY:
+                other_code = codes[other]
+                engaged = (direction_of(other_code) - direction) % 8 == 4
+                if (player_of(other_code) == player or
+                        (engaged and ROTATION_STEP[kind_of(other_code)] < 8)):
+                    break
+                threatened[player_of(other_code)].add(other)
+            x, y = tx, ty
+        movers.append((player, x, y))
+
+    attacks = [0] * position.player_count
+    for victim, pids in enumerate(threatened):
+        if not pids:
+            continue
+        commands = sum(COMMAND[kind_of(codes[_])] for _ in pids)
+        if commands and commands >= position.commands[victim]:
+            pids = position.pieces(victim)
+        value = sum(piece_value(codes[_]) for _ in pids)
+        for player in range(position.player_count):
+            if player != victim:
+                # shared between the attackers, with more than two players
+                attacks[player] += value / (position.player_count - 1)
+    distances = [0] * position.player_count
+    for player, x, y in movers:
+        targets = [_ for owner, squares in enumerate(commanders)
+                   if owner != player for _ in squares]
+        if targets:
+            distances[player] += min(max(abs(x - cx), abs(y - cy))
+                                     for cx, cy in targets)
+    return attacks, distances
+
+
+def evaluate(position):
+    """Score the position for the active player."""
+    if position.game_over:
+        return WIN if position.alive[position.active_player] else 0
+    scores = [COMMAND_VALUE * _ for _ in position.commands]
+    codes = position.codes
+    for pid, square in enumerate(position.squares):
+        if square != CAPTURED:
+            code = codes[pid]
+            scores[player_of(code)] += KIND_VALUES[kind_of(code)]
+    active = position.active_player
+    attacks, distances = outlook(position)
+    for player, distance in enumerate(distances):
+        scores[player] -= DISTANCE_WEIGHT * distance
+    mine = scores[active] + ATTACK_WEIGHT * attacks[active]
+    theirs = sum(scores) - scores[active] + DEFENSE_WEIGHT * (
+        sum(attacks) - attacks[active])
+    return int(mine - theirs)
+
+
+def free_move(position, pieces):
+    """An unmoved piece whose move can't change, or be changed by, the moves
+    of the others: nothing else moves from or into any square it may pass
+    over. Moving it first is as good as any other order, so the search only
+    has to try that. Returns None if every move depends on another.
+    """
+    width, height = position.width, position.height
+    codes, squares = position.codes, position.squares
+    paths = []
+    counts = {}
+    for pid in pieces:
+        code = codes[pid]
+        square = squares[pid]
+        dx, dy = STEPS[direction_of(code)]
+        x, y = position.coordinates(square)
+        path = [square]
+        for _ in range(remaining_of(code)):
+            x, y = x + dx, y + dy
+            if not (0 <= x < width and 0 <= y < height):
+                break
+            path.append(y * width + x)
+        paths.append((pid, path))
+        for square in path:
+            counts[square] = counts.get(square, 0) + 1
+    for pid, path in paths:
+        if all(counts[_] == 1 for _ in path):
+            return pid
+    return None
+
+
+class TranspositionTable(object):
+    """A fixed number of slots indexed by the low bits of the key, so memory
+    stays bounded. A slot is replaced when it's empty, left over from an
+    earlier search, or searched less deeply than the new entry.
+    """
+    def __init__(self, size=1 << 16):
+        self.size = size
+        self.slots = [None] * size
+        self.generation = 0
+
+    def new_search(self):
+        self.generation += 1
+
+    def get(self, key):
+        entry = self.slots[key % self.size]
+        if entry is not None and entry[0] == key:
+            return entry
+        return None
+
+    def put(self, key, depth, value, flag, action):
+        index = key % self.size
+        entry = self.slots[index]
+        if (entry is None or entry[5] != self.generation or
+                depth >= entry[1]):
+            self.slots[index] = (key, depth, value, flag, action,
+                                 self.generation)
+
+
+class Searcher(object):
+    """Finds the best action within a time limit."""
+    def __init__(self, table_size=1 << 16):
+        self.table = TranspositionTable(table_size)
+        self.history = {}
+        self.nodes = 0
+        self.deadline = None
+
+    def actions(self, position, last_rotated):
+        """The legal actions, minus redundant ones: moves that don't depend
+        on each other are made in a fixed order (see `free_move`), and
+        pieces are rotated in id order, and never back to where they
+        started the turn (that's the same as not rotating them at all).
+        """
+        actions = legal_actions(position)
+        if actions and actions[0][0] == MOVE:
+            pid = free_move(position, [_[1] for _ in actions])
+            return actions if pid is None else [(MOVE, pid)]
+        actions = []
+        for action in legal_actions(position):
+            kind, pid = action
+            if kind == ROTATE:
+                code = position.codes[pid]
+                step = ROTATION_STEP[kind_of(code)]
+                if (pid < last_rotated or
+                        (direction_of(code) + step) % 8 ==
+                        old_direction_of(code)):
+                    continue
+            actions.append(action)
+        return actions
+
+    def order(self, actions, best):
+        history = self.history
+        actions.sort(key=lambda a: (a != best, -history.get(a, 0)))
+        return actions
+
+    def search(self, position, depth, alpha, beta, last_rotated=-1):
+        self.nodes += 1
+        if not self.nodes & 255 and time.time() > self.deadline:
+            raise Timeout()
+        entry = self.table.get(position.key)
+        best_action = None
+        if entry is not None:
+            best_action = entry[4]
+            if entry[1] >= depth:
+                value, flag = entry[2], entry[3]
+                if flag == EXACT:
+                    return value
+                if flag == LOWER and value >= beta:
+                    return value
+                if flag == UPPER and value <= alpha:
+                    return value
+        if depth == 0:
+            return evaluate(position)
+        actions = self.actions(position, last_rotated)
+        if not actions:
+            return evaluate(position)
+
+        original_alpha = alpha
+        best_value = -WIN - 1
+        player = position.active_player
+        for action in self.order(actions, best_action):
+            mark = make(position, action)
+            if position.active_player == player:
+                # the same turn goes on, at the same depth
+                rotated = action[1] if action[0] == ROTATE else last_rotated
+                value = self.search(position, depth, alpha, beta, rotated)
+            else:
+                value = -self.search(position, depth - 1, -beta, -alpha)
+            unmake(position, mark)
+            if value > best_value:
+                best_value, best_action = value, action
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                self.history[action] = (self.history.get(action, 0) +
+                                        depth ** 2)
+                break
+
+        if best_value <= original_alpha:
+            flag = UPPER
+        elif best_value >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.table.put(position.key, depth, best_value, flag, best_action)
+        return best_value
+
+    def best_action(self, position, time_limit, max_depth=16,
+                    last_rotated=-1):
+        """Deepen the search a turn at a time until the time runs out (or
+        up to max_depth turns, without a time limit), and return the best
+        action of the last completed iteration.
+        """
+        actions = self.actions(position, last_rotated)
+        if len(actions) <= 1:
+            return actions[0] if actions else None
+        self.table.new_search()
+        if time_limit is None:
+            self.deadline = float('inf')
+        else:
+            self.deadline = time.time() + time_limit
+        best = actions[0]
+        mark = position.mark()
+        for depth in range(1, max_depth + 1):
+            try:
+                self.search(position, depth, -WIN - 1, WIN + 1,
+                            last_rotated)
+            except Timeout:
+                position.undo(mark)
+                break
+            entry = self.table.get(position.key)
+            if entry is not None and entry[4] in actions:
+                best = entry[4]
+            if entry is not None and abs(entry[2]) >= WIN:
+                break  # found a forced result
+        return best
+
+
+class RandomAgent(object):
+    """Plays random legal actions."""
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+
+    def choose(self, position):
+        actions = legal_actions(position)
+        # Don't spin on rotations forever
+        if actions and actions[-1][0] == PASS and self.random.random() < .5:
+            return actions[-1]
+        return self.random.choice(actions) if actions else None
+
+
+class AlphaBetaAgent(object):
+    """Plays the actions found by the Searcher. The time budget is per turn.
+    The first decision searches the whole turn, and the later ones mostly
+    find their answer in the transposition table, so every decision gets
+    half of the time left. Without a time budget it searches to a fixed
+    depth (in turns), which makes it deterministic.
+    """
+    def __init__(self, time_budget=1., table_size=1 << 16, max_depth=16):
+        self.time_budget = time_budget
+        self.max_depth = max_depth
+        self.searcher = Searcher(table_size)
+        self.last_rotated = -1
+        self.turn_end = None
+
+    def choose(self, position):
+        time_limit = None
+        if self.time_budget is not None:
+            if self.turn_end is None:
+                self.turn_end = time.time() + self.time_budget
+            time_limit = max(.01, (self.turn_end - time.time()) / 2)
+        action = self.searcher.best_action(position, time_limit,
+                                           self.max_depth, self.last_rotated)
+        if action is None or action[0] == PASS:
+            self.last_rotated = -1
+            self.turn_end = None
+        elif action[0] == ROTATE:
+            self.last_rotated = action[1]
+        return action
+
+
+def plan_turn(position, time_budget=1., table_size=1 << 16):
+    """Return the actions for the active player's whole turn, ending with the
+    one that passes it (unless the game ends first). Used by the AI player
+    in a worker process.
+    """
+    agent = AlphaBetaAgent(time_budget, table_size)
+    player = position.active_player
+    actions = []
+    while not position.game_over and position.active_player == player:
+        action = agent.choose(position)
+        if action is None:
+            break
+        actions.append(action)
+        make(position, action)
+    return actions
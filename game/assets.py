@@ -0,0 +1,117 @@
+"""A process-wide cache of loaded models and images. Every piece of the same
+class and player looks exactly the same, so they can all share one parsed OBJ
+and one set of vertex lists on the GPU.
+"""
+import math
+import pyglet
+from pyglet.graphics import Batch
+from game import atlas
+from game.profiler import PROFILER
+
+
+def get_piece_model_path(skin, player_index, name):
+    return 'skins/pieces/{}/models/player{}/{}.obj'.format(
+        skin, player_index, name)
+
+
+def get_piece_texture_path(skin):
+    return 'skins/pieces/{}/textures/'.format(skin)
+
+
+class Model(object):
+    """A parsed OBJ along with the batch holding its vertex lists."""
+    def __init__(self, obj):
+        self.obj = obj
+        self.batch = Batch()
+        self.vertex_lists = obj.add_to(self.batch)
+        # bounding cylinder around the z axis, used for picking
+        self.radius = 0.
+        self.bottom, self.top = float('inf'), float('-inf')
+        for mesh in obj.mesh_list:
+            for group in mesh.groups:
+                v = group.vertices
+                for x, y in zip(v[0::3], v[1::3]):
+                    self.radius = max(self.radius, math.hypot(x, y))
+                if len(v):
+                    self.bottom = min(self.bottom, min(v[2::3]))
+                    self.top = max(self.top, max(v[2::3]))
+
+    def delete(self):
+        """Free the vertex lists. The model can't be drawn afterwards."""
+        for vertex_list in self.vertex_lists:
+            vertex_list.delete()
+        self.vertex_lists = []
+
+
+class ModelCache(object):
+    """Caches piece models keyed by (skin, player index, class name)."""
+    def __init__(self):
+        self._models = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._models)
+
+    def __contains__(self, key):
+        return key in self._models
+
+    def get(self, skin, player_index, name):
+        """Return the shared Model, loading it on the first request."""
+        key = (skin, player_index, name)
+        model = self._models.get(key)
+        if model is not None:
+            self.hits += 1
+            return model
+        self.misses += 1
+        # the menu only needs the images, so the model parser (and NumPy)
+        # are imported once a model is needed
+        from game.obj_batch import OBJ
+        with PROFILER.scope('assets.load'):
+            obj = OBJ.load(get_piece_model_path(skin, player_index, name),
+                           texture_path=get_piece_texture_path(skin))
+            model = self._models[key] = Model(obj)
+        return model
+
+    def put(self, skin, player_index, name, obj):
+        """Cache a model whose OBJ was loaded elsewhere (see
+        `game.preload`). Its textures must be loaded already.
+        """
+        key = (skin, player_index, name)
+        if key not in self._models:
+            self._models[key] = Model(obj)
+        return self._models[key]
+
+    def evict(self, skin=None):
+        """Drop every cached model, or only those of the given skin. Pieces
+        still holding an evicted model must be reloaded before drawing.
+        """
+        for key in list(self._models):
+            if skin is None or key[0] == skin:
+                self._models.pop(key).delete()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+MODELS = ModelCache()
+
+# Decoded images by file name, shared by everything that shows them
+IMAGES = {}
+
+
+def load_image(filename):
+    """Load an image once. Its texture is created on first use, and shared
+    from then on. Images packed into an atlas are a region of the page.
+    """
+    image = IMAGES.get(filename)
+    if image is None:
+        found = atlas.lookup(filename)
+        if found is not None:
+            page, _, region = found
+            image = load_image(page).get_texture().get_region(*region)
+        else:
+            image = pyglet.image.load(filename)
+        IMAGES[filename] = image
+    return image
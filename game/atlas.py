@@ -0,0 +1,210 @@
+"""Texture atlases: a skin's textures packed into a few big pages, so models
+with different textures can share one texture (and one material group, see
+`obj_batch.Material`) and be drawn without rebinding in between.
+
+    python -m game.atlas build [textures/ ...]   # (re)build the atlases
+    python -m game.atlas binds [skin]            # texture binds per frame
+
+A build writes `atlas0.png`, `atlas1.png`, ... and an `atlas.json` table
+into the textures directory. `obj_batch` looks every texture up in the
+table when it loads a model and rewrites the UV coordinates into the page.
+Like compiled meshes, the atlases are ignored when any of the textures in
+them changed after the build.
+"""
+from __future__ import division, print_function
+import glob
+import json
+import os
+
+ATLAS_TABLE = 'atlas.json'
+ATLAS_PAGE = 'atlas{}.png'
+MAX_SIZE = 2048
+DEFAULT_DIRECTORIES = ('skins/pieces/*/textures', 'skins/interfaces/*/textures')
+
+# Loaded tables by directory (None when there's no usable atlas)
+_TABLES = {}
+
+
+def next_power_of_two(n):
+    size = 1
+    while size < n:
+        size *= 2
+    return size
+
+
+def pack(sizes, max_size=MAX_SIZE):
+    """Pack (name, width, height) rectangles onto shelves, tallest first.
+    Returns a list of pages, each a {name: (x, y, width, height)} dict.
+    Images of the same height keep their name order, so textures named
+    alike (the same player color) end up on the same page.
+    """
+    pages = []
+    regions = None
+    x = y = shelf = 0
+    for name, width, height in sorted(sizes, key=lambda _: (-_[2], _[0])):
+        if width > max_size or height > max_size:
+            raise ValueError("{} is too big for a {}x{} atlas".format(
+                name, max_size, max_size))
+        if regions is not None and x + width > max_size:
+            x, y, shelf = 0, y + shelf, 0
+        if regions is None or y + height > max_size:
+            regions = {}
+            pages.append(regions)
+            x = y = shelf = 0
+        regions[name] = (x, y, width, height)
+        x += width
+        shelf = max(shelf, height)
+    return pages
+
+
+def page_size(regions):
+    """The smallest power of two page that holds the regions."""
+    return (next_power_of_two(max(x + w for x, y, w, h in regions.values())),
+            next_power_of_two(max(y + h for x, y, w, h in regions.values())))
+
+
+def find_textures(directory):
+    """The image files in a directory that can go into an atlas."""
+    return sorted(_ for _ in os.listdir(directory)
+                  if _.lower().endswith(('.png', '.jpg', '.jpeg')) and
+                  not _.startswith('atlas'))
+
+
+def build_atlas(directory, max_size=MAX_SIZE):
+    """Pack every texture in the directory into atlas pages, and write the
+    pages and the table next to them. Returns the table.
+    """
+    import pyglet
+    images = {}
+    for name in find_textures(directory):
+        images[name] = pyglet.image.load(os.path.join(directory, name))
+    pages = pack([(name, image.width, image.height)
+                  for name, image in images.items()], max_size)
+    table = {'pages': [], 'textures': {}}
+    for index, regions in enumerate(pages):
+        width, height = page_size(regions)
+        data = bytearray(width * height * 4)
+        for name, (x, y, w, h) in regions.items():
+            # rows are stored bottom to top, like the region's y
+            rows = images[name].get_data('RGBA', w * 4)
+            for row in range(h):
+                start = ((y + row) * width + x) * 4
+                data[start:start + w * 4] = rows[row * w * 4:(row + 1) * w * 4]
+            table['textures'][name] = [index, x, y, w, h]
+        filename = ATLAS_PAGE.format(index)
+        pyglet.image.ImageData(width, height, 'RGBA', bytes(data)).save(
+            os.path.join(directory, filename))
+        table['pages'].append({'file': filename, 'size': [width, height]})
+    with open(os.path.join(directory, ATLAS_TABLE), 'w') as outfile:
+        json.dump(table, outfile, indent=1, sort_keys=True)
+    _TABLES.pop(directory, None)
+    return table
+
+
+def load_table(directory):
+    """The atlas table of a directory, or None if there's none or it's out
+    of date.
+    """
+    if directory in _TABLES:
+        return _TABLES[directory]
+    table = None
+    path = os.path.join(directory, ATLAS_TABLE)
+    try:
+        with open(path) as infile:
+            table = json.load(infile)
+        mtime = os.path.getmtime(path)
+        sources = [os.path.join(directory, _) for _ in table['textures']]
+        pages = [os.path.join(directory, _['file']) for _ in table['pages']]
+        if (any(os.path.getmtime(_) > mtime for _ in sources) or
+                not all(os.path.exists(_) for _ in pages)):
+            table = None
+    except (IOError, OSError, ValueError, KeyError):
+        table = None
+    _TABLES[directory] = table
+    return table
+
+
+def lookup(filename):
+    """Where a texture file is in its atlas: (page file, page size,
+    (x, y, width, height)), or None if it isn't in one.
+    """
+    directory, name = os.path.split(filename)
+    table = load_table(directory)
+    if table is None or name not in table['textures']:
+        return None
+    index, x, y, width, height = table['textures'][name]
+    page = table['pages'][index]
+    return ('{}/{}'.format(directory, page['file']), tuple(page['size']),
+            (x, y, width, height))
+
+
+def uv_transform(texture, page_size, region):
+    """(scale u, offset u, scale v, offset v) mapping the UVs of a texture
+    into its region of the page `texture`. The region is shrunk by half a
+    texel on every side, so linear filtering never samples the neighbors.
+    """
+    tex_coords = texture.tex_coords
+    u0, v0, u1, v1 = tex_coords[0], tex_coords[1], tex_coords[3], \
+        tex_coords[7]
+    width, height = page_size
+    x, y, w, h = region
+    su = (u1 - u0) / width
+    sv = (v1 - v0) / height
+    return ((w - 1) * su, u0 + (x + .5) * su,
+            (h - 1) * sv, v0 + (y + .5) * sv)
+
+
+def bind_counts(skin='default', board='default'):
+    """Texture binds per frame drawing the pieces of a board, one by one
+    and batched, with every texture separate and with the atlases. The
+    models are only parsed, so this works without a GL context.
+    """
+    from game.assets import get_piece_model_path, get_piece_texture_path
+    from game.obj_batch import OBJ
+    from game.rules import read_board
+    records = read_board(board)
+    textures, pages = set(), set()
+    per_piece = 0
+    models = {}
+    for record in records:
+        key = (record['player'] + 1, record['class'])
+        if key not in models:
+            models[key] = OBJ.load(
+                get_piece_model_path(skin, *key),
+                texture_path=get_piece_texture_path(skin),
+                load_textures=False)
+        obj = models[key]
+        for mesh in obj.mesh_list:
+            for group in mesh.groups:
+                name = getattr(group.material, 'texture_name', None)
+                if not name:
+                    continue
+                # every piece draws from its own batch
+                per_piece += 1
+                filename = obj.get_texture_file(name)
+                textures.add(filename)
+                found = lookup(filename)
+                pages.add(found[0] if found else filename)
+    return {'pieces': len(records), 'per_piece': per_piece,
+            'batched': len(textures), 'batched_atlas': len(pages)}
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:2] == ['build']:
+        directories = sys.argv[2:] or sorted(
+            _ for pattern in DEFAULT_DIRECTORIES for _ in glob.glob(pattern))
+        for directory in directories:
+            table = build_atlas(directory)
+            print('{}: {} textures on {} page(s)'.format(
+                directory, len(table['textures']), len(table['pages'])))
+    elif sys.argv[1:2] == ['binds']:
+        counts = bind_counts(*sys.argv[2:3])
+        print('{} pieces; texture binds per frame:'.format(counts['pieces']))
+        print('  drawn one by one  {:>4}'.format(counts['per_piece']))
+        print('  batched           {:>4}'.format(counts['batched']))
+        print('  batched, atlas    {:>4}'.format(counts['batched_atlas']))
+    else:
+        print("Usage: {} build [textures/ ...]".format(sys.argv[0]))
+        print("       {} binds [skin]".format(sys.argv[0]))
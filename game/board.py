@@ -1,19 +1,33 @@
 from __future__ import unicode_literals, print_function
 from weakref import proxy
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
 import pyglet
 from pyglet.graphics import Batch
 from game.obj_batch import OBJ
-from game.pieces import PieceList
+from game.pieces import PieceList, PieceBatch
+from game.rules import Game, LOAD, MOVE, ROTATE, CAPTURE
+from game.position import Position
+from game.movegen import PASS
+from game.ai import plan_turn
+from game.replay import ReplayWriter, EXTENSION
+from game import savegame
+from game.profiler import profiled
 from euclid import Vector3
-from game.renderer import draw_highlight, color_at_point
-from collections import deque
+from game.renderer import (HighlightLayer, TiledBoard, blend_colors,
+                           color_at_point, ray_box_intersection)
 
 SURFACE_HEIGHT = 0.36
+PIECE_SCALE = 0.8
 # TODO: maybe just brighten the highlight on hover?
 WHITE_HIGHLIGHT = (1.0, 1.0, 1.0, .75)
 BLUE_HIGHLIGHT = (0.0, 0.0, 0.7, .75)
 GREEN_HIGHLIGHT = (0.0, 0.7, 0.0, .75)
-RED_HIGHLIGHT = (0.7, 0.0, 0.0, .75)
+AI_ACTION_DELAY = 0.4  # seconds between the actions of computer players
 
 
 # TODO: Next objective should be getting things to load from skin files.
@@ -21,6 +35,11 @@ def get_skin_path(filename):
     return 'skins/boards/default/models/{}'.format(filename)
 
 
+def get_skin_metadata():
+    with open('skins/boards/default/metadata.json') as infile:
+        return json.load(infile)
+
+
 class Player(object):
     # TODO: maybe automatic assigning of teams?
     def __init__(self, name, player_index):
@@ -28,125 +47,498 @@ class Player(object):
         self.player_index = player_index
 
 
+class AIPlayer(Player):
+    """A computer player. Its turns are planned in a worker process (see
+    `game.ai.plan_turn`), so the window keeps drawing while it thinks. The
+    process starts with its first turn and stops with `close`.
+    """
+    time_budget = 2.  # seconds of thinking per turn
+
+    def __init__(self, name, player_index, time_budget=None):
+        super(AIPlayer, self).__init__(name, player_index)
+        if time_budget is not None:
+            self.time_budget = time_budget
+        self._pool = None
+        self._pieces = []
+        self._plan = None
+        self._actions = None
+
+    def start_turn(self, game):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(1)
+        # the planned actions refer to pieces by their index in this list
+        self._pieces = list(game.pieces)
+        self._actions = None
+        self._plan = self._pool.apply_async(
+            plan_turn, (Position.from_game(game), self.time_budget))
+
+    def next_action(self):
+        """Return the next planned (action kind, rules piece) pair, or None
+        while still thinking or when out of actions.
+        """
+        if self._actions is None:
+            if self._plan is None or not self._plan.ready():
+                return None
+            self._actions = self._plan.get()
+            self._plan = None
+        if not self._actions:
+            return None
+        kind, pid = self._actions.pop(0)
+        return kind, None if pid is None else self._pieces[pid]
+
+    def close(self):
+        """Stop the worker process, dropping the turn it's planning."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        self._plan = None
+
+
+class RemotePlayer(Player):
+    """A player connected to the same server match (see `game.network`).
+    Its actions arrive as deltas from the server.
+    """
+    pass
+
+
 class Board(object):
     """The global gameboard. It's better to not instantiate new ones of these,
     but rather just reuse it by clearing pieces and adding them anew.
+
+    The state of the game is kept by a headless `game.rules.Game`; the board
+    draws it and turns mouse input into game actions.
     """
     width, height = 8, 8
-    game_over = False
+    # The GPU picker renders every piece in a unique color and reads back the
+    # pixel under the cursor; the default casts a ray on the CPU instead.
+    gpu_picking = 'gpupick' in sys.argv
+    # Draw the pieces from a single batch of pre-transformed vertices instead
+    # of one batch (and matrix setup) per piece.
+    batched = 'batched' in sys.argv
+    # The board model isn't loaded here but in the background (see
+    # `game.preload`), so the window opens right away; `syncload` loads it
+    # here instead.
+    background_model = 'syncload' not in sys.argv
+    # `record` writes a replay of every game to replays/ (see `game.replay`)
+    record = 'record' in sys.argv
+    replay_directory = 'replays'
+    # Local games are saved after every action, on a thread of their own
+    # (see `game.savegame`), unless `noautosave` is given.
+    autosave = 'noautosave' not in sys.argv
+    model_path = get_skin_path('board.obj')
+    texture_path = 'skins/boards/default/textures/'
 
     def __init__(self, window):
         self.window = proxy(window)
 
         # set up players
-        player1 = Player('Thane', 1)
-        player2 = Player('Stacey', 2)
-        self.players = deque([player1, player2])
-        self.active_player = self.players[0]
+        self.players = self.make_players()
+        self.remote = None
+        self.recorder = None
+        self.board_name = None
+        self.autosaver = savegame.Autosaver() if self.autosave else None
+        self.game = Game(self.width, self.height, len(self.players))
 
         # set up pieces
         self.pieces = PieceList()
         self.selected_piece = None
+        self._pick_key = None
+        self.piece_batch = None
+        if self.batched:
+            self.piece_batch = PieceBatch(PIECE_SCALE)
+        self._pick_extent = None
+        self.highlight_layer = None
+        self._highlights_dirty = True
 
         # misc setup
         self.position = Vector3(0, 0, -SURFACE_HEIGHT)
         self.batch = Batch()
-        self._obj = OBJ(get_skin_path('board.obj'),
-                        texture_path='skins/boards/default/textures/')
+        self._obj = None
+        # the model only fits boards of its size; others are made of tiles
+        self.model_size = tuple(get_skin_metadata().get('size', (8, 8)))
+        self.tiles = None
+        if not self.background_model:
+            self.load_model()
+        self.game.subscribe(self.on_game_event)
+
+    @property
+    def model(self):
+        return self._obj
+
+    def load_model(self):
+        self.set_model(OBJ.load(self.model_path,
+                                texture_path=self.texture_path))
+
+    def set_model(self, obj):
+        """Show the board model, once it's loaded."""
+        self._obj = obj
         self._obj.translate(*self.position)
         self._obj.add_to(self.batch)
-        pyglet.clock.schedule_interval(self.update, 1 / 60.)
+        self.window.invalidate()
+
+    def make_players(self):
+        player1 = Player('Thane', 1)
+        if 'ai' in sys.argv:
+            player2 = AIPlayer('Stacey', 2)
+        else:
+            player2 = Player('Stacey', 2)
+        return [player1, player2]
+
+    def close_players(self):
+        """Stop the computer players' worker processes (see
+        `AIPlayer.close`). They start again with their next turn.
+        """
+        pyglet.clock.unschedule(self.play_ai_action)
+        for player in self.players:
+            if isinstance(player, AIPlayer):
+                player.close()
+
+    @property
+    def active_player(self):
+        return self.players[self.game.active_player]
+
+    @property
+    def game_over(self):
+        return self.game.game_over
+
+    @property
+    def human_turn(self):
+        return not isinstance(self.active_player, (AIPlayer, RemotePlayer))
+
+    def set_remote(self, remote):
+        """Play a match on a server (see `game.network.RemoteGame`) instead
+        of a local game. The local player gets the seat the server gives it,
+        and the rest are remote. None goes back to local games.
+        """
+        self.close_players()
+        self.remote = remote
+        if remote is None:
+            self.players = self.make_players()
+        else:
+            remote.on_game.append(self.on_remote_game)
+
+    def on_remote_game(self, game):
+        """Show the copy of the match after joining it (or resyncing)."""
+        self.close_players()
+        self.players = [
+            (Player if i == self.remote.player else RemotePlayer)(
+                player.name, player.player_index)
+            for i, player in enumerate(self.make_players())]
+        self.set_game(game)
 
     def reset(self):
+        self.stop_recording()
         self.pieces.clear()
-        self.game_over = False
+        if self.piece_batch is not None:
+            self.piece_batch.clear()
+        self.game.reset()
+        self._pick_extent = None
+        self.invalidate_picking()
+
+    def set_batched(self, batched):
+        """Switch between drawing the pieces one by one and all at once."""
+        if self.piece_batch is not None:
+            self.piece_batch.clear()
+            self.piece_batch = None
+        if batched:
+            self.piece_batch = PieceBatch(PIECE_SCALE)
+            for piece in self.pieces:
+                self.piece_batch.add(piece)
+
+    def invalidate_picking(self):
+        """Pieces moved around, so the selection has to be recomputed."""
+        self._pick_key = None
 
     def load_state(self, statefilename):
         self.reset()
         self.pieces.load_from_file(self, statefilename, self.players)
+        self.board_name = statefilename
+        self.width, self.height = self.game.width, self.game.height
+        self.start_game()
+
+    def set_game(self, game, board_name=None):
+        """Show a game set up elsewhere (e.g. a generated or saved one)
+        instead. The listeners of the old game carry over to the new one.
+        """
+        self.reset()
+        for listener in self.game.listeners:
+            game.subscribe(listener)
+        del self.game.listeners[:]
+        self.game = game
+        self.board_name = board_name
+        self.width, self.height = game.width, game.height
+        self.pieces.load_from_game(self, self.players)
+        game.emit(LOAD)
+        self.start_game()
 
-    def update(self, dt):
-        self.selected_piece = self.get_selected_piece()
-        self.check_victory()  # TODO: call in a more efficient place.
+    def save_game(self, filename):
+        savegame.save(filename, self.game, board=self.board_name)
+
+    def load_game(self, filename):
+        """Resume a saved game. Raises SaveError (or IOError) if the file
+        can't be loaded.
+        """
+        game, header = savegame.load(filename)
+        self.set_game(game, header.get('board'))
+
+    @profiled('autosave')
+    def autosave_game(self):
+        if self.autosaver is not None and self.remote is None:
+            self.autosaver.save(self.game, board=self.board_name)
+
+    def start_game(self):
+        if self.piece_batch is not None:
+            for piece in self.pieces:
+                self.piece_batch.add(piece)
+        if self.record and self.remote is None:
+            self.start_recording()
+        self.check_victory()
+        self.update()
+        self.start_turn()
+
+    def on_game_event(self, event, piece):
+        """Keep the rendered pieces in step with the rules game."""
+        self._highlights_dirty = True
+        self.window.invalidate()
+        if event == CAPTURE:
+            if self.piece_batch is not None:
+                self.piece_batch.remove(self.pieces.piece_for(piece))
+            self.pieces.remove_state(piece)
+        elif event in (MOVE, ROTATE) and self.piece_batch is not None:
+            self.piece_batch.update(self.pieces.piece_for(piece))
+        self.invalidate_picking()
+
+    @profiled('board.update')
+    def update(self, dt=None):
+        """Find the piece under the cursor. Call this when the cursor, the
+        camera or the pieces changed; nothing needs updating every frame.
+        """
+        selected_piece = self.get_selected_piece()
+        if selected_piece is not self.selected_piece:
+            self.selected_piece = selected_piece
+            self._highlights_dirty = True
+            self.window.invalidate()
 
     def check_victory(self):
-        # check victory
-        for player in self.players:
-            if not self.pieces.filter(player=player, command=True):
-                for piece in self.pieces.filter(player=player):
-                    self.pieces.remove(piece)
-        my_pieces = self.pieces.filter(player=self.active_player)
-        if len(self.pieces) == len(my_pieces):
-            self.game_over = True
-            # TODO: Some sort of dialog
+        # This is a no-op unless pieces were captured or the turn passed.
+        self.game.check_victory()
+        # TODO: Some sort of dialog
 
     def click(self):
-        if self.game_over:
+        if not self.human_turn:
             return
-        # setup
-        piece = self.selected_piece
-        if not piece:
-            return
-        my_pieces = self.pieces.filter(player=self.active_player)
-        # process moves
-        if piece in my_pieces.filter(moved=False):
-            piece.move()
+        self.act(self.selected_piece and self.selected_piece.state)
+
+    def act(self, piece):
+        """Move or rotate the piece of the rules game, as the turn allows."""
+        if self.remote is not None:
+            # the server plays it, and sends back what changed
+            self.remote.click(piece)
             return
-        if my_pieces.filter(moved=False):
-            return  # don't process rotation until we're done moving
-        # process rotation
-        commanders = my_pieces.filter(command=True)
-        rotate_limit = sum(piece.command_count for piece in commanders)
-        rotated = my_pieces.filter(rotated=True)
-        remaining_rotates = rotate_limit - len(rotated)
-        if ((remaining_rotates > 0 and
-             piece in my_pieces.filter(can_rotate=True)) or
-                piece in rotated):
-            # TODO: reverse rotate on right-click?
-            piece.rotate()
+        if self.game.click(piece):
+            if self.recorder is not None:
+                self.recorder.click(piece)
+            self.check_victory()
+            self.autosave_game()
+            self.update()
 
     def pass_turn(self):
-        self.players.append(self.players.popleft())
-        self.active_player = self.players[0]
-        for piece in self.pieces:
-            piece.reset()
+        if self.remote is not None:
+            self.remote.pass_turn()
+            return
+        self.game.pass_turn()
+        if self.recorder is not None:
+            self.recorder.pass_turn()
+        self.check_victory()
+        self.autosave_game()
+        self.update()
+        self.start_turn()
+
+    def start_recording(self):
+        if not os.path.isdir(self.replay_directory):
+            os.makedirs(self.replay_directory)
+        filename = os.path.join(self.replay_directory, time.strftime(
+            '%Y%m%d-%H%M%S') + EXTENSION)
+        self.recorder = ReplayWriter(
+            filename, self.game, board=self.board_name,
+            agents=[type(_).__name__ for _ in self.players])
 
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            print('Wrote a replay of {} actions to {}'.format(
+                self.recorder.actions, self.recorder.filename))
+            self.recorder = None
+
+    def start_turn(self):
+        """Let computer players start thinking about their turn."""
+        pyglet.clock.unschedule(self.play_ai_action)
+        if (isinstance(self.active_player, AIPlayer) and
+                not self.game.game_over):
+            self.active_player.start_turn(self.game)
+            pyglet.clock.schedule_interval(self.play_ai_action,
+                                           AI_ACTION_DELAY)
+
+    def play_ai_action(self, dt):
+        """Play the next action planned by the computer player, if any."""
+        if (not isinstance(self.active_player, AIPlayer) or
+                self.game.game_over):
+            pyglet.clock.unschedule(self.play_ai_action)
+            return
+        action = self.active_player.next_action()
+        if action is None:
+            return
+        kind, piece = action
+        if kind == PASS:
+            self.pass_turn()
+        else:
+            self.act(piece)
+
+    @profiled('picking')
     def get_selected_piece(self):
+        """Find the piece under the cursor. This is only recomputed when the
+        cursor, the camera or the pieces changed since the last call.
+        """
+        if self.gpu_picking:
+            return self.get_selected_piece_gpu()
+        window, camera = self.window, self.window.camera
+        key = (window.mouse.x, window.mouse.y, window.width, window.height,
+               tuple(camera.position), tuple(camera.looking_at))
+        if key == self._pick_key:
+            return self.selected_piece
+        self._pick_key = key
+        origin, direction = camera.ray(window.mouse.x, window.mouse.y,
+                                       window.width, window.height)
+        return self.pick(origin, direction)
+
+    def piece_at(self, x, y):
+        """The piece on a square, from the index of the rules game."""
+        return self.pieces.piece_for(self.game.piece_at(x, y))
+
+    def get_pick_extent(self):
+        """How high, and how far from the center of its square, any piece
+        may reach. The models don't change during a game, so this only
+        looks at the pieces once.
+        """
+        if self._pick_extent is None:
+            models = set(_._model for _ in self.pieces)
+            self._pick_extent = (
+                max(_.top for _ in models) * PIECE_SCALE,
+                max(_.radius for _ in models) * PIECE_SCALE)
+        return self._pick_extent
+
+    def pick(self, origin, direction):
+        """Cast a ray against the bounding boxes of the pieces on the squares
+        it passes over. If it misses them all, fall back to whatever piece
+        stands on the square where the ray hits the board.
+        """
+        if direction.z >= 0 or not self.pieces:
+            return None
+        # only the part of the ray between the top of the tallest piece and
+        # the surface of the board can hit anything
+        top, reach = self.get_pick_extent()
+        # squares of the game are offset from the centered board
+        cx, cy = (self.width - 1) / 2., (self.height - 1) / 2.
+        t_top = max(0., (top - origin.z) / direction.z)
+        t_surface = -origin.z / direction.z
+        xs = [origin.x + direction.x * t + cx + .5
+              for t in (t_top, t_surface)]
+        ys = [origin.y + direction.y * t + cy + .5
+              for t in (t_top, t_surface)]
+        nearest, hit = float('inf'), None
+        for x in range(int(math.floor(min(xs) - reach)),
+                       int(math.floor(max(xs) + reach)) + 1):
+            for y in range(int(math.floor(min(ys) - reach)),
+                           int(math.floor(max(ys) + reach)) + 1):
+                piece = self.piece_at(x, y)
+                if piece is None:
+                    continue
+                t = ray_box_intersection(origin, direction,
+                                         *piece.bounds(PIECE_SCALE))
+                if t is not None and t < nearest:
+                    nearest, hit = t, piece
+        if hit is None:
+            hit = self.piece_at(int(math.floor(xs[1])),
+                                int(math.floor(ys[1])))
+        return hit
+
+    def get_selected_piece_gpu(self):
         """Via a special rendering pass, find if the cursor is over any of the
         active pieces.
         """
         self.window.enable_3d()
         self.window.clear()
         for piece in self.pieces:
-            piece.draw_for_picker(scale=0.8)
+            piece.draw_for_picker(scale=PIECE_SCALE)
         color = color_at_point(self.window.mouse.x, self.window.mouse.y)
         for piece in self.pieces:
             if piece.matches_color(color):
                 return piece
         return None
 
+    @profiled('board.draw')
     def draw(self):
-        # draw board and pieces
-        self.batch.draw()
-        for piece in self.pieces:
-            piece.draw(scale=0.8)
+        # draw board and pieces, skipping what's off the screen
+        window = self.window
+        frustum = window.camera.frustum(window.width, window.height)
+        if (self.width, self.height) == self.model_size:
+            self.batch.draw()
+        else:
+            if self.tiles is None or (self.tiles.width, self.tiles.height) \
+                    != (self.width, self.height):
+                if self.tiles is not None:
+                    self.tiles.delete()
+                self.tiles = TiledBoard(self.width, self.height)
+            self.tiles.draw(frustum)
+        if self.piece_batch is not None:
+            self.piece_batch.draw(frustum)
+        else:
+            for piece in self.pieces:
+                if frustum.intersects_box(*piece.bounds(PIECE_SCALE)):
+                    piece.draw(scale=PIECE_SCALE)
+
+        if self._highlights_dirty:
+            self.update_highlights()
+        self.highlight_layer.draw(frustum)
 
+    def get_highlights(self):
+        """Map the squares to highlight to their colors."""
+        highlights = {}
         if self.game_over:
-            return
+            return highlights
+
+        def highlight(piece, color):
+            square = piece.state.square
+            highlights[square] = blend_colors(highlights.get(square), color)
 
         # highlight the squares under the right pieces
-        my_pieces = self.pieces.filter(player=self.active_player)
-        if self.selected_piece and self.selected_piece in my_pieces:
-            draw_highlight(self.selected_piece.square_center, WHITE_HIGHLIGHT)
+        player = self.active_player
+        if self.selected_piece and self.selected_piece.player is player:
+            highlight(self.selected_piece, WHITE_HIGHLIGHT)
             # TODO: instead draw an arrow of where it will move
 
-        still_to_move = my_pieces.filter(moved=False)
+        still_to_move = self.pieces.filter(player=player, moved=False)
         if still_to_move:
             for piece in still_to_move:
-                draw_highlight(piece.square_center, BLUE_HIGHLIGHT)
+                highlight(piece, BLUE_HIGHLIGHT)
         else:
-            commanders = my_pieces.filter(command=True)
-            rotate_limit = sum(piece.command_count for piece in commanders)
-            rotated = my_pieces.filter(rotated=True)
-            for piece in commanders.limit(rotate_limit - len(rotated)) + rotated:
-                draw_highlight(piece.square_center, GREEN_HIGHLIGHT)
\ No newline at end of file
+            commanders = self.pieces.filter(player=player, command=True)
+            rotated = self.pieces.filter(player=player, rotated=True)
+            remaining = self.game.remaining_rotations(self.game.active_player)
+            for piece in commanders.limit(remaining) + rotated:
+                highlight(piece, GREEN_HIGHLIGHT)
+        return highlights
+
+    def update_highlights(self):
+        """Recompute the highlights after the game or the selection changed.
+        """
+        layer = self.highlight_layer
+        if layer is None or (layer.width, layer.height) != (self.width,
+                                                            self.height):
+            if layer is not None:
+                layer.delete()
+            layer = self.highlight_layer = HighlightLayer(self.width,
+                                                          self.height)
+        layer.set(self.get_highlights())
+        self._highlights_dirty = False
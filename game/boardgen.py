@@ -0,0 +1,77 @@
+"""Generate synthetic boards of any size, to play and to test big boards
+with:
+
+    python -m game.boardgen huge 256 256 --ranks 4
+    python main.py board=huge
+
+Each player fills `ranks` rows at its end of the board, facing the other
+one. The armies mirror each other, so neither side has an advantage but
+moving first, and every eighth piece is a commander.
+"""
+from __future__ import division, print_function
+import argparse
+import json
+import random
+
+from game.rules import PIECE_TYPES, MAX_SIZE, STEPS
+
+SOLDIERS = sorted(_ for _ in PIECE_TYPES if PIECE_TYPES[_].command_count == 0)
+COMMANDER_EVERY = 8
+
+
+def generate(width, height, ranks=2, density=1., seed=0):
+    """A two player board as the JSON of a `.board` file."""
+    if not (0 < width <= MAX_SIZE and 0 < height <= MAX_SIZE):
+        raise ValueError("Boards can't be {}x{}".format(width, height))
+    if not 0 < ranks <= height // 2:
+        raise ValueError("{} ranks don't fit on {} rows".format(ranks,
+                                                                height))
+    rng = random.Random(seed)
+    squares = [(x, y) for y in range(ranks) for x in range(width)]
+    squares = sorted(rng.sample(squares, max(1, int(len(squares) *
+                                                    density))))
+    pieces = []
+    for i, (x, y) in enumerate(squares):
+        if i % COMMANDER_EVERY == 0:
+            kind = 'B0'
+        else:
+            kind = rng.choice(SOLDIERS)
+        # straight up the board, or diagonally for pieces that face that way
+        direction = STEPS.index((0, 1)) - PIECE_TYPES[kind].rotation_offset \
+            // 45
+        for player, (px, py), facing in (
+                (0, (x, y), direction),
+                (1, (width - 1 - x, height - 1 - y), direction + 4)):
+            pieces.append({'class': kind, 'player': player,
+                           'position': [px, py],
+                           'rotation': facing % 8 * 45})
+    return {'width': width, 'height': height, 'pieces': pieces}
+
+
+def write_board(name, data):
+    path = 'resources/' + name + '.board'
+    with open(path, 'w') as outfile:
+        json.dump(data, outfile, separators=(',', ':'))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('name', help="written to resources/<name>.board")
+    parser.add_argument('width', type=int)
+    parser.add_argument('height', type=int)
+    parser.add_argument('--ranks', type=int, default=2,
+                        help="rows of pieces per player")
+    parser.add_argument('--density', type=float, default=1.,
+                        help="fraction of the squares of the ranks to fill")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    data = generate(args.width, args.height, args.ranks, args.density,
+                    args.seed)
+    print('Wrote {} pieces on {}x{} to {}'.format(
+        len(data['pieces']), args.width, args.height,
+        write_board(args.name, data)))
+
+
+if __name__ == "__main__":
+    main()
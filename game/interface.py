@@ -1,21 +1,128 @@
-"""Support for loading *.interface files."""
+"""Support for loading *.interface files.
+
+An interface file lists views, each followed by its indented attributes:
+
+    TextButton
+        id: start_game
+        x: window.left
+        y: window.verticalcenter + 30
+        text: Start Game
+        image: button.png
+
+The positions are arithmetic on numbers and the window's edges and centers.
+Every file is parsed once into a `Layout`, with the positions compiled into
+`Expression`s that are evaluated again whenever the window is resized.
+"""
+from __future__ import division
+import operator
+import re
 from pyglet import gl
 import pyglet
 from pyglet.sprite import Sprite
+from game.assets import load_image
+
+# The window dimensions an expression can use, from the width and height
+WINDOW_VALUES = {
+    'left': lambda width, height: 0,
+    'bottom': lambda width, height: 0,
+    'right': lambda width, height: width,
+    'top': lambda width, height: height,
+    'horizontalcenter': lambda width, height: width / 2,
+    'verticalcenter': lambda width, height: height / 2,
+}
+OPERATORS = {'+': operator.add, '-': operator.sub, '*': operator.mul,
+             '/': operator.truediv}
+TOKEN = re.compile(r'\s*(?:(\d+\.?\d*|\.\d+)|window\.(\w+)|([-+*/()]))')
+EXPRESSION_KEYS = ('x', 'y')
+TEXT_KEYS = ('text', 'image', 'id')
+
+
+class Expression(object):
+    """An arithmetic expression like `window.verticalcenter - 30`, compiled
+    once into nested functions of the window's width and height. Only
+    numbers, `window.<dimension>`, + - * / and parentheses are allowed.
+    """
+    def __init__(self, text):
+        self.text = text
+        self._tokens = self._tokenize(text)
+        self._position = 0
+        self._evaluate = self._sum()
+        if self._position != len(self._tokens):
+            self._error()
+
+    def __call__(self, width, height):
+        return self._evaluate(width, height)
 
-CHARACTER_WHITELIST = set("0123456789 -+/*")
+    def _error(self):
+        raise AttributeError("Invalid calculation `{}`.".format(self.text))
 
+    def _tokenize(self, text):
+        tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = TOKEN.match(text, position)
+            if match is None:
+                self._error()
+            number, name, symbol = match.groups()
+            if number is not None:
+                value = float(number) if '.' in number else int(number)
+                tokens.append(('number', value))
+            elif name is not None:
+                if name not in WINDOW_VALUES:
+                    self._error()
+                tokens.append(('window', name))
+            else:
+                tokens.append(('symbol', symbol))
+            position = match.end()
+        return tokens
 
-def clean_value(v, window):
-    v = v.replace('window.verticalcenter', str(window.height / 2))
-    v = v.replace('window.horizontalcenter', str(window.height / 2))
-    v = v.replace('window.left', "0")
-    v = v.replace('window.bottom', "0")
-    v = v.replace('window.top', str(window.height))
-    v = v.replace('window.right', str(window.width))
-    if len(set(v) - CHARACTER_WHITELIST):
-        raise AttributeError("Invalid characters specified in calculation.")
-    return v
+    def _peek(self):
+        if self._position < len(self._tokens):
+            kind, value = self._tokens[self._position]
+            if kind == 'symbol':
+                return value
+        return None
+
+    def _next(self):
+        if self._position >= len(self._tokens):
+            self._error()
+        self._position += 1
+        return self._tokens[self._position - 1]
+
+    def _binary(self, operands, symbols):
+        left = operands()
+        while self._peek() in symbols:
+            function = OPERATORS[self._next()[1]]
+            right = operands()
+            left = (lambda function, left, right: lambda width, height:
+                    function(left(width, height), right(width, height)))(
+                        function, left, right)
+        return left
+
+    def _sum(self):
+        return self._binary(self._product, ('+', '-'))
+
+    def _product(self):
+        return self._binary(self._factor, ('*', '/'))
+
+    def _factor(self):
+        kind, value = self._next()
+        if kind == 'number':
+            return lambda width, height: value
+        if kind == 'window':
+            return WINDOW_VALUES[value]
+        if value == '-':
+            operand = self._factor()
+            return lambda width, height: -operand(width, height)
+        if value == '+':
+            return self._factor()
+        if value == '(':
+            inner = self._sum()
+            if self._next() != ('symbol', ')'):
+                self._error()
+            return inner
+        self._error()
 
 
 def draw_rect(x, y, width, height):
@@ -31,14 +138,19 @@ def draw_rect(x, y, width, height):
 # TODO: Batch-based rendering for all these elements
 class View(Sprite):
     def __init__(self, **kwargs):
-        """All UI elements inherit from this base class."""
+        """All UI elements inherit from this base class. Views only get
+        events while they're shown (see `show`).
+        """
         self._window = kwargs.pop('window')
-        self._window.push_handlers(self)
-        image = pyglet.image.load(
+        image = load_image(
             'skins/interfaces/default/textures/{}'.format(kwargs.pop('image')))
         self.id = kwargs.pop('id')
         super(View, self).__init__(image, **kwargs)
 
+    def show(self):
+        self.visible = True
+        self._window.push_handlers(self)
+
     def cleanup(self):
         self._window.remove_handlers(self)
 
@@ -67,6 +179,12 @@ class Button(View):
     def on_press(self):
         pass
 
+    def cleanup(self):
+        super(Button, self).cleanup()
+        self.charged = False
+        # let go of the callback of the state that's going away
+        self.__dict__.pop('on_press', None)
+
 
 class TextButton(Button):
     def __init__(self, **kwargs):
@@ -86,4 +204,71 @@ class TextButton(Button):
         return self._label.text
     @text.setter
     def text(self, value):
-        self._label.text = value
\ No newline at end of file
+        self._label.text = value
+
+
+class Layout(object):
+    """A parsed interface file: the class, the attributes and the position
+    expressions of every view in it.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.views = []  # (view class, attributes, expressions)
+        with open(filename, 'r') as infile:
+            lines = [_ for _ in infile if _.strip() and not _.startswith('#')]
+        for line in lines:
+            # if we're indented, it's an attribute.
+            if line.startswith('    ') or line.startswith('\t'):
+                key, value = [_.strip() for _ in line.split(':', 1)]
+                if not self.views:
+                    raise AttributeError(
+                        "Attribute `{}` comes before any view.".format(key))
+                _, attrs, expressions = self.views[-1]
+                if key in EXPRESSION_KEYS:
+                    expressions[key] = Expression(value)
+                elif key in TEXT_KEYS:
+                    attrs[key] = value
+                else:
+                    raise AttributeError(
+                        "Invalid key `{}` specified for interface element."
+                        "".format(key))
+            # if not indented, it's a view declaration
+            else:
+                ViewClass = globals().get(line.strip())
+                if not (isinstance(ViewClass, type) and
+                        issubclass(ViewClass, View)):
+                    raise AttributeError(
+                        "Unknown view `{}`.".format(line.strip()))
+                self.views.append((ViewClass, {}, {}))
+
+    def positions(self, width, height):
+        """The evaluated expressions of every view for a window size."""
+        return [{key: expression(width, height)
+                 for key, expression in expressions.items()}
+                for _, __, expressions in self.views]
+
+    def create(self, window):
+        """Make the views, laid out for the window's current size."""
+        return [ViewClass(window=window, **dict(attrs, **position))
+                for (ViewClass, attrs, _), position in zip(
+                    self.views, self.positions(window.width, window.height))]
+
+    def reflow(self, views, width, height):
+        """Move views made by `create` to where they go in a window of the
+        given size.
+        """
+        for view, position in zip(views, self.positions(width, height)):
+            view.set_position(position.get('x', view.x),
+                              position.get('y', view.y))
+
+
+# Parsed layouts by file name
+LAYOUTS = {}
+
+
+def load_layout(filename):
+    """Parse an interface file the first time it's asked for."""
+    layout = LAYOUTS.get(filename)
+    if layout is None:
+        layout = LAYOUTS[filename] = Layout(filename)
+    return layout
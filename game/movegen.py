@@ -0,0 +1,178 @@
+"""Legal action generation for positions (see `game.position`).
+
+An action is a `(kind, piece id)` tuple: MOVE and ROTATE act on a piece, and
+PASS (with a piece id of None) ends the turn. `make` applies an action the
+way clicking on the board does, including the victory check that follows
+it, and returns a mark that `unmake` uses to restore the position.
+`make_captures` also tells which pieces the action captured.
+"""
+from __future__ import division, print_function
+import sys
+import time
+
+from game.rules import STEPS, read_board_file
+from game.position import (
+    Position, EMPTY, CAPTURED, ROTATION_STEP, MOVED_FLAG, kind_of, player_of,
+    direction_of, remaining_of, is_moved, is_rotated, with_direction,
+    with_remaining, reset_code)
+
+MOVE, ROTATE, PASS = 0, 1, 2
+PASS_ACTION = (PASS, None)
+
+
+def legal_actions(position):
+    """All the actions the active player can take. Every unmoved piece has to
+    be moved (in any order) before anything can be rotated or the turn
+    passed.
+    """
+    if position.game_over:
+        return []
+    player = position.active_player
+    codes = position.codes
+    pieces = [pid for pid, square in enumerate(position.squares)
+              if square != CAPTURED and player_of(codes[pid]) == player]
+    if position.unmoved[player]:
+        return [(MOVE, pid) for pid in pieces if not is_moved(codes[pid])]
+    actions = []
+    can_rotate_more = position.commands[player] > position.rotated[player]
+    for pid in pieces:
+        code = codes[pid]
+        if ((can_rotate_more and ROTATION_STEP[kind_of(code)] < 8) or
+                is_rotated(code)):
+            actions.append((ROTATE, pid))
+    actions.append(PASS_ACTION)
+    return actions
+
+
+def make(position, action):
+    """Apply the action and return the mark to pass to `unmake`."""
+    mark = position.mark()
+    kind, pid = action
+    if kind == MOVE:
+        move(position, pid)
+    elif kind == ROTATE:
+        rotate(position, pid)
+    else:
+        pass_turn(position)
+    check_victory(position)
+    return mark
+
+
+def make_captures(position, action):
+    """Like `make`, but return (mark, taken, lost): the ids of the pieces the
+    action captured, and of those lost along with their last commander.
+    """
+    mark = position.mark()
+    kind, pid = action
+    if kind == MOVE:
+        move(position, pid)
+    elif kind == ROTATE:
+        rotate(position, pid)
+    else:
+        pass_turn(position)
+    taken = captured_since(position, mark)
+    victory_mark = position.mark()
+    check_victory(position)
+    return mark, taken, captured_since(position, victory_mark)
+
+
+def captured_since(position, mark):
+    """The ids of the pieces captured since `position.mark()` was `mark`."""
+    return [pid for pid, square, code in position.journal(mark)
+            if pid is not None and square != CAPTURED and
+            position.squares[pid] == CAPTURED]
+
+
+def unmake(position, mark):
+    position.undo(mark)
+
+
+def move(position, pid):
+    """Slide the piece, capturing enemies in the way. This mirrors
+    `game.rules.Game.move`.
+    """
+    codes, board, width = position.codes, position.board, position.width
+    # This is always an *attempted* move, so it's marked such.
+    code = codes[pid] | MOVED_FLAG
+    player = player_of(code)
+    direction = direction_of(code)
+    dx, dy = STEPS[direction]
+    x, y = position.coordinates(position.squares[pid])
+    remaining = remaining_of(code)
+    while remaining:
+        remaining -= 1
+        tx, ty = x + dx, y + dy
+        if not (0 <= tx < width and 0 <= ty < position.height):
+            break
+        other = board[ty * width + tx]
+        if other != EMPTY:
+            other_code = codes[other]
+            engaged = (direction_of(other_code) - direction) % 8 == 4
+            can_capture = (not engaged or
+                           ROTATION_STEP[kind_of(other_code)] == 8)
+            if player_of(other_code) != player and can_capture:
+                position.set_piece(other, CAPTURED, other_code)
+            else:
+                break
+        x, y = tx, ty
+    position.set_piece(pid, y * width + x, with_remaining(code, remaining))
+
+
+def rotate(position, pid):
+    code = position.codes[pid]
+    direction = (direction_of(code) + ROTATION_STEP[kind_of(code)]) % 8
+    position.set_piece(pid, position.squares[pid],
+                       with_direction(code, direction))
+
+
+def pass_turn(position):
+    position.set_turn((position.active_player + 1) % position.player_count,
+                      position.game_over)
+    for pid, square in enumerate(position.squares):
+        if square != CAPTURED:
+            code = position.codes[pid]
+            if code != reset_code(code):
+                position.set_piece(pid, square, reset_code(code))
+
+
+def check_victory(position):
+    """Players without commanders lose all their pieces. The game is over
+    when only the active player has pieces left.
+    """
+    for player in range(position.player_count):
+        if position.alive[player] and not position.commands[player]:
+            for pid in position.pieces(player):
+                position.set_piece(pid, CAPTURED, position.codes[pid])
+    if (not position.game_over and
+            sum(position.alive) == position.alive[position.active_player]):
+        position.set_turn(position.active_player, True)
+
+
+def perft(position, depth):
+    """Count the action sequences of the given length (or shorter, where the
+    game ends early).
+    """
+    if depth == 0:
+        return 1
+    actions = legal_actions(position)
+    if not actions:
+        return 1
+    nodes = 0
+    for action in actions:
+        mark = make(position, action)
+        nodes += perft(position, depth - 1)
+        unmake(position, mark)
+    return nodes
+
+
+if __name__ == "__main__":
+    # Usage: python -m game.movegen [board name] [max depth]
+    name = sys.argv[1] if len(sys.argv) > 1 else 'default'
+    max_depth = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    root = Position.from_records(*read_board_file(name))
+    for depth in range(1, max_depth + 1):
+        start = time.time()
+        nodes = perft(root, depth)
+        elapsed = time.time() - start
+        print('perft({}) = {} in {:.3f}s ({:.0f} nodes/s)'.format(
+            depth, nodes, elapsed, nodes / max(elapsed, 1e-9)))
@@ -0,0 +1,376 @@
+"""Networked games: the messages between `server.py` and its clients, the
+matches the server hosts, and the client side for `PlayGameState`.
+
+Messages are JSON objects, one per line. A client joins a match, by name
+or wherever a seat is free:
+
+    {"type": "join", "match": "friday"}          client -> server
+    {"type": "joined", "match": "friday", "player": 1, "seq": 0,
+     "snapshot": {...}}                          server -> client
+
+(with `"binary": true`, the snapshot comes separately, in the format of
+`game.protocol`, and so do all later snapshots and deltas) and from then
+on sends the actions of its player:
+
+    {"type": "action", "action": "click", "piece": 12}
+    {"type": "action", "action": "pass"}
+
+The server is the only one applying the rules. Every valid action is
+broadcast to everyone in the match as a delta: the numbered list of what
+changed, e.g. `["move", 12, 3, 4, 2]` (piece, x, y, direction),
+`["rotate", 12, 3]` or `["capture", 30]`, and the checksum of the game
+after it (see `game.protocol.checksum`). Pieces are numbered by their
+order in the snapshot. A client that misses a delta, can't apply one or
+ends up with a different checksum asks for a new snapshot with
+`{"type": "resync"}`. Invalid actions only get an `error` back.
+
+Everything in here runs on Python 2 and 3, without pyglet.
+"""
+from __future__ import division, print_function
+import errno
+import json
+import socket
+
+from game.protocol import (FRAME, BINARY_TYPES, checksum, encode_message,
+                           decode_frame, split_messages)
+from game.rules import (Game, Piece, MOVE, ROTATE, CAPTURE, PASS_TURN,
+                        GAME_OVER)
+
+DEFAULT_PORT = 7777
+MAX_MESSAGE = 1 << 16  # bytes in a line
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class ActionError(Exception):
+    """An action the rules don't allow. The message goes to the client."""
+    pass
+
+
+def encode(message):
+    return json.dumps(message, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+def decode(line):
+    if line[:1] == FRAME:
+        return decode_frame(line)
+    message = json.loads(line.decode('utf-8'))
+    if not isinstance(message, dict):
+        raise ValueError("A message must be an object")
+    return message
+
+
+def encode_for(message, binary):
+    """A message in the format a client asked for."""
+    if binary and message['type'] in BINARY_TYPES:
+        return encode_message(message)
+    return encode(message)
+
+
+def parse_address(text, default_host='localhost'):
+    """A (host, port) pair from `host:port`, `host` or `:port`."""
+    host, _, port = text.rpartition(':') if ':' in text else (text, '', '')
+    return host or default_host, int(port) if port else DEFAULT_PORT
+
+
+def client_options(argv):
+    """The server address (`server=host:port`) and the name of the match to
+    join (`match=name`, or None for any) from the command line.
+    """
+    address, match = ('localhost', DEFAULT_PORT), None
+    for arg in argv:
+        if arg.startswith('server='):
+            address = parse_address(arg[len('server='):])
+        elif arg.startswith('match='):
+            match = arg[len('match='):]
+    return address, match
+
+
+# game state
+def snapshot(game, pieces):
+    """Everything a client needs to set up its copy of the game. Pieces
+    keep their number; captured ones are null.
+    """
+    return {
+        'width': game.width,
+        'height': game.height,
+        'players': game.player_count,
+        'active_player': game.active_player,
+        'game_over': game.game_over,
+        'pieces': [None if piece is None or piece.captured else
+                   [piece.kind, piece.player, piece.x, piece.y,
+                    piece.direction, piece.old_direction, piece.moved]
+                   for piece in pieces],
+    }
+
+
+def game_from_snapshot(data):
+    """A new game set up from a snapshot, and its pieces by number."""
+    game = Game(data['width'], data['height'], data['players'])
+    game.active_player = data['active_player']
+    pieces = []
+    for record in data['pieces']:
+        if record is None:
+            pieces.append(None)
+            continue
+        kind, player, x, y, direction, old_direction, moved = record
+        piece = Piece(kind, player, x, y, direction)
+        piece.old_direction = old_direction
+        if moved:
+            piece.moved = True
+            piece.remaining_move = 0
+        pieces.append(game.add(piece))
+    game.game_over = data['game_over']
+    return game, pieces
+
+
+def apply_events(game, pieces, events):
+    """Make the changes of a delta to a copy of the game. The game emits
+    the same events as if it played the action itself.
+    """
+    for event in events:
+        kind = event[0]
+        if kind == MOVE:
+            game.place(pieces[event[1]], MOVE, *event[2:5])
+        elif kind == ROTATE:
+            piece = pieces[event[1]]
+            game.place(piece, ROTATE, piece.x, piece.y, event[2])
+        elif kind == CAPTURE:
+            piece = pieces[event[1]]
+            pieces[event[1]] = None
+            game.capture(piece)
+        elif kind == PASS_TURN:
+            game.pass_turn()
+            if game.active_player != event[1]:
+                raise ValueError("Passed the turn to the wrong player")
+        elif kind == GAME_OVER:
+            game.game_over = True
+            game.emit(GAME_OVER)
+        else:
+            raise ValueError("Unknown event `{}`".format(kind))
+
+
+class Match(object):
+    """A game hosted by the server, with a seat for every player. It checks
+    the actions against the rules and turns them into deltas; the server
+    only passes messages around.
+    """
+    def __init__(self, name, records, width=8, height=8, player_count=2):
+        self.name = name
+        self.game = Game(width, height, player_count)
+        self.game.load(records)
+        self.pieces = list(self.game.pieces)
+        self.ids = {piece: pid for pid, piece in enumerate(self.pieces)}
+        self.seq = 0
+        self.seats = [None] * player_count
+        self._events = []
+        self.game.subscribe(self.on_game_event)
+
+    @property
+    def empty(self):
+        return not any(self.seats)
+
+    @property
+    def full(self):
+        return all(self.seats)
+
+    def join(self, client):
+        """Seat the client in the first free seat. Returns the player
+        number, or None when the match is full.
+        """
+        for player, seated in enumerate(self.seats):
+            if seated is None:
+                self.seats[player] = client
+                return player
+        return None
+
+    def leave(self, client):
+        self.seats = [None if _ is client else _ for _ in self.seats]
+
+    def snapshot(self):
+        return snapshot(self.game, self.pieces)
+
+    def on_game_event(self, event, piece):
+        if event == MOVE:
+            self._events.append([event, self.ids[piece], piece.x, piece.y,
+                                 piece.direction])
+        elif event == ROTATE:
+            self._events.append([event, self.ids[piece], piece.direction])
+        elif event == CAPTURE:
+            self._events.append([event, self.ids[piece]])
+        elif event == PASS_TURN:
+            self._events.append([event, self.game.active_player])
+        elif event == GAME_OVER:
+            self._events.append([event])
+
+    def act(self, player, message):
+        """Play an action of a player. Returns the delta to broadcast, or
+        raises ActionError if the rules don't allow it.
+        """
+        game = self.game
+        if not self.full:
+            raise ActionError("Waiting for the other players.")
+        if game.game_over:
+            raise ActionError("The game is over.")
+        if player != game.active_player:
+            raise ActionError("It isn't your turn.")
+        del self._events[:]
+        action = message.get('action')
+        if action == 'click':
+            pid = message.get('piece')
+            if (not isinstance(pid, int) or isinstance(pid, bool) or
+                    not 0 <= pid < len(self.pieces)):
+                raise ActionError("There's no piece {}.".format(pid))
+            piece = self.pieces[pid]
+            if piece.captured or piece.player != player:
+                raise ActionError("That isn't one of your pieces.")
+            if not game.click(piece):
+                raise ActionError("That piece can't do anything now.")
+        elif action == 'pass':
+            # the same as the end turn button, which shows after moving
+            if game.phase != 'rotate':
+                raise ActionError("Every piece has to move first.")
+            game.pass_turn()
+        else:
+            raise ActionError("Unknown action `{}`.".format(action))
+        game.check_victory()
+        self.seq += 1
+        return {'type': 'delta', 'seq': self.seq,
+                'crc': checksum(self.snapshot()),
+                'events': list(self._events)}
+
+
+# the client side
+class Connection(object):
+    """A non-blocking connection to the server, for a client to poll from
+    its main loop (instead of running an event loop of its own).
+    """
+    def __init__(self, address, timeout=5.):
+        self.socket = socket.create_connection(address, timeout)
+        self.socket.setblocking(False)
+        self.closed = False
+        self._incoming = b''
+        self._outgoing = b''
+
+    def send(self, message):
+        self._outgoing += encode(message)
+        self.flush()
+
+    def flush(self):
+        while self._outgoing and not self.closed:
+            try:
+                sent = self.socket.send(self._outgoing)
+            except socket.error as ex:
+                if ex.errno in WOULD_BLOCK:
+                    return
+                raise
+            self._outgoing = self._outgoing[sent:]
+
+    def receive(self):
+        """Every message that arrived since the last call."""
+        self.flush()
+        while not self.closed:
+            try:
+                data = self.socket.recv(MAX_MESSAGE)
+            except socket.error as ex:
+                if ex.errno in WOULD_BLOCK:
+                    break
+                raise
+            if not data:
+                self.closed = True
+            self._incoming += data
+        messages, self._incoming = split_messages(self._incoming)
+        return [decode(_) for _ in messages if _.strip()]
+
+    def close(self):
+        self.closed = True
+        self.socket.close()
+
+
+class RemoteGame(object):
+    """A match on the server, as seen by a client. It sends the actions of
+    the local player, and keeps a copy of the game in step with the deltas
+    of the server. Every new copy (after joining, or resyncing) is passed to
+    the `on_game(game)` callbacks; deltas change the current copy, which
+    emits its events like any game does. Unless `binary` is off, snapshots
+    and deltas come in the format of `game.protocol`.
+    """
+    def __init__(self, connection, match=None, binary=True):
+        self.connection = connection
+        self.match = None
+        self.player = None
+        self.game = None
+        self.pieces = []
+        self.seq = None
+        self.seated = []
+        self.on_game = []
+        connection.send({'type': 'join', 'match': match, 'binary': binary})
+
+    @property
+    def my_turn(self):
+        return (self.game is not None and not self.game.game_over and
+                self.game.active_player == self.player)
+
+    def poll(self, dt=None):
+        if self.connection.closed:
+            return
+        try:
+            messages = self.connection.receive()
+        except socket.error as ex:
+            print('Lost the connection to the server: {}'.format(ex))
+            self.connection.close()
+            return
+        except ValueError as ex:
+            print('Bad message from the server ({}), resyncing'.format(ex))
+            self.resync()
+            return
+        for message in messages:
+            self.handle(message)
+
+    def handle(self, message):
+        kind = message.get('type')
+        if kind == 'joined':
+            self.match, self.player = message['match'], message['player']
+        if kind in ('joined', 'snapshot') and 'snapshot' in message:
+            self.game, self.pieces = game_from_snapshot(message['snapshot'])
+            self.seq = message['seq']
+            for callback in self.on_game:
+                callback(self.game)
+        elif kind == 'delta':
+            if self.seq is None:
+                return  # a snapshot is on its way
+            if message['seq'] != self.seq + 1:
+                self.resync()
+                return
+            try:
+                apply_events(self.game, self.pieces, message['events'])
+            except (IndexError, KeyError, TypeError, ValueError):
+                self.resync()
+                return
+            if ('crc' in message and
+                    checksum(snapshot(self.game, self.pieces)) !=
+                    message['crc']):
+                print('Out of sync with the server, resyncing')
+                self.resync()
+                return
+            self.seq = message['seq']
+        elif kind == 'players':
+            self.seated = message['seated']
+        elif kind == 'error':
+            print('Server: {}'.format(message.get('message')))
+
+    def resync(self):
+        self.seq = None
+        self.connection.send({'type': 'resync'})
+
+    def click(self, piece):
+        if piece is None:
+            return  # an empty square
+        # captured pieces leave a None behind, so look for this very piece
+        for index, other in enumerate(self.pieces):
+            if other is piece:
+                self.connection.send({'type': 'action', 'action': 'click',
+                                      'piece': index})
+                return
+
+    def pass_turn(self):
+        self.connection.send({'type': 'action', 'action': 'pass'})
@@ -1,12 +1,116 @@
 """Wavefront OBJ renderer using pyglet's Batch class.
 Based on the public domain code by Juan J. Martinez <jjm@usebox.net>.
+
+Models can also be compiled ahead of time into a binary `.mesh` file next to
+the `.obj`, which loads by memory-mapping the float arrays instead of parsing
+text. Run `python -m game.obj_batch compile` to (re)build them.
+
+Textures packed into an atlas (see `game.atlas`) are loaded from the atlas
+page instead, with the UV coordinates rewritten to match.
 """
+from __future__ import print_function
 import os
+import json
+import mmap
+import struct
+import ctypes
+from array import array
 import pyglet
 from pyglet import gl
 from pyglet import graphics
 import math
 import euclid
+from game import atlas
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MESH_EXTENSION = '.mesh'
+MESH_MAGIC = b'BNRMESH\x01'
+# magic, material table size in bytes, group count
+MESH_HEADER = struct.Struct('<8sII')
+# mesh index, material index (-1 for none), vertex count
+MESH_GROUP = struct.Struct('<iiI')
+FLOAT_SIZE = ctypes.sizeof(gl.GLfloat)
+# Every texture loaded so far by file name, whether ahead of time (see
+# `game.preload`) or on first use. An atlas page is loaded once, under the
+# name of the page, so all the materials on it share one texture object and
+# compare equal.
+TEXTURES = {}
+
+
+def get_compiled_path(filename):
+    return os.path.splitext(filename)[0] + MESH_EXTENSION
+
+
+def _tobytes(a):
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+
+def add_arrays(batch, material, count, vertices, normals, tex_coords):
+    """Add a vertex list to the batch, copying the data straight from
+    buffers (ctypes arrays, addresses of NumPy arrays, ...) instead of going
+    through tuples.
+    """
+    vertex_list = batch.add(count, gl.GL_TRIANGLES, material,
+                            'v3f/static', 'n3f/static', 't2f/static')
+    ctypes.memmove(vertex_list.vertices, vertices, count * 3 * FLOAT_SIZE)
+    ctypes.memmove(vertex_list.normals, normals, count * 3 * FLOAT_SIZE)
+    ctypes.memmove(vertex_list.tex_coords, tex_coords,
+                   count * 2 * FLOAT_SIZE)
+    return vertex_list
+
+
+def _records_array(records, width):
+    """Turn the string values of v/vn/vt records into an array, with the
+    same dummy first row that the OBJ indices (starting at 1) expect.
+    """
+    data = numpy.zeros((len(records) + 1, width))
+    if records:
+        data[1:] = numpy.array(records, dtype=numpy.float64)
+    return data
+
+
+def _absolute_corner(corner, records):
+    """Resolve the negative indices of a face corner token."""
+    indices = []
+    for index, key in zip(corner.split('/'), ('v', 'vt', 'vn')):
+        if index.startswith('-'):
+            index = str(int(index) + len(records[key]))
+        indices.append(index)
+    return '/'.join(indices)
+
+
+def _corner_indices(corners):
+    """Convert face corner tokens (`v`, `v/t`, `v//n`, `v/t/n`) into an
+    (n, 3) array of indices, using 0 for the missing ones.
+    """
+    text = ' '.join(corners)
+    if text.count('/') == 2 * len(corners):
+        values = text.replace('//', '/0/').replace('/', ' ').split()
+        if len(values) == 3 * len(corners):
+            return numpy.array(values, dtype=numpy.int64).reshape(-1, 3)
+    return numpy.array([([int(j or 0) for j in v.split('/')] + [0, 0])[:3]
+                        for v in corners], dtype=numpy.int64)
+
+
+def _fan_order(counts):
+    """The corner order used for fan triangulation: the first triangle of a
+    face is (0, 1, 2) and every further corner k adds (k, 0, k - 1).
+    """
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+    firsts = numpy.cumsum(counts) - counts
+    triangles = numpy.maximum(counts - 2, 0)
+    first = numpy.repeat(firsts, triangles)
+    k = (numpy.arange(triangles.sum()) -
+         numpy.repeat(numpy.cumsum(triangles) - triangles, triangles))
+    start = k == 0
+    return numpy.column_stack((
+        numpy.where(start, first, first + k + 2),
+        numpy.where(start, first + 1, first),
+        numpy.where(start, first + 2, first + k + 1),
+    )).ravel()
 
 
 class Material(graphics.Group):
@@ -42,13 +146,21 @@ class Material(graphics.Group):
             gl.glDisable(self.texture.target)
         gl.glDisable(gl.GL_COLOR_MATERIAL)
 
+    def properties(self):
+        return (list(self.diffuse), list(self.ambient), list(self.specular),
+                list(self.emission), self.shininess, self.opacity)
+
     def __eq__(self, other):
+        # Materials look the same when they have the same texture and
+        # lighting, so the groups of different models on one atlas page
+        # are merged by the batch
         if self.texture is None:
             return super(Material, self).__eq__(other)
         return (self.__class__ is other.__class__ and
                 self.texture.id == other.texture.id and
                 self.texture.target == other.texture.target and
-                self.parent == other.parent)
+                self.parent == other.parent and
+                self.properties() == other.properties())
 
     def __hash__(self):
         if self.texture is None:
@@ -60,11 +172,13 @@ class MaterialGroup(object):
     def __init__(self, material):
         self.material = material
 
-        # Interleaved array of floats in GL_T2F_N3F_V3F format
         self.vertices = []
         self.normals = []
         self.tex_coords = []
+        # (tex_coords, normals, vertices) float buffers of a compiled mesh
         self.array = None
+        # the UVs from the file, when they were mapped into an atlas
+        self.raw_tex_coords = None
 
 
 class Mesh(object):
@@ -80,22 +194,58 @@ class OBJ(object):
         loc = pyglet.resource.location(filename)
         return OBJ(filename, infile=loc.open(filename), path=loc.path)
 
-    def __init__(self, filename, infile=None, path=None, texture_path=None):
-        self.materials = {}
-        self.meshes = {}        # Name mapping
-        self.mesh_list = []     # Also includes anonymous meshes
-
-        self.transforms = euclid.Matrix4.new_identity()
-        self.normalize = False
+    @staticmethod
+    def load(filename, texture_path=None, load_textures=True):
+        """Load the compiled version of the object if it's up to date,
+        otherwise fall back to parsing the .obj file.
+        """
+        try:
+            return OBJ.from_compiled(filename, texture_path=texture_path,
+                                     load_textures=load_textures)
+        except (IOError, OSError, ValueError, struct.error):
+            return OBJ(filename, texture_path=texture_path,
+                       load_textures=load_textures)
 
-        self.texture_path = texture_path
+    @staticmethod
+    def from_compiled(filename, texture_path=None, load_textures=True):
+        """Memory-map a compiled .mesh file. Raises ValueError if it's
+        missing something or older than its sources.
+        """
+        obj = OBJ.__new__(OBJ)
+        obj._setup(filename, None, texture_path, load_textures)
+        obj._load_compiled(get_compiled_path(filename))
+        return obj
+
+    def __init__(self, filename, infile=None, path=None, texture_path=None,
+                 load_textures=True, vectorized=None):
+        """If `vectorized` is set, parse and transform with NumPy arrays.
+        It defaults to True when NumPy is installed. Both paths produce
+        identical vertex data.
+        """
+        self._setup(filename, path, texture_path, load_textures)
+        if vectorized is None:
+            vectorized = numpy is not None
+        elif vectorized and numpy is None:
+            raise ImportError("The vectorized OBJ loader requires NumPy.")
+        self.vectorized = vectorized
         if infile is None:
             infile = open(filename, 'r')
 
-        if path is None:
-            path = os.path.dirname(filename)
-        self.path = path
+        if vectorized:
+            normal_count = self._parse_arrays(infile)
+        else:
+            normal_count = self._parse(infile)
+        assert normal_count > 0, \
+            ("It appears this .obj file is missing normals data. See this "
+             "post for info on how to export from Blender: "
+             "http://blender.stackexchange.com/questions/121/"
+             "how-do-i-export-a-model-to-obj-format")
+        self._map_tex_coords()
 
+    def _parse(self, infile):
+        """Parse the file line by line into Python lists. Returns the number
+        of normals found.
+        """
         mesh = None
         group = None
         material = None
@@ -118,6 +268,7 @@ class OBJ(object):
             elif values[0] == 'vt':
                 tex_coords.append(map(float, values[1:3]))
             elif values[0] == 'mtllib':
+                self.mtllibs.append(values[1])
                 self.load_material_library(values[1])
             elif values[0] in ('usemtl', 'usemat'):
                 material = self.materials.get(values[1], None)
@@ -177,11 +328,220 @@ class OBJ(object):
                     tlast = tex_coords[t_index]
                     vlast = vertices[v_index]
 
-        assert len(normals) > 1, \
-            ("It appears this .obj file is missing normals data. See this "
-             "post for info on how to export from Blender: "
-             "http://blender.stackexchange.com/questions/121/"
-             "how-do-i-export-a-model-to-obj-format")
+        return len(normals) - 1
+
+    def _parse_arrays(self, infile):
+        """Parse the file like `_parse`, but gather the records as strings and
+        turn them into NumPy arrays in bulk. Faces are fan triangulated with
+        index arithmetic instead of list concatenation.
+        """
+        records = {'v': [], 'vn': [], 'vt': []}
+        faces = []  # (group, corner tokens, corner counts)
+        mesh = None
+        group = None
+        material = None
+
+        for line in infile:
+            if line.startswith('#'):
+                continue
+            values = line.split()
+            if not values:
+                continue
+
+            if values[0] in ('v', 'vn'):
+                records[values[0]].append(values[1:4])
+            elif values[0] == 'vt':
+                records['vt'].append(values[1:3])
+            elif values[0] == 'mtllib':
+                self.mtllibs.append(values[1])
+                self.load_material_library(values[1])
+            elif values[0] in ('usemtl', 'usemat'):
+                material = self.materials.get(values[1], None)
+                if material is None:
+                    print('Unknown material: %s'.format(values[1]))
+                if mesh is not None:
+                    group = MaterialGroup(material)
+                    mesh.groups.append(group)
+            elif values[0] == 'o':
+                mesh = Mesh(values[1])
+                self.meshes[mesh.name] = mesh
+                self.mesh_list.append(mesh)
+                group = None
+            elif values[0] == 'f':
+                if mesh is None:
+                    mesh = Mesh('')
+                    self.mesh_list.append(mesh)
+                if material is None:
+                    # FIXME
+                    material = Material("<unknown>")
+                if group is None:
+                    group = MaterialGroup(material)
+                    mesh.groups.append(group)
+                if not faces or faces[-1][0] is not group:
+                    faces.append((group, [], []))
+                corners = values[1:]
+                if '-' in line:
+                    # Relative indices depend on what has been read so far
+                    corners = [_absolute_corner(_, records) for _ in corners]
+                faces[-1][1].extend(corners)
+                faces[-1][2].append(len(corners))
+
+        vertices = _records_array(records['v'], 3)
+        normals = _records_array(records['vn'], 3)
+        tex_coords = _records_array(records['vt'], 2)
+        for group, corners, counts in faces:
+            indices = _corner_indices(corners)[_fan_order(counts)]
+            vertices_, tex_coords_, normals_ = indices.T
+            group.vertices = numpy.concatenate(
+                (group.vertices, vertices[vertices_].ravel()))
+            group.tex_coords = numpy.concatenate(
+                (group.tex_coords, tex_coords[tex_coords_].ravel()))
+            group.normals = numpy.concatenate(
+                (group.normals, normals[normals_].ravel()))
+        return len(records['vn'])
+
+    def _setup(self, filename, path, texture_path, load_textures):
+        self.filename = filename
+        self.materials = {}
+        self.meshes = {}        # Name mapping
+        self.mesh_list = []     # Also includes anonymous meshes
+        self.mtllibs = []
+
+        self.transforms = euclid.Matrix4.new_identity()
+        self.normalize = False
+
+        self.texture_path = texture_path
+        self.load_textures = load_textures
+        self.vectorized = numpy is not None
+
+        if path is None:
+            path = os.path.dirname(filename)
+        self.path = path
+
+    def _load_compiled(self, compiled_filename):
+        with open(compiled_filename, 'rb') as infile:
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, table_size, group_count = MESH_HEADER.unpack_from(data)
+        if magic != MESH_MAGIC:
+            raise ValueError("{} is not a compiled mesh".format(
+                compiled_filename))
+        offset = MESH_HEADER.size
+        table = json.loads(data[offset:offset + table_size].decode('utf-8'))
+        offset += table_size
+        # Recompile when any of the sources changed after compilation
+        mtime = os.path.getmtime(compiled_filename)
+        sources = [self.filename] + [os.path.join(self.path, _)
+                                     for _ in table['mtllibs']]
+        if any(os.path.getmtime(_) > mtime for _ in sources):
+            raise ValueError("{} is out of date".format(compiled_filename))
+
+        self.mtllibs = table['mtllibs']
+        materials = []
+        for attrs in table['materials']:
+            material = Material(attrs.pop('name'))
+            texture_name = attrs.pop('texture')
+            for key, value in attrs.items():
+                setattr(material, key, value)
+            if texture_name:
+                material.texture_name = texture_name
+                if self.load_textures:
+                    self.load_texture(material, texture_name)
+            self.materials[material.name] = material
+            materials.append(material)
+        for name in table['meshes']:
+            mesh = Mesh(name)
+            if name:
+                self.meshes[name] = mesh
+            self.mesh_list.append(mesh)
+
+        for _ in range(group_count):
+            mesh_index, material_index, count = \
+                MESH_GROUP.unpack_from(data, offset)
+            offset += MESH_GROUP.size
+            if material_index < 0:
+                material = Material("<unknown>")
+            else:
+                material = materials[material_index]
+            group = MaterialGroup(material)
+            buffers = []
+            for size in (2, 3, 3):
+                float_array = gl.GLfloat * (count * size)
+                buffers.append(float_array.from_buffer(data, offset))
+                offset += ctypes.sizeof(float_array)
+            group.array = tuple(buffers)
+            group.tex_coords, group.normals, group.vertices = group.array
+            self.mesh_list[mesh_index].groups.append(group)
+        # Keep the mapping alive as long as the buffers point into it
+        self._mmap = data
+        self._map_tex_coords()
+
+    def _map_tex_coords(self):
+        """Rewrite the UVs of the groups whose texture is on an atlas page,
+        once.
+        """
+        for mesh in self.mesh_list:
+            for group in mesh.groups:
+                transform = getattr(group.material, 'uv_transform', None)
+                if transform is None or group.raw_tex_coords is not None:
+                    continue
+                su, ou, sv, ov = transform
+                group.raw_tex_coords = group.tex_coords
+                if numpy is not None:
+                    uvs = numpy.array(group.tex_coords, dtype=numpy.float64)
+                    uvs[0::2] = uvs[0::2] * su + ou
+                    uvs[1::2] = uvs[1::2] * sv + ov
+                else:
+                    uvs = list(group.tex_coords)
+                    uvs[0::2] = [u * su + ou for u in uvs[0::2]]
+                    uvs[1::2] = [v * sv + ov for v in uvs[1::2]]
+                if group.array is not None:
+                    uvs = (gl.GLfloat * len(uvs))(*uvs)
+                    group.array = (uvs,) + group.array[1:]
+                group.tex_coords = uvs
+
+    def compile(self, compiled_filename=None):
+        """Write this object to a binary .mesh file for fast loading."""
+        if compiled_filename is None:
+            compiled_filename = get_compiled_path(self.filename)
+        materials = sorted(set(group.material for mesh in self.mesh_list
+                               for group in mesh.groups),
+                           key=lambda m: m.name)
+        table = {
+            'mtllibs': self.mtllibs,
+            'meshes': [mesh.name for mesh in self.mesh_list],
+            'materials': [{
+                'name': m.name,
+                'diffuse': list(m.diffuse),
+                'ambient': list(m.ambient),
+                'specular': list(m.specular),
+                'emission': list(m.emission),
+                'shininess': m.shininess,
+                'opacity': m.opacity,
+                'texture': getattr(m, 'texture_name', None),
+            } for m in materials if m.name in self.materials],
+        }
+        names = [_['name'] for _ in table['materials']]
+        table = json.dumps(table).encode('utf-8')
+        table += b' ' * (-len(table) % 4)  # keep the floats aligned
+        groups = [(i, group) for i, mesh in enumerate(self.mesh_list)
+                  for group in mesh.groups]
+        with open(compiled_filename, 'wb') as outfile:
+            outfile.write(MESH_HEADER.pack(MESH_MAGIC, len(table),
+                                           len(groups)))
+            outfile.write(table)
+            for mesh_index, group in groups:
+                if group.material.name in names:
+                    material_index = names.index(group.material.name)
+                else:
+                    material_index = -1
+                outfile.write(MESH_GROUP.pack(
+                    mesh_index, material_index, len(group.vertices) // 3))
+                tex_coords = group.tex_coords
+                if group.raw_tex_coords is not None:
+                    tex_coords = group.raw_tex_coords
+                for values in (tex_coords, group.normals, group.vertices):
+                    outfile.write(_tobytes(array('f', values)))
+        return compiled_filename
 
     def load_identity(self):
         """Discard any transformation"""
@@ -199,34 +559,85 @@ class OBJ(object):
         self.transforms.scale(x, y, z)
         self.normalize = True
 
+    def transformed(self, group):
+        """Return the group's vertices and normals with the model
+        transformations applied, as flat sequences.
+        """
+        if self.vectorized:
+            return self._transformed_arrays(group)
+        vertices = []
+        normals = []
+        for index in xrange(0, len(group.vertices), 3):
+            tv = self.transforms * euclid.Point3(
+                group.vertices[index],
+                group.vertices[index+1],
+                group.vertices[index+2]
+            )
+            vertices.extend(tv[:])
+            tn = self.transforms * euclid.Point3(group.normals[index],
+                                                 group.normals[index+1],
+                                                 group.normals[index+2]
+                                                 )
+            if self.normalize:
+                tn = tn.normalized()
+            normals.extend(tn[:])
+        return vertices, normals
+
+    def _transformed_arrays(self, group):
+        """The same as the euclid path, but over the whole group at once. The
+        arithmetic is done in the same order, so the results are identical.
+        """
+        m = self.transforms
+
+        def transform(data):
+            x, y, z = numpy.asarray(
+                data, dtype=numpy.float64).reshape(-1, 3).T
+            return (m.a * x + m.b * y + m.c * z + m.d,
+                    m.e * x + m.f * y + m.g * z + m.h,
+                    m.i * x + m.j * y + m.k * z + m.l)
+
+        vertices = numpy.column_stack(transform(group.vertices)).ravel()
+        x, y, z = transform(group.normals)
+        if self.normalize:
+            d = numpy.sqrt(x ** 2 + y ** 2 + z ** 2)
+            d[d == 0] = 1.
+            x, y, z = x / d, y / d, z / d
+        normals = numpy.column_stack((x, y, z)).ravel()
+        return vertices, normals
+
     def add_to(self, specified_batch):
-        """Add the meshes to a batch applying model transformations"""
+        """Add the meshes to a batch applying model transformations. Returns
+        the created vertex lists, so the caller can free them later.
+        """
+        vertex_lists = []
+        identity = self.transforms[:] == euclid.Matrix4()[:]
         for mesh in self.mesh_list:
             for group in mesh.groups:
-                vertices = []
-                normals = []
-                for index in xrange(0, len(group.vertices), 3):
-                    tv = self.transforms * euclid.Point3(
-                        group.vertices[index],
-                        group.vertices[index+1],
-                        group.vertices[index+2]
-                    )
-                    vertices.extend(tv[:])
-                    tn = self.transforms * euclid.Point3(group.normals[index],
-                                                         group.normals[index+1],
-                                                         group.normals[index+2]
-                                                         )
-                    if self.normalize:
-                        tn = tn.normalized()
-                    normals.extend(tn[:])
-
-                specified_batch.add(len(vertices)//3,
-                                    gl.GL_TRIANGLES,
-                                    group.material,
-                                    ('v3f/static', tuple(vertices)),
-                                    ('n3f/static', tuple(normals)),
-                                    ('t2f/static', tuple(group.tex_coords)),
-                                    )
+                if group.array is not None and identity:
+                    tex_coords, normals, vertices = group.array
+                    vertex_lists.append(add_arrays(
+                        specified_batch, group.material, len(vertices) // 3,
+                        vertices, normals, tex_coords))
+                    continue
+                vertices, normals = self.transformed(group)
+                if self.vectorized:
+                    vertices, normals, tex_coords = [
+                        numpy.ascontiguousarray(_, dtype=numpy.float32)
+                        for _ in (vertices, normals, group.tex_coords)]
+                    vertex_lists.append(add_arrays(
+                        specified_batch, group.material, len(vertices) // 3,
+                        vertices.ctypes.data, normals.ctypes.data,
+                        tex_coords.ctypes.data))
+                    continue
+                vertex_lists.append(specified_batch.add(
+                    len(vertices)//3,
+                    gl.GL_TRIANGLES,
+                    group.material,
+                    ('v3f/static', tuple(vertices)),
+                    ('n3f/static', tuple(normals)),
+                    ('t2f/static', tuple(group.tex_coords)),
+                ))
+        return vertex_lists
 
     def open_material_file(self, filename):
         """Override for loading from archive/network etc."""
@@ -264,24 +675,118 @@ class OBJ(object):
                 elif values[0] == 'd':
                     material.opacity = float(values[1])
                 elif values[0] == 'map_Kd':
-                    try:
-                        tpath = "resources/textures/{}".format(values[1])
-                        if self.texture_path:
-                            tpath = "{}{}".format(self.texture_path, values[1])
-                        material.texture = pyglet.resource.image(tpath).texture
-                    except BaseException as ex:
-                        print('Could not load texture {}: {}'.format(
-                            values[1], ex))
+                    material.texture_name = values[1]
+                    if self.load_textures:
+                        self.load_texture(material, values[1])
             except BaseException as ex:
                 print('Parse error in {}. {}'.format(filename, ex))
 
+    def get_texture_file(self, name):
+        """The path of a texture named in a material library."""
+        if self.texture_path:
+            return "{}{}".format(self.texture_path, name)
+        return "resources/textures/{}".format(name)
+
+    def get_texture_source(self, name):
+        """The file a texture is loaded from (its atlas page, if it's in
+        one), and where in the page it is (or None).
+        """
+        tpath = self.get_texture_file(name)
+        found = atlas.lookup(tpath)
+        if found is None:
+            return tpath, None
+        return found[0], found[1:]
+
+    def load_texture(self, material, name):
+        try:
+            tpath, region = self.get_texture_source(name)
+            texture = TEXTURES.get(tpath)
+            if texture is None:
+                texture = TEXTURES[tpath] = pyglet.resource.image(
+                    tpath).texture
+            material.texture = texture
+            if region is not None:
+                material.uv_transform = atlas.uv_transform(texture, *region)
+        except BaseException as ex:
+            print('Could not load texture {}: {}'.format(name, ex))
+
+    def load_missing_textures(self):
+        """Load the textures skipped because of `load_textures=False`."""
+        for material in self.materials.values():
+            name = getattr(material, 'texture_name', None)
+            if name and material.texture is None:
+                self.load_texture(material, name)
+        self._map_tex_coords()
+
+
+def find_models(root='skins'):
+    """Find every .obj file in a `models` directory of the skins."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        if 'models' not in dirpath.split(os.sep):
+            continue
+        for filename in sorted(filenames):
+            if filename.endswith('.obj'):
+                yield os.path.join(dirpath, filename)
+
+
+def compile_models(filenames):
+    for filename in filenames:
+        obj = OBJ(filename, load_textures=False)
+        print('Compiled {}'.format(obj.compile()))
+
+
+def benchmark_models(filenames, repeat=10):
+    """Time the list and the NumPy loaders against each other, and check
+    that they produce the same float buffers.
+    """
+    import time
+    if numpy is None:
+        print("NumPy is not installed; nothing to compare against.")
+        return
+
+    def as_floats(values):
+        return numpy.asarray(values, dtype=numpy.float32).tobytes()
+
+    for filename in filenames:
+        timings = []
+        buffers = []
+        for vectorized in (False, True):
+            start = time.time()
+            for _ in range(repeat):
+                obj = OBJ(filename, load_textures=False,
+                          vectorized=vectorized)
+            parse_time = (time.time() - start) / repeat
+            obj.translate(1, 2, 3)
+            obj.rotate(30, 0, 0, 1)
+            obj.scale(.8, .8, .8)
+            groups = [g for mesh in obj.mesh_list for g in mesh.groups]
+            start = time.time()
+            for _ in range(repeat):
+                transformed = [obj.transformed(g) for g in groups]
+            transform_time = (time.time() - start) / repeat
+            timings.append((parse_time, transform_time))
+            buffers.append([as_floats(_) for g, (v, n) in
+                            zip(groups, transformed)
+                            for _ in (v, n, g.tex_coords)])
+        (list_parse, list_transform), (array_parse, array_transform) = timings
+        print('{}: parse {:.2f}ms -> {:.2f}ms, transform {:.2f}ms -> {:.2f}ms'
+              ', {}'.format(filename, list_parse * 1000, array_parse * 1000,
+                            list_transform * 1000, array_transform * 1000,
+                            'identical' if buffers[0] == buffers[1]
+                            else 'MISMATCH'))
+
 
 if __name__ == "__main__":
     import sys
-    import ctypes
 
-    if len(sys.argv) != 2:
+    if sys.argv[1:2] == ['compile']:
+        compile_models(sys.argv[2:] or find_models())
+    elif sys.argv[1:2] == ['bench']:
+        benchmark_models(sys.argv[2:] or find_models())
+    elif len(sys.argv) != 2:
         print("Usage: {} file.obj".format(sys.argv[0]))
+        print("       {} compile [file.obj ...]".format(sys.argv[0]))
+        print("       {} bench [file.obj ...]".format(sys.argv[0]))
     else:
         window = pyglet.window.Window()
         fourfv = ctypes.c_float * 4
@@ -309,7 +814,6 @@ if __name__ == "__main__":
             gl.glRotatef(rot, 1, 0, 0)
             gl.glRotatef(rot/2, 0, 1, 0)
             batch.draw()
-            gl.glFinish()
 
         rot = 0
 
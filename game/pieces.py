@@ -1,21 +1,23 @@
-import json
-from math import copysign
 from random import randint
+import ctypes
 import weakref
 import math
 
 from euclid import Vector3
 from pyglet import gl
 from pyglet.graphics import Batch
-from game.obj_batch import OBJ
+from game.assets import MODELS
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-import game
 
-
-def roundvec(v, n=2):
-    return Vector3(round(v.x, n), round(v.y, n), round(v.z, n))
 X_AXIS = Vector3(1, 0, 0)
 Z_AXIS = Vector3(0, 0, 1)
+STATE_ATTRIBUTES = {'kind', 'command_count', 'speed', 'rotation_angle',
+                    'rotation_offset', 'moved', 'rotated', 'can_rotate',
+                    'remaining_move', 'angle', 'old_direction'}
 
 
 class PieceList(list):
@@ -26,20 +28,31 @@ class PieceList(list):
         * can_rotate
         * rotated
         * command
+
+    The list of all the pieces on the board (filled by `load_from_game`)
+    takes its candidates from the indices of the rules game, so filtering it
+    only looks at the pieces of one player, or fewer. Filtered sublists
+    are plain lists of pieces and are scanned.
     """
+    def __init__(self, pieces=()):
+        super(PieceList, self).__init__(pieces)
+        self.game = None
+        self.players = []
+        self._by_state = {}
+
     def filter(self, player=None, moved=None, can_rotate=None, rotated=None,
                command=None):
         """Filter this list by the specified attributes, then return another
-        PieceList.
+        PieceList. Nothing is changed on the pieces.
         """
         sublist = self
+        if player is not None and self.game is not None:
+            sublist = [self._by_state[_] for _ in self._candidates(
+                self.players.index(player), moved, rotated, command)]
+            player = None
         if player is not None:
             sublist = [_ for _ in sublist if _.player is player]
         if moved is not None:
-            # If it has no speed, it can't be moved
-            for _ in sublist:
-                if _.speed == 0:
-                    _.moved = True  # TODO: maybe better as a property?
             sublist = [_ for _ in sublist if _.moved == moved]
         if can_rotate is not None:
             if can_rotate:
@@ -56,64 +69,93 @@ class PieceList(list):
 
         return PieceList(sublist)
 
+    def _candidates(self, player, moved, rotated, command):
+        """The smallest index of the game that covers the filter."""
+        if moved is False:
+            return self.game.unmoved(player)
+        if rotated:
+            return self.game.rotated(player)
+        if command:
+            return self.game.commanders(player)
+        return self.game.pieces_of(player)
+
     def clear(self):
         del self[:]
+        self._by_state.clear()
 
     def limit(self, n):
         return self[:n]
 
     def load_from_file(self, board, filename, players):
-        path = 'resources/' + filename + '.board'
-        with open(path, 'r') as infile:
-            data = json.load(infile)
-        for piece in data:
-            P = getattr(game.pieces, piece['class'])
-            player = players[piece['player']]
-            x, y = piece['position']
-            direction = Vector3(1, 0, 0)
-            direction = direction.rotate_around(
-                Z_AXIS, piece['rotation'] * math.pi / 180)
-            self.append(P(board, player, x, y, direction))
+        """Load the game state from the `.board` file, then add a renderable
+        piece for each piece of the game.
+        """
+        board.game.load_file(filename)
+        self.load_from_game(board, players)
+
+    def load_from_game(self, board, players):
+        """Add a renderable piece for each piece of the board's game."""
+        self.clear()
+        self.game = board.game
+        self.players = players
+        for state in board.game.pieces:
+            piece = Piece(board, players[state.player], state)
+            self._by_state[state] = piece
+            self.append(piece)
+
+    def piece_for(self, state):
+        """The piece that renders the state of a rules piece, if any."""
+        return self._by_state.get(state)
+
+    def remove_state(self, state):
+        """Remove the piece that renders the state of a rules piece."""
+        piece = self._by_state.pop(state, None)
+        if piece is not None:
+            self.remove(piece)
 
 
 class Piece(object):
+    """Renders a piece of the game. The state itself (and the rules that
+    change it) lives in a `game.rules.Piece`.
+    """
     # TODO: Different piece color per player (duh)
-    command_count = 0  # number of pieces this can command
-    speed = 0  # number of movement squares
-    rotation_angle = 360  # rotations must be a multiple of this number
-    rotation_offset = 0  # number of degress offset it starts at
-    # piece state
-    moved = False  # TODO: this probably is no longer necessary
     # rendering
+    skin = 'default'
     _model = None
 
-    def __init__(self, board, player, x, y, direction):
+    def __init__(self, board, player, state):
         self.board = weakref.proxy(board)
         self.player = player  # TODO: weakref?
-        # place the piece on the board
-        self.position = Vector3(x - 3.5, y - 3.5, 0)
-        # load the model
-        # TODO: Cached loading
-        model_filename = 'skins/pieces/default/models/player{}/{}.obj'.format(
-            self.player.player_index, self.__class__.__name__)
-        self._obj = OBJ(model_filename,
-                        texture_path='skins/pieces/default/textures/')
-        self.batch = Batch()
-        self._obj.add_to(self.batch)
-        # set the rotation
-        self.direction = direction
-        self.old_direction = self.direction
-        # TODO: is angle necessary anymore?
-        self.angle = (self.direction.angle(X_AXIS)*180/math.pi -
-                      self.rotation_offset)
-        # generate a color key
+        self.state = state
+        # load the model (shared between all identical pieces)
+        self._model = MODELS.get(self.skin, self.player.player_index,
+                                 state.kind)
+        # generate a color key for the GPU picker
         # TODO: Ensure this *never* collides (it definitely has a chance)
         self.color_key = (randint(1, 254) / 255.,
                           randint(1, 254) / 255.,
                           randint(1, 254) / 255.)
         self._color_key_processed = [int(round(_*255)) for _ in self.color_key]
-        # set remaining_move to speed
-        self.remaining_move = self.speed
+
+    def __getattr__(self, name):
+        # kind, speed, moved, rotated, remaining_move, etc. come from the state
+        if name in STATE_ATTRIBUTES:
+            return getattr(self.state, name)
+        raise AttributeError(name)
+
+    @property
+    def position(self):
+        # Adjust because board center is (0, 0)
+        return Vector3(self.state.x - (self.board.width - 1) / 2.,
+                       self.state.y - (self.board.height - 1) / 2., 0)
+
+    @property
+    def direction(self):
+        return X_AXIS.rotate_around(Z_AXIS, self.state.direction * math.pi / 4)
+
+    @property
+    def batch(self):
+        return self._model.batch
 
     def draw(self, scale=1):
         gl.glPushMatrix()
@@ -142,93 +184,179 @@ class Piece(object):
         gl.glEnable(gl.GL_LIGHTING)
         gl.glEnable(gl.GL_TEXTURE_2D)
 
-    @property
-    def rotated(self):
-        return roundvec(self.direction) != roundvec(self.old_direction)
-
     def rotate(self):
-        self.direction = self.direction.rotate_around(
-            Z_AXIS, self.rotation_angle * math.pi / 180)
-        self.angle += self.rotation_angle
+        self.board.game.rotate(self.state)
 
     def reset(self):
-        self.moved = False
-        self.remaining_move = self.speed
-        self.old_direction = self.direction
+        self.board.game.reset_piece(self.state)
 
     def move(self):
-        # This is always an *attempted* move, so it's marked such.
-        self.moved = True
-        # Decrement the recursion counter or exit
-        if self.remaining_move:
-            self.remaining_move -= 1
-        else:
-            return
-        # Make the vector have all 1s, 0s, and -1s.
-        v = roundvec(self.direction, 0)
-        # Check out of bounds
-        target = self.position + v  # Only move one square at a time
-        # Adjust because board center is (0, 0)
-        w, h = self.board.width / 2, self.board.height / 2
-        if abs(target.x) > w or abs(target.y) > h:
-            return
-        # Check the board for pieces existing at the target
-        for p in self.board.pieces[:]:
-            if p.position == target:
-                engaged = roundvec(p.direction) == roundvec(-self.direction)
-                can_capture = not engaged or p.rotation_angle == 360
-                if p.player != self.player and can_capture:
-                    self.board.pieces.remove(p)
-                else:
-                    return
-        # All's clear! Move.
-        self.position = target
-        # Recurse
-        self.move()
+        self.board.game.move(self.state)
 
-    @property
-    def square_center(self):
+    def bounds(self, scale=1):
+        """An axis-aligned box that holds the piece in any rotation."""
+        r = self._model.radius * scale
         x, y = self.position.x, self.position.y
-        return int(x) + copysign(.5, x), int(y) + copysign(.5, y)
+        return (Vector3(x - r, y - r, self._model.bottom * scale),
+                Vector3(x + r, y + r, self._model.top * scale))
 
     def matches_color(self, color):
         return self._color_key_processed == color
 
 
-###############################################################################
-# Specific Piece Subclasses
-###############################################################################
-class B0(Piece):
-    command_count = 1
-
-
-class O1(Piece):
-    speed = 1
-    rotation_angle = 90
-
-
-class O2(Piece):
-    speed = 2
-    rotation_angle = 90
-
-
-class D1(Piece):
-    speed = 1
-    rotation_angle = 90
-    rotation_offset = 45
-
+class PieceChunk(object):
+    """The pieces on a square of the board, `PieceBatch.chunk` squares on
+    a side, in a batch of their own.
+    """
+    def __init__(self):
+        self.batch = Batch()
+        self.pieces = set()
+        self._bounds = None
+
+    def bounds(self, scale):
+        """A box around every piece in the chunk."""
+        if self._bounds is None:
+            boxes = [_.bounds(scale) for _ in self.pieces]
+            self._bounds = (
+                Vector3(min(_[0].x for _ in boxes),
+                        min(_[0].y for _ in boxes),
+                        min(_[0].z for _ in boxes)),
+                Vector3(max(_[1].x for _ in boxes),
+                        max(_[1].y for _ in boxes),
+                        max(_[1].z for _ in boxes)))
+        return self._bounds
+
+    def invalidate(self):
+        self._bounds = None
+
+
+class PieceBatch(object):
+    """Draws all the pieces from a few batches, with every piece's vertices
+    transformed ahead of time instead of by the modelview matrix. Vertex
+    lists are grouped by material, so a batch takes one draw per material
+    (identical textures count as one, and so do the textures on one atlas
+    page; see `game.atlas`). A piece's vertices are only rewritten when it
+    moves or rotates.
+
+    There's a batch per chunk of the board, so the chunks that are off the
+    screen can be skipped; the default board fits in one.
+    """
+    chunk = 16  # squares on a side
 
-class D2(Piece):
-    speed = 2
-    rotation_angle = 90
-    rotation_offset = 45
+    def __init__(self, scale=1):
+        self.scale = scale
+        self.chunks = {}
+        self._chunk_of = {}
+        self._vertex_lists = {}
+        self._geometry = {}
 
+    def __len__(self):
+        return len(self._vertex_lists)
 
-class A1(Piece):
-    speed = 1
-    rotation_angle = 45
+    def __contains__(self, piece):
+        return piece in self._vertex_lists
 
+    def geometry(self, model):
+        """The (material, vertices, normals, tex_coords) of every group of
+        the model, converted once to whatever `update` works with.
+        """
+        if model not in self._geometry:
+            groups = []
+            for mesh in model.obj.mesh_list:
+                for group in mesh.groups:
+                    data = [group.vertices, group.normals, group.tex_coords]
+                    if numpy is not None:
+                        data = [numpy.asarray(_, dtype=numpy.float64)
+                                for _ in data]
+                        data[0] = data[0].reshape(-1, 3)
+                        data[1] = data[1].reshape(-1, 3)
+                    else:
+                        data = [list(_) for _ in data]
+                    groups.append([group.material] + data)
+            self._geometry[model] = groups
+        return self._geometry[model]
+
+    def chunk_key(self, piece):
+        x, y = piece.state.square
+        return x // self.chunk, y // self.chunk
+
+    def add(self, piece):
+        key = self.chunk_key(piece)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = PieceChunk()
+        chunk.pieces.add(piece)
+        self._chunk_of[piece] = key
+        vertex_lists = []
+        for material, vertices, normals, tex_coords in self.geometry(
+                piece._model):
+            count = len(tex_coords) // 2
+            vertex_list = chunk.batch.add(count, gl.GL_TRIANGLES, material,
+                                          'v3f/dynamic', 'n3f/dynamic',
+                                          't2f/static')
+            vertex_list.tex_coords[:] = [float(_) for _ in tex_coords]
+            vertex_lists.append(vertex_list)
+        self._vertex_lists[piece] = vertex_lists
+        self.update(piece)
+
+    def remove(self, piece):
+        for vertex_list in self._vertex_lists.pop(piece, ()):
+            vertex_list.delete()
+        key = self._chunk_of.pop(piece, None)
+        if key is not None:
+            chunk = self.chunks[key]
+            chunk.pieces.discard(piece)
+            chunk.invalidate()
+            if not chunk.pieces:
+                del self.chunks[key]
 
-class A2(Piece):
-    speed = 2
-    rotation_angle = 45
\ No newline at end of file
+    def clear(self):
+        for piece in list(self._vertex_lists):
+            self.remove(piece)
+
+    def update(self, piece):
+        """Rewrite the vertices of a piece after it moved or rotated."""
+        if self.chunk_key(piece) != self._chunk_of[piece]:
+            # moved to another chunk
+            self.remove(piece)
+            self.add(piece)
+            return
+        self.chunks[self._chunk_of[piece]].invalidate()
+        angle = math.radians(piece.angle)
+        c, s = math.cos(angle), math.sin(angle)
+        k = self.scale
+        x, y, z = piece.position
+        groups = self.geometry(piece._model)
+        for vertex_list, (_, vertices, normals, _) in zip(
+                self._vertex_lists[piece], groups):
+            if numpy is not None:
+                # same as glTranslate, glRotate (about z) and glScale
+                out = numpy.empty_like(vertices)
+                out[:, 0] = k * (vertices[:, 0] * c - vertices[:, 1] * s) + x
+                out[:, 1] = k * (vertices[:, 0] * s + vertices[:, 1] * c) + y
+                out[:, 2] = k * vertices[:, 2] + z
+                out_normals = numpy.empty_like(normals)
+                out_normals[:, 0] = normals[:, 0] * c - normals[:, 1] * s
+                out_normals[:, 1] = normals[:, 0] * s + normals[:, 1] * c
+                out_normals[:, 2] = normals[:, 2]
+                for target, data in ((vertex_list.vertices, out),
+                                     (vertex_list.normals, out_normals)):
+                    data = numpy.ascontiguousarray(data, dtype=numpy.float32)
+                    ctypes.memmove(target, data.ctypes.data, data.nbytes)
+                continue
+            out, out_normals = [], []
+            for i in range(0, len(vertices), 3):
+                vx, vy, vz = vertices[i:i + 3]
+                out.extend((k * (vx * c - vy * s) + x,
+                            k * (vx * s + vy * c) + y, k * vz + z))
+                nx, ny, nz = normals[i:i + 3]
+                out_normals.extend((nx * c - ny * s, nx * s + ny * c, nz))
+            vertex_list.vertices[:] = out
+            vertex_list.normals[:] = out_normals
+
+    def draw(self, frustum=None):
+        """Draw the chunks that may be visible, or all of them."""
+        for chunk in self.chunks.values():
+            if frustum is None or frustum.intersects_box(
+                    *chunk.bounds(self.scale)):
+                chunk.batch.draw()
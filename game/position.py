@@ -0,0 +1,294 @@
+"""A compact representation of a game of Banneret for fast move generation
+and search. Where `game.rules.Game` keeps a list of piece objects, a Position
+keeps plain lists of small ints:
+
+    * `board` maps each square index (y * width + x) to a piece id, or EMPTY
+    * `squares` maps each piece id to its square index, or CAPTURED
+    * `codes` maps each piece id to its kind, player, direction and turn state
+      packed into the bits of a single int (see `pack`)
+
+Occupancy is a single list lookup, and copying a position is a handful of
+list copies. Changes can also be undone without copying: every change is
+journaled, so `undo(mark())` rolls back everything done since the mark.
+
+Every position also has a Zobrist `key`, updated incrementally, that is the
+same for positions which only differ in the ids of identical pieces.
+"""
+from __future__ import division, print_function
+from game.rules import PIECE_TYPES, Game, Piece, angle_to_direction
+
+EMPTY = -1
+CAPTURED = -1
+
+KINDS = ['B0', 'O1', 'O2', 'D1', 'D2', 'A1', 'A2']
+KIND_INDEX = {kind: i for i, kind in enumerate(KINDS)}
+SPEED = [PIECE_TYPES[_].speed for _ in KINDS]
+COMMAND = [PIECE_TYPES[_].command_count for _ in KINDS]
+ROTATION_STEP = [PIECE_TYPES[_].rotation_angle // 45 for _ in KINDS]
+
+# bit layout of a piece code
+KIND_SHIFT, KIND_MASK = 0, 0x7
+PLAYER_SHIFT, PLAYER_MASK = 3, 0x7
+DIRECTION_SHIFT, DIRECTION_MASK = 6, 0x7
+OLD_DIRECTION_SHIFT, OLD_DIRECTION_MASK = 9, 0x7
+REMAINING_SHIFT, REMAINING_MASK = 12, 0x7
+MOVED_FLAG = 1 << 15
+
+
+def pack(kind, player, direction, old_direction=None, remaining=None,
+         moved=False):
+    """Pack the state of a piece into an int. `kind` is an index into KINDS.
+    The old direction defaults to the direction and the remaining move to
+    the speed, as they are at the start of a turn.
+    """
+    if old_direction is None:
+        old_direction = direction
+    if remaining is None:
+        remaining = SPEED[kind]
+    return (kind << KIND_SHIFT | player << PLAYER_SHIFT |
+            direction << DIRECTION_SHIFT |
+            old_direction << OLD_DIRECTION_SHIFT |
+            remaining << REMAINING_SHIFT | (MOVED_FLAG if moved else 0))
+
+
+def kind_of(code):
+    return code >> KIND_SHIFT & KIND_MASK
+
+
+def player_of(code):
+    return code >> PLAYER_SHIFT & PLAYER_MASK
+
+
+def direction_of(code):
+    return code >> DIRECTION_SHIFT & DIRECTION_MASK
+
+
+def old_direction_of(code):
+    return code >> OLD_DIRECTION_SHIFT & OLD_DIRECTION_MASK
+
+
+def remaining_of(code):
+    return code >> REMAINING_SHIFT & REMAINING_MASK
+
+
+def is_moved(code):
+    # If it has no speed, it can't be moved
+    return bool(code & MOVED_FLAG) or SPEED[kind_of(code)] == 0
+
+
+def is_rotated(code):
+    return direction_of(code) != old_direction_of(code)
+
+
+def with_direction(code, direction):
+    return (code & ~(DIRECTION_MASK << DIRECTION_SHIFT) |
+            direction << DIRECTION_SHIFT)
+
+
+def with_remaining(code, remaining):
+    return (code & ~(REMAINING_MASK << REMAINING_SHIFT) |
+            remaining << REMAINING_SHIFT)
+
+
+MASK64 = (1 << 64) - 1
+
+
+def zobrist(value):
+    """A pseudo-random 64 bit key for an int (the splitmix64 finalizer), so
+    there are no key tables to size for large boards.
+    """
+    z = (value + 0x9E3779B97F4A7C15) & MASK64
+    z = ((z ^ z >> 30) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ z >> 27) * 0x94D049BB133111EB) & MASK64
+    return z ^ z >> 31
+
+
+def piece_key(square, code):
+    return zobrist(square << 16 | code)
+
+
+def turn_key(active_player, game_over):
+    return zobrist(-1 - (active_player << 1 | bool(game_over)))
+
+
+def reset_code(code):
+    """The code at the start of a new turn."""
+    return pack(kind_of(code), player_of(code), direction_of(code))
+
+
+class Position(object):
+    """See the module docstring. Besides the lists, a position keeps per
+    player counts of pieces, commands, unmoved and rotated pieces up to date,
+    so the turn phase and the rotation budget are O(1) to check.
+    """
+    def __init__(self, width=8, height=8, player_count=2):
+        self.width, self.height = width, height
+        self.player_count = player_count
+        self.board = [EMPTY] * (width * height)
+        self.squares = []
+        self.codes = []
+        self.active_player = 0
+        self.game_over = False
+        self.alive = [0] * player_count
+        self.commands = [0] * player_count
+        self.unmoved = [0] * player_count
+        self.rotated = [0] * player_count
+        self.key = turn_key(0, False)
+        self._journal = []
+
+    def copy(self):
+        other = Position.__new__(Position)
+        other.__dict__.update(self.__dict__)
+        for name in ('board', 'squares', 'codes', 'alive', 'commands',
+                     'unmoved', 'rotated'):
+            setattr(other, name, list(getattr(self, name)))
+        other._journal = []
+        return other
+
+    def __eq__(self, other):
+        return (isinstance(other, Position) and
+                (self.width, self.height, self.player_count, self.squares,
+                 self.codes, self.active_player, self.game_over) ==
+                (other.width, other.height, other.player_count,
+                 other.squares, other.codes, other.active_player,
+                 other.game_over))
+
+    def __ne__(self, other):
+        return not self == other
+
+    # squares
+    def index(self, x, y):
+        return y * self.width + x
+
+    def coordinates(self, square):
+        return square % self.width, square // self.width
+
+    def piece_at(self, x, y):
+        """The id of the piece on the square, or EMPTY."""
+        return self.board[y * self.width + x]
+
+    def pieces(self, player=None):
+        """Ids of the pieces still on the board."""
+        return [pid for pid, square in enumerate(self.squares)
+                if square != CAPTURED and
+                (player is None or player_of(self.codes[pid]) == player)]
+
+    # low level changes, which keep the counts and the journal up to date
+    def _count(self, pid, sign):
+        code = self.codes[pid]
+        player = player_of(code)
+        self.alive[player] += sign
+        self.commands[player] += sign * COMMAND[kind_of(code)]
+        if not is_moved(code):
+            self.unmoved[player] += sign
+        if is_rotated(code):
+            self.rotated[player] += sign
+
+    def _write(self, pid, square, code):
+        old_square = self.squares[pid]
+        if old_square != CAPTURED:
+            self._count(pid, -1)
+            self.key ^= piece_key(old_square, self.codes[pid])
+            if self.board[old_square] == pid:
+                self.board[old_square] = EMPTY
+        self.squares[pid] = square
+        self.codes[pid] = code
+        if square != CAPTURED:
+            self.board[square] = pid
+            self._count(pid, 1)
+            self.key ^= piece_key(square, code)
+
+    def _write_turn(self, active_player, game_over):
+        self.key ^= (turn_key(self.active_player, self.game_over) ^
+                     turn_key(active_player, game_over))
+        self.active_player = active_player
+        self.game_over = game_over
+
+    def set_piece(self, pid, square, code):
+        """Put a piece on a square (or CAPTURED) with a new code."""
+        self._journal.append((pid, self.squares[pid], self.codes[pid]))
+        self._write(pid, square, code)
+
+    def set_turn(self, active_player, game_over):
+        self._journal.append((None, self.active_player, self.game_over))
+        self._write_turn(active_player, game_over)
+
+    def add(self, kind, player, x, y, direction, **state):
+        """Add a new piece and return its id. This can't be undone."""
+        pid = len(self.codes)
+        self.squares.append(CAPTURED)
+        self.codes.append(0)
+        self._write(pid, self.index(x, y),
+                    pack(KIND_INDEX[kind], player, direction, **state))
+        return pid
+
+    def mark(self):
+        return len(self._journal)
+
+    def journal(self, mark):
+        """The changes made since `mark()` returned `mark`, oldest first: a
+        (piece id, old square, old code) for every piece changed and a
+        (None, old active player, old game over) for every turn change.
+        """
+        return self._journal[mark:]
+
+    def undo(self, mark):
+        """Roll back every change made since `mark()` returned `mark`."""
+        journal = self._journal
+        while len(journal) > mark:
+            pid, a, b = journal.pop()
+            if pid is None:
+                self._write_turn(a, b)
+            else:
+                self._write(pid, a, b)
+
+    # conversions
+    @classmethod
+    def from_records(cls, records, width=8, height=8, player_count=2):
+        """Build a starting position from the records of a `.board` file."""
+        position = cls(width, height, player_count)
+        for record in records:
+            x, y = record['position']
+            position.add(record['class'], record['player'], x, y,
+                         angle_to_direction(record['rotation']))
+        return position
+
+    def to_records(self):
+        records = []
+        for pid in self.pieces():
+            code = self.codes[pid]
+            x, y = self.coordinates(self.squares[pid])
+            records.append({'class': KINDS[kind_of(code)],
+                            'player': player_of(code),
+                            'position': [x, y],
+                            'rotation': direction_of(code) * 45})
+        return records
+
+    @classmethod
+    def from_game(cls, game):
+        """Convert a `game.rules.Game`, including the state of the turn. Piece
+        ids follow the order of `game.pieces`.
+        """
+        position = cls(game.width, game.height, game.player_count)
+        for piece in game.pieces:
+            position.add(piece.kind, piece.player, piece.x, piece.y,
+                         piece.direction, old_direction=piece.old_direction,
+                         remaining=piece.remaining_move,
+                         moved=piece._moved)
+        position._write_turn(game.active_player, game.game_over)
+        return position
+
+    def to_game(self):
+        game = Game(self.width, self.height, self.player_count)
+        for pid in self.pieces():
+            code = self.codes[pid]
+            x, y = self.coordinates(self.squares[pid])
+            piece = Piece(KINDS[kind_of(code)], player_of(code), x, y,
+                          direction_of(code))
+            piece.old_direction = old_direction_of(code)
+            piece.remaining_move = remaining_of(code)
+            piece.moved = bool(code & MOVED_FLAG)
+            game.add(piece)
+        game.active_player = self.active_player
+        game.game_over = self.game_over
+        return game
@@ -0,0 +1,262 @@
+"""Loads assets ahead of time without blocking the window.
+
+Parsing models and decoding images happens on a pool of worker threads.
+Anything that touches OpenGL (creating textures and vertex lists) has to
+happen on the main thread, so the finished work is queued and uploaded a
+little at a time, within a time budget per frame. Once an asset is
+uploaded, it's in the same caches the game loads from anyway
+(`game.assets.MODELS`, `game.assets.IMAGES`, `game.obj_batch.TEXTURES`),
+so nothing has to change for the game to use it.
+"""
+from __future__ import division, print_function
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import pyglet
+from game import atlas
+from game.assets import (MODELS, IMAGES, get_piece_model_path,
+                         get_piece_texture_path)
+from game.obj_batch import OBJ, TEXTURES
+from game.profiler import PROFILER
+from game.rules import PIECE_TYPES
+
+INTERFACE_TEXTURES = 'skins/interfaces/default/textures/'
+
+
+class Preloader(object):
+    """Loads models and images in the background. Call `start` from the main
+    thread; progress is reported to the `on_progress(done, total)` callbacks
+    after every uploaded asset, and `on_finish()` once everything is done.
+    """
+    budget = .004  # seconds of uploading per frame
+    workers = 4
+
+    def __init__(self):
+        self.objs = []
+        self.models = []
+        self.images = []
+        self.done = 0
+        self.total = 0
+        self.started = False
+        self.finished = False
+        self.on_progress = []
+        self.on_finish = []
+        self._ready = queue.Queue()
+        # every texture is decoded by the first worker to need it, and
+        # uploaded along with its model; models sharing it wait for that
+        self._claimed = set()
+        self._failed = set()
+        self._waiting = []
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def add_obj(self, filename, texture_path, callback):
+        """Load any model; `callback(obj)` gets it once it's uploaded."""
+        self.objs.append((filename, texture_path, callback))
+
+    def add_model(self, skin, player_index, name):
+        self.models.append((skin, player_index, name))
+
+    def add_image(self, filename):
+        self.images.append(filename)
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        self.total = len(self.objs) + len(self.models) + len(self.images)
+        self._pool = ThreadPool(self.workers)
+        for item in self.objs:
+            self._pool.apply_async(self._load_obj, (item,),
+                                   callback=self._ready.put)
+        for key in self.models:
+            if key not in MODELS:
+                self._pool.apply_async(self._load_model, (key,),
+                                       callback=self._ready.put)
+            else:
+                self._ready.put(None)
+        for filename in self.images:
+            self._pool.apply_async(self._load_image, (filename,),
+                                   callback=self._ready.put)
+        self._pool.close()
+        pyglet.clock.schedule_interval(self.upload, 1 / 60.)
+
+    # worker threads
+    def _claim(self, filename):
+        """Whether the caller is the first to ask for the file."""
+        with self._lock:
+            if filename in self._claimed or filename in TEXTURES:
+                return False
+            self._claimed.add(filename)
+            return True
+
+    def _load_obj(self, item):
+        filename, texture_path, callback = item
+        try:
+            obj, textures, needed = self._read_obj(filename, texture_path)
+            return 'obj', callback, obj, textures, needed
+        except Exception as ex:
+            # nothing else loads it, so do it on the main thread instead
+            return 'error', filename, ex, lambda: callback(
+                OBJ.load(filename, texture_path=texture_path))
+
+    def _load_model(self, key):
+        try:
+            skin, player_index, name = key
+            obj, textures, needed = self._read_obj(
+                get_piece_model_path(skin, player_index, name),
+                get_piece_texture_path(skin))
+            return 'model', key, obj, textures, needed
+        except Exception as ex:
+            return 'error', key, ex
+
+    def _read_obj(self, filename, texture_path):
+        """Parse a model and decode the textures nobody else is loading.
+        Returns the model, the decoded images by file name (None for those
+        that failed) and the file names of all of its textures.
+        """
+        obj = OBJ.load(filename, texture_path=texture_path,
+                       load_textures=False)
+        textures = {}
+        needed = set()
+        for material in obj.materials.values():
+            name = getattr(material, 'texture_name', None)
+            if name:
+                filename, _ = obj.get_texture_source(name)
+                needed.add(filename)
+                if self._claim(filename):
+                    try:
+                        textures[filename] = pyglet.image.load(filename)
+                    except Exception as ex:
+                        print('Could not preload {}: {}'.format(filename,
+                                                                ex))
+                        textures[filename] = None
+        return obj, textures, needed
+
+    def _load_image(self, filename):
+        try:
+            return 'image', filename, pyglet.image.load(filename)
+        except Exception as ex:
+            return 'error', filename, ex
+
+    # main thread
+    def upload(self, dt=None):
+        """Upload finished work until the time budget runs out."""
+        end = time.time() + self.budget
+        with PROFILER.scope('assets.upload'):
+            while time.time() < end:
+                try:
+                    item = self._ready.get_nowait()
+                except queue.Empty:
+                    break
+                self._process(item)
+        if self.done >= self.total:
+            self.finish()
+
+    def _process(self, item):
+        """Upload an item, and whatever was waiting for its textures."""
+        if item is not None and not self._upload(item):
+            self._waiting.append(item)
+            return
+        self._count()
+        while True:
+            ready = [_ for _ in self._waiting if self._has_textures(_)]
+            if not ready:
+                break
+            for waiting in ready:
+                self._waiting.remove(waiting)
+                self._upload(waiting)
+                self._count()
+
+    def _count(self):
+        self.done += 1
+        for callback in self.on_progress:
+            callback(self.done, self.total)
+
+    def _has_textures(self, item):
+        return all(_ in TEXTURES or _ in self._failed for _ in item[4])
+
+    def _upload(self, item):
+        """Returns False, without doing anything else, for models whose
+        textures another worker has yet to hand in.
+        """
+        if item[0] == 'error':
+            # it will be loaded (or fail again) when it's first used
+            print('Could not preload {}: {}'.format(item[1], item[2]))
+            if len(item) > 3:
+                item[3]()
+            return True
+        if item[0] == 'image':
+            _, filename, image = item
+            image.get_texture()
+            IMAGES.setdefault(filename, image)
+            return True
+        kind, key, obj, textures, needed = item
+        for filename, image in list(textures.items()):
+            if image is None:
+                self._failed.add(filename)
+            elif filename not in TEXTURES:
+                # the same as what pyglet.resource.image does for big images
+                TEXTURES[filename] = image.get_texture(True)
+        textures.clear()  # in case it has to wait
+        if not self._has_textures(item):
+            return False
+        obj.load_missing_textures()
+        if kind == 'obj':
+            key(obj)  # the callback
+        else:
+            MODELS.put(*(key + (obj,)))
+        return True
+
+    def finish(self):
+        """Upload everything that's left right away."""
+        pyglet.clock.unschedule(self.upload)
+        if self._pool is not None:
+            self._pool.join()
+            self._pool = None
+        # every worker handed its work in when the pool was joined
+        while True:
+            try:
+                item = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            self._process(item)
+        while self._waiting:
+            # nothing else is coming, so load what's missing right here
+            item = self._waiting.pop(0)
+            self._failed.update(item[4])
+            self._process(item)
+        if not self.finished:
+            self.finished = True
+            for callback in self.on_finish:
+                callback()
+
+
+def preload_game_assets(skin='default', player_indices=(1, 2), board=None,
+                        start=True):
+    """Start loading what `PlayGameState` needs: the models of every piece
+    and the interface images, and the model of the board if it has none
+    yet.
+    """
+    preloader = Preloader()
+    if board is not None and board.model is None:
+        preloader.add_obj(board.model_path, board.texture_path,
+                          board.set_model)
+    for player_index in player_indices:
+        for name in sorted(PIECE_TYPES):
+            preloader.add_model(skin, player_index, name)
+    images = set()
+    for name in atlas.find_textures(INTERFACE_TEXTURES):
+        # images in an atlas are regions of its page
+        found = atlas.lookup(INTERFACE_TEXTURES + name)
+        images.add(found[0] if found else INTERFACE_TEXTURES + name)
+    for filename in sorted(images):
+        preloader.add_image(filename)
+    if start:
+        preloader.start()
+    return preloader
@@ -0,0 +1,251 @@
+"""Per-frame timings of the hot paths of the game.
+
+Code to measure is wrapped in named scopes:
+
+    with PROFILER.scope('board.draw'):
+        ...
+
+or decorated with `@profiled('board.draw')`. Every frame (see `frame`) the
+time spent in each scope since the previous frame is added to a rolling
+window, along with the number of GL calls and texture binds, and how many
+more memory blocks are allocated than before (where Python can tell; the
+blocks a frame allocates and frees again don't show).
+`stats()` gives the percentiles over that window, and with tracing on every
+scope is also recorded for `export_chrome_trace` (load the file in
+chrome://tracing).
+
+While the profiler is disabled (the default), scopes cost one attribute
+lookup and a function call.
+"""
+from __future__ import division, print_function
+from collections import deque, defaultdict
+import ctypes
+import functools
+import json
+import sys
+import time
+
+FRAME = 'frame'
+COUNTERS = ('gl calls', 'texture binds', 'net allocated blocks')
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, p):
+    """The nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0.
+    index = max(0, min(len(values) - 1,
+                       int(round(p / 100. * len(values) + .5)) - 1))
+    return values[index]
+
+
+def allocated_blocks():
+    """The number of memory blocks allocated right now, or None where Python
+    doesn't tell (before 3.4).
+    """
+    if hasattr(sys, 'getallocatedblocks'):
+        return sys.getallocatedblocks()
+    return None
+
+
+class _NullScope(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SCOPE = _NullScope()
+
+
+class _Scope(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.time())
+        return False
+
+
+class Profiler(object):
+    """Collects scope timings and per-frame counters. See the module
+    docstring.
+    """
+    def __init__(self, window=300, max_trace_events=200000):
+        self.enabled = False
+        self.tracing = False
+        self.window = window
+        self.history = defaultdict(lambda: deque(maxlen=self.window))
+        self.trace = deque(maxlen=max_trace_events)
+        self.frame_count = 0
+        self.gl_calls = 0
+        self.gl_call_counts = defaultdict(int)
+        self._totals = defaultdict(float)
+        self._gl_wrapped = False
+        self._blocks = None
+        self._binds = 0
+        self._epoch = time.time()
+
+    def enable(self, tracing=False, count_gl=True):
+        self.enabled = True
+        self.tracing = tracing
+        self._blocks = allocated_blocks()
+        if count_gl:
+            self.count_gl_calls()
+
+    def disable(self):
+        self.enabled = False
+        self.tracing = False
+
+    def reset(self):
+        self.history.clear()
+        self.trace.clear()
+        self.frame_count = 0
+        self.gl_calls = 0
+        self.gl_call_counts.clear()
+        self._binds = 0
+        self._totals.clear()
+
+    # recording
+    def scope(self, name):
+        if not self.enabled:
+            return NULL_SCOPE
+        return _Scope(self, name)
+
+    def record(self, name, start, end):
+        self._totals[name] += end - start
+        if self.tracing:
+            self.trace.append((name, start, end))
+
+    def frame(self):
+        """A scope around drawing a frame. Closing it files everything
+        recorded since the previous frame under this frame.
+        """
+        if not self.enabled:
+            return NULL_SCOPE
+        return _FrameScope(self)
+
+    def end_frame(self):
+        self.frame_count += 1
+        for name, total in self._totals.items():
+            self.history[name].append(total)
+        # scopes that didn't run this frame took no time
+        for name in self.history:
+            if name not in self._totals and name not in COUNTERS:
+                self.history[name].append(0.)
+        self._totals.clear()
+        self.history['gl calls'].append(self.gl_calls)
+        binds = self.gl_call_counts['glBindTexture']
+        self.history['texture binds'].append(binds - self._binds)
+        self._binds = binds
+        blocks = allocated_blocks()
+        if blocks is not None:
+            self.history['net allocated blocks'].append(blocks - self._blocks)
+            self._blocks = blocks
+        if self.tracing:
+            counters = {name: self.history[name][-1] for name in COUNTERS
+                        if self.history.get(name)}
+            self.trace.append(('counters', time.time(), counters))
+        self.gl_calls = 0
+
+    # GL call counting
+    def count_gl_calls(self):
+        """Count every call through `pyglet.gl`, by chaining a counter in
+        front of the `errcheck` of each ctypes function. This works whether
+        or not pyglet's GL debugging is on.
+        """
+        if self._gl_wrapped:
+            return
+        from pyglet import gl
+        seen = set()
+        for name in dir(gl):
+            function = getattr(gl, name)
+            if (not isinstance(function, ctypes._CFuncPtr) or
+                    id(function) in seen):
+                continue
+            seen.add(id(function))
+            function.errcheck = self._counter(name, function.errcheck)
+        self._gl_wrapped = True
+
+    def _counter(self, name, previous):
+        counts = self.gl_call_counts
+
+        def errcheck(result, function, arguments):
+            if self.enabled:
+                self.gl_calls += 1
+                counts[name] += 1
+            if previous is not None:
+                return previous(result, function, arguments)
+            return result
+        return errcheck
+
+    # reporting
+    def stats(self):
+        """{name: {'p50': ..., 'p95': ..., 'p99': ...}} over the rolling
+        window. Scope times are in milliseconds, counters are counts.
+        """
+        result = {}
+        for name, values in self.history.items():
+            values = sorted(values)
+            scale = 1 if name in COUNTERS else 1000.
+            result[name] = {'p{}'.format(p): percentile(values, p) * scale
+                            for p in PERCENTILES}
+        return result
+
+    def summary(self):
+        """The stats as lines of text, slowest scopes first."""
+        stats = self.stats()
+        scopes = sorted((_ for _ in stats if _ not in COUNTERS),
+                        key=lambda _: -stats[_]['p95'])
+        lines = ['{:<20} {:>7} {:>7} {:>7}'.format('ms', 'p50', 'p95', 'p99')]
+        for name in scopes + [_ for _ in COUNTERS if _ in stats]:
+            lines.append('{:<20} {:>7.2f} {:>7.2f} {:>7.2f}'.format(
+                name, *[stats[name]['p{}'.format(p)] for p in PERCENTILES]))
+        return lines
+
+    def export_chrome_trace(self, filename):
+        """Write the recorded scopes in the Chrome trace event format."""
+        events = []
+        for name, start, end in self.trace:
+            if name == 'counters':
+                events.append({'name': name, 'ph': 'C', 'pid': 0, 'tid': 0,
+                               'ts': (start - self._epoch) * 1e6,
+                               'args': end})
+                continue
+            events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                           'ts': (start - self._epoch) * 1e6,
+                           'dur': (end - start) * 1e6})
+        with open(filename, 'w') as outfile:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                      outfile)
+        return len(events)
+
+
+class _FrameScope(_Scope):
+    def __init__(self, profiler):
+        super(_FrameScope, self).__init__(profiler, FRAME)
+
+    def __exit__(self, *exc_info):
+        super(_FrameScope, self).__exit__(*exc_info)
+        self.profiler.end_frame()
+        return False
+
+
+PROFILER = Profiler()
+
+
+def profiled(name):
+    """Decorate a function to time every call in the named scope."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with PROFILER.scope(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
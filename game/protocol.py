@@ -0,0 +1,260 @@
+"""The binary encoding of the game state messages of `game.network`: a full
+snapshot when joining (or resyncing), then one small delta per action.
+
+Both decode to the same messages as their JSON versions, so the client
+doesn't care which one the server sent. Everything is little-endian:
+
+    frame     0x00, payload length (uint32), payload
+    snapshot  'S', version, seq (uint32), width, height (uint16),
+              players, active player, game over (uint8),
+              piece count (uint16), pieces, checksum (uint32)
+    piece     kind, player (uint8), x, y (uint16), bits (uint8): direction
+              | old direction << 3 | moved << 6; captured pieces are kind
+              255 and zeros
+    delta     'D', seq (uint32), checksum (uint32), event count (uint16),
+              events
+    events    move: 1, piece (uint16), x, y (uint16), direction (uint8)
+              rotate: 2, piece (uint16), direction (uint8)
+              capture: 3, piece (uint16)
+              pass turn: 4, next player (uint8)
+              game over: 5
+
+A JSON message never starts with a zero byte, so both kinds can share a
+connection. The checksum is a CRC-32 of the state after the action (see
+`checksum`); a client whose copy comes out different asks for a resync.
+
+    python -m game.protocol [games]     # bytes per turn against JSON
+"""
+from __future__ import division, print_function
+import json
+import struct
+import zlib
+
+from game.rules import (PIECE_TYPES, MOVE, ROTATE, CAPTURE, PASS_TURN,
+                        GAME_OVER)
+
+VERSION = 1
+FRAME = b'\x00'
+KINDS = sorted(PIECE_TYPES)
+KIND_IDS = {kind: i for i, kind in enumerate(KINDS)}
+CAPTURED = 255
+BINARY_TYPES = ('snapshot', 'delta')
+
+_FRAME = struct.Struct('<I')
+_SNAPSHOT = struct.Struct('<cBIHHBBBH')
+_STATE = struct.Struct('<BB')
+_PIECE_FORMAT = 'BBHHB'
+_PIECE = struct.Struct('<' + _PIECE_FORMAT)
+_EMPTY_PIECE = _PIECE.pack(CAPTURED, 0, 0, 0, 0)
+_CHECKSUM = struct.Struct('<I')
+_DELTA = struct.Struct('<cIIH')
+_EVENTS = {
+    MOVE: (1, struct.Struct('<BHHHB')),
+    ROTATE: (2, struct.Struct('<BHB')),
+    CAPTURE: (3, struct.Struct('<BH')),
+    PASS_TURN: (4, struct.Struct('<BB')),
+    GAME_OVER: (5, struct.Struct('<B')),
+}
+_EVENT_KINDS = {code: (kind, format_) for kind, (code, format_)
+                in _EVENTS.items()}
+
+
+def pack_pieces(records):
+    """The pieces of a snapshot (see `game.network.snapshot`) as bytes."""
+    pack = _PIECE.pack
+    return b''.join(
+        _EMPTY_PIECE if record is None else
+        pack(KIND_IDS[record[0]], record[1], record[2], record[3],
+             record[4] | record[5] << 3 | bool(record[6]) << 6)
+        for record in records)
+
+
+def unpack_pieces(data, count, offset=0):
+    # one call for all the pieces is much faster than one per piece
+    values = struct.unpack_from('<' + _PIECE_FORMAT * count, data, offset)
+    records = []
+    for i in range(0, len(values), 5):
+        kind, player, x, y, bits = values[i:i + 5]
+        if kind == CAPTURED:
+            records.append(None)
+        elif kind < len(KINDS):
+            records.append([KINDS[kind], player, x, y, bits & 7,
+                            bits >> 3 & 7, bool(bits >> 6 & 1)])
+        else:
+            raise ValueError("Unknown piece kind {}".format(kind))
+    return records
+
+
+def checksum(state, pieces=None):
+    """A CRC-32 of everything that decides how the game goes on: whose turn
+    it is, whether it's over, and the pieces. `pieces` are the packed
+    pieces of the snapshot `state`, if they're at hand already.
+    """
+    if pieces is None:
+        pieces = pack_pieces(state['pieces'])
+    crc = zlib.crc32(_STATE.pack(state['active_player'],
+                                 state['game_over']))
+    return zlib.crc32(pieces, crc) & 0xffffffff
+
+
+# messages
+def encode_snapshot(seq, state):
+    pieces = pack_pieces(state['pieces'])
+    return b''.join((
+        _SNAPSHOT.pack(b'S', VERSION, seq, state['width'], state['height'],
+                       state['players'], state['active_player'],
+                       state['game_over'], len(state['pieces'])),
+        pieces,
+        _CHECKSUM.pack(checksum(state, pieces))))
+
+
+def decode_snapshot(payload):
+    """A snapshot message. Raises ValueError if the payload is damaged; the
+    checksum is checked before anything is unpacked, so damaged pieces
+    can't get any further.
+    """
+    (_, version, seq, width, height, players, active_player, game_over,
+     count) = _SNAPSHOT.unpack_from(payload)
+    if version != VERSION:
+        raise ValueError("Unknown snapshot version {}".format(version))
+    end = _SNAPSHOT.size + count * _PIECE.size
+    state = {'width': width, 'height': height, 'players': players,
+             'active_player': active_player, 'game_over': bool(game_over)}
+    try:
+        expected = _CHECKSUM.unpack_from(payload, end)[0]
+    except struct.error:
+        raise ValueError("The snapshot is cut off")
+    if checksum(state, payload[_SNAPSHOT.size:end]) != expected:
+        raise ValueError("The snapshot is corrupt")
+    state['pieces'] = unpack_pieces(payload, count, _SNAPSHOT.size)
+    return {'type': 'snapshot', 'seq': seq, 'snapshot': state}
+
+
+def encode_delta(seq, crc, events):
+    data = [_DELTA.pack(b'D', seq, crc, len(events))]
+    for event in events:
+        code, format_ = _EVENTS[event[0]]
+        data.append(format_.pack(code, *event[1:]))
+    return b''.join(data)
+
+
+def decode_delta(payload):
+    _, seq, crc, count = _DELTA.unpack_from(payload)
+    offset = _DELTA.size
+    events = []
+    for _ in range(count):
+        kind, format_ = _EVENT_KINDS[ord(payload[offset:offset + 1])]
+        event = list(format_.unpack_from(payload, offset))
+        event[0] = kind
+        events.append(event)
+        offset += format_.size
+    return {'type': 'delta', 'seq': seq, 'crc': crc, 'events': events}
+
+
+def encode_message(message):
+    """A snapshot or delta message, framed."""
+    if message['type'] == 'snapshot':
+        payload = encode_snapshot(message['seq'], message['snapshot'])
+    else:
+        payload = encode_delta(message['seq'], message['crc'],
+                               message['events'])
+    return FRAME + _FRAME.pack(len(payload)) + payload
+
+
+def decode_message(payload):
+    """The message in the payload of a frame. Raises ValueError if it's
+    damaged.
+    """
+    try:
+        kind = payload[:1]
+        if kind == b'S':
+            return decode_snapshot(payload)
+        elif kind == b'D':
+            return decode_delta(payload)
+    except (struct.error, KeyError, IndexError, TypeError) as ex:
+        raise ValueError("Bad binary message: {}".format(ex))
+    raise ValueError("Unknown binary message {!r}".format(kind))
+
+
+def decode_frame(frame):
+    return decode_message(frame[1 + _FRAME.size:])
+
+
+def split_messages(data, max_size=1 << 24):
+    """Split received bytes into whole lines of JSON and whole frames.
+    Returns them, and the rest that is still incomplete.
+    """
+    messages = []
+    start = 0
+    while start < len(data):
+        if data[start:start + 1] == FRAME:
+            if len(data) < start + 1 + _FRAME.size:
+                break
+            length = _FRAME.unpack_from(data, start + 1)[0]
+            if length > max_size:
+                raise ValueError("A frame of {} bytes is too big".format(
+                    length))
+            end = start + 1 + _FRAME.size + length
+            if len(data) < end:
+                break
+            messages.append(data[start:end])
+            start = end
+        else:
+            end = data.find(b'\n', start)
+            if end < 0:
+                break
+            messages.append(data[start:end + 1])
+            start = end + 1
+    return messages, data[start:]
+
+
+# comparison with JSON
+def turn_sizes(games=20, seed=0, board='default'):
+    """Play random games on the server's matches, and add up the bytes of
+    every delta in JSON and in binary, and of the starting position as a
+    `.board` file, a JSON snapshot and a binary one.
+    """
+    import random
+    from game.network import Match, encode
+    from game.rules import read_board_file
+    rng = random.Random(seed)
+    records, width, height = read_board_file(board)
+    sizes = {'deltas': 0, 'json': 0, 'binary': 0}
+    for _ in range(games):
+        match = Match('bench', records, width, height)
+        match.seats = [True] * len(match.seats)
+        if not sizes.get('board'):
+            snapshot = {'type': 'snapshot', 'seq': 0,
+                        'snapshot': match.snapshot()}
+            sizes['board'] = len(json.dumps(records))
+            sizes['snapshot_json'] = len(encode(snapshot))
+            sizes['snapshot_binary'] = len(encode_message(snapshot))
+        while not match.game.game_over and match.seq < 2000:
+            game = match.game
+            player = game.active_player
+            clickable = [pid for pid, piece in enumerate(match.pieces)
+                         if not piece.captured and piece.player == player and
+                         (game.can_move(piece) or game.can_rotate(piece))]
+            if clickable and (game.phase == 'move' or rng.random() < .5):
+                message = {'action': 'click',
+                           'piece': rng.choice(clickable)}
+            else:
+                message = {'action': 'pass'}
+            delta = match.act(player, message)
+            sizes['deltas'] += 1
+            sizes['json'] += len(encode(delta))
+            sizes['binary'] += len(encode_message(delta))
+    return sizes
+
+
+if __name__ == "__main__":
+    import sys
+
+    sizes = turn_sizes(*[int(_) for _ in sys.argv[1:2]])
+    print('starting position: .board {} B, JSON snapshot {} B, binary '
+          'snapshot {} B'.format(sizes['board'], sizes['snapshot_json'],
+                                 sizes['snapshot_binary']))
+    print('{} actions: JSON {:.1f} B/action, binary {:.1f} B/action '
+          '({:.0%})'.format(sizes['deltas'], sizes['json'] / sizes['deltas'],
+                            sizes['binary'] / sizes['deltas'],
+                            sizes['binary'] / sizes['json']))
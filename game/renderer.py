@@ -1,19 +1,34 @@
 from __future__ import print_function
 from weakref import proxy, WeakSet
+import math
 import pyglet
 import sys
+import time
 from pyglet import gl
 from euclid import Vector3
 from game import interface
+from game.profiler import PROFILER, profiled
 
 
 ###############################################################################
 # Pyglet Window subclass
 ###############################################################################
-from game.interface import clean_value
+
+# Events that (may) change what's on the screen. Others, like mouse motion,
+# have to call `invalidate` themselves when they change anything.
+INVALIDATING_EVENTS = {'on_mouse_press', 'on_mouse_release', 'on_mouse_drag',
+                       'on_mouse_scroll', 'on_key_press', 'on_text',
+                       'on_resize', 'on_expose', 'on_show', 'on_activate'}
 
 
 class GameWindow3d(pyglet.window.Window):
+    """The game window. By default it only redraws when something marked it
+    invalid (see `invalidate`), instead of for every event; the `continuous`
+    flag redraws 60 times per second regardless.
+    """
+    continuous = 'continuous' in sys.argv
+    show_timings = 'timings' in sys.argv
+
     class Mouse(object):
         x, y = 0, 0
 
@@ -21,12 +36,47 @@ class GameWindow3d(pyglet.window.Window):
         up = Vector3(0, 0, 1)
         looking_at = Vector3(0, 0, 0)
         position = Vector3(1, 0, 0)
+        fov = 60.  # vertical field of view in degrees
+        near, far = .1, 1000.
 
         def look(self):
             gl.glLoadIdentity()
             data = list(self.position) + list(self.looking_at) + list(self.up)
             gl.gluLookAt(*data)
 
+        def basis(self):
+            """The forward, right and up unit vectors of the view."""
+            forward = (self.looking_at - self.position).normalized()
+            right = forward.cross(self.up).normalized()
+            return forward, right, right.cross(forward)
+
+        def ray(self, x, y, width, height):
+            """Unproject a window coordinate into a world space ray. Returns
+            the origin and the (normalized) direction.
+            """
+            forward, right, up = self.basis()
+            scale = math.tan(math.radians(self.fov) / 2)
+            dx = (2. * x / width - 1) * scale * width / float(height)
+            dy = (2. * y / height - 1) * scale
+            direction = (forward + right * dx + up * dy).normalized()
+            return self.position, direction
+
+        def frustum(self, width, height):
+            """What the camera sees in a window of the given size."""
+            forward, right, up = self.basis()
+            half_height = math.tan(math.radians(self.fov) / 2)
+            half_width = half_height * width / float(height)
+            # every side plane goes through the camera, facing inward
+            normals = [(right + forward * half_width).normalized(),
+                       (-right + forward * half_width).normalized(),
+                       (up + forward * half_height).normalized(),
+                       (-up + forward * half_height).normalized()]
+            planes = [(n, -n.dot(self.position)) for n in normals]
+            planes.append((forward, -forward.dot(self.position) -
+                           self.near))
+            planes.append((-forward, forward.dot(self.position) + self.far))
+            return Frustum(planes)
+
     def __init__(self, StartingGameStateClass, *args, **kwargs):
         # update kwargs
         kwargs['config'] = gl.Config(
@@ -48,33 +98,67 @@ class GameWindow3d(pyglet.window.Window):
             pyglet.clock.schedule_interval(
                 lambda dt: print(pyglet.clock.get_fps()), 1)
 
+        if self.continuous:
+            pyglet.clock.schedule_interval(lambda dt: None, 1 / 60.)
+        self.timings_overlay = None
+        if self.show_timings:
+            self.timings_overlay = TimingsOverlay(self)
+
+        # the views of every interface file, shared by the game states
+        self.interface_views = {}
+        # when the first frame was drawn (see `on_first_frame`)
+        self.first_frame_time = None
+
         # set the starting game state
         self.gamestate = StartingGameStateClass(self)
 
+    def invalidate(self):
+        """Redraw the window when the event loop gets to it."""
+        self.invalid = True
+
+    def dispatch_event(self, event_type, *args):
+        if event_type in INVALIDATING_EVENTS:
+            self.invalid = True
+        return super(GameWindow3d, self).dispatch_event(event_type, *args)
+
     def set_state(self, NewStateClass, *args, **kwargs):
         # TODO: this will handle the animation triggers, callbacks, etc.
         # clean up old handlers (so they don't stay in memory)
         [w.cleanup() for w in self.gamestate.views]
+        self.gamestate.cleanup()
         self.remove_handlers(self.gamestate)
         self.gamestate = NewStateClass(self, *args, **kwargs)
+        self.invalidate()
 
     def on_draw(self):
-        self.clear()
-        self.enable_3d()
-        self.gamestate.draw_3d()
-        self.enable_2d()
-        self.gamestate.draw_2d()
-        gl.glFinish()
+        with PROFILER.frame():
+            self.clear()
+            self.enable_3d()
+            with PROFILER.scope('draw_3d'):
+                self.gamestate.draw_3d()
+            self.enable_2d()
+            with PROFILER.scope('draw_2d'):
+                self.gamestate.draw_2d()
+            if self.timings_overlay is not None:
+                self.timings_overlay.draw()
+        # Scheduled functions redraw all windows anyway, but events only do
+        # so when the window is invalid.
+        self.invalid = False
+        if self.first_frame_time is None:
+            self.first_frame_time = time.time()
+            self.dispatch_event('on_first_frame')
 
     def on_mouse_motion(self, x, y, dx, dy):
         # TODO: I think this is redundant
         self.mouse.x, self.mouse.y = x, y
 
+    @profiled('enable_3d')
     def enable_3d(self):
         gl.glViewport(0, 0, self.width, self.height)
         gl.glMatrixMode(gl.GL_PROJECTION)
         gl.glLoadIdentity()
-        gl.gluPerspective(60., self.width / float(self.height), .1, 1000.)
+        gl.gluPerspective(self.camera.fov, self.width / float(self.height),
+                          self.camera.near, self.camera.far)
         gl.glMatrixMode(gl.GL_MODELVIEW)
         gl.glDepthFunc(gl.GL_LEQUAL)
         gl.glEnable(gl.GL_DEPTH_TEST)
@@ -99,6 +183,32 @@ class GameWindow3d(pyglet.window.Window):
         gl.glDisable(gl.GL_LIGHTING)
 
 
+# Dispatched once, right after the first frame was drawn
+GameWindow3d.register_event_type('on_first_frame')
+
+
+class TimingsOverlay(object):
+    """Shows the frame timings of the profiler (see `game.profiler`) in the
+    top left corner of the window.
+    """
+    interval = .5  # seconds between updates of the text
+
+    def __init__(self, window):
+        self.window = proxy(window)
+        self.label = pyglet.text.Label('', font_name='Courier New',
+                                       font_size=10, multiline=True,
+                                       width=400, anchor_y='top')
+        self._updated = 0
+
+    def draw(self):
+        now = time.time()
+        if now - self._updated > self.interval:
+            self.label.text = '\n'.join(PROFILER.summary())
+            self._updated = now
+        self.label.x, self.label.y = 10, self.window.height - 10
+        self.label.draw()
+
+
 class WeakViewSet(WeakSet):
     def __getattr__(self, item):
         for i in self:
@@ -113,41 +223,33 @@ class BaseGameState(object):
         self.window = proxy(window)
         self.window.push_handlers(self)
         self.views = WeakViewSet()
+        self.layouts = []
         self.camera_look_at = Vector3(0, 0, 0)
 
     def load_interface(self, filename):
-        # TODO: refactor this to be not... stupid. Probably should invoke
-        # TODO: some parser helper functions contained in interface.py
-        filename = 'skins/interfaces/default/{}'.format(filename)
-        with open(filename, 'r') as infile:
-            data = infile.readlines()
-
-        ViewClass = None
-        view_attrs = {}
-
-        for line in [_ for _ in data if _.strip() and not _.startswith('#')]:
-            # if we're indented, it's an attribute.
-            if line.startswith('    ') or line.startswith('\t'):
-                key, value = [_.strip() for _ in line.split(':')]
-                if key in ['x', 'y', 'w', 'h']:
-                    value = clean_value(value, self.window)
-                    view_attrs[key] = eval(value)
-                elif key in ['text', 'image', 'id']:
-                    view_attrs[key] = value
-                else:
-                    raise AttributeError(
-                        "Invalid key `{}` specified for interface element."
-                        "".format(key))
-            # if not indented, it's a view declaration
-            else:
-                if ViewClass is not None:
-                    # push the old view to the rendering queue
-                    self.views.add(ViewClass(window=self.window, **view_attrs))
-                # set up for the next
-                ViewClass = getattr(interface, line.strip())
-        if ViewClass is not None:
-            # push the final view to the rendering queue
-            self.views.add(ViewClass(window=self.window, **view_attrs))
+        """Show the views of an interface file. They're made the first time
+        and reused by every state that shows the same file after that.
+        """
+        layout = interface.load_layout(
+            'skins/interfaces/default/{}'.format(filename))
+        views = self.window.interface_views.get(layout.filename)
+        if views is None:
+            views = layout.create(self.window)
+            self.window.interface_views[layout.filename] = views
+        else:
+            layout.reflow(views, self.window.width, self.window.height)
+        for view in views:
+            view.show()
+            self.views.add(view)
+        self.layouts.append((layout, views))
+
+    def on_resize(self, width, height):
+        for layout, views in self.layouts:
+            layout.reflow(views, width, height)
+
+    def cleanup(self):
+        """Let go of anything outside the state that refers to it."""
+        pass
 
     def draw_3d(self):
         pass
@@ -169,23 +271,189 @@ def color_at_point(x, y):
     return list(a)
 
 
+class Frustum(object):
+    """The part of the world a camera sees, as planes `(normal, d)` with
+    `normal.dot(point) + d >= 0` on the inside. Tests are conservative:
+    boxes near a corner may pass without being visible.
+    """
+    def __init__(self, planes):
+        self.planes = planes
+
+    def intersects_box(self, low, high):
+        """Whether any of an axis-aligned box may be visible."""
+        for n, d in self.planes:
+            # the corner of the box furthest along the normal
+            if (n.x * (high.x if n.x >= 0 else low.x) +
+                    n.y * (high.y if n.y >= 0 else low.y) +
+                    n.z * (high.z if n.z >= 0 else low.z) + d < 0):
+                return False
+        return True
+
+
+def ray_box_intersection(origin, direction, low, high):
+    """Return the distance along the ray to an axis-aligned box, or None if
+    the ray misses it.
+    """
+    near, far = 0., float('inf')
+    for o, d, lo, hi in zip(origin, direction, low, high):
+        if abs(d) < 1e-9:
+            if not lo <= o <= hi:
+                return None
+            continue
+        t1, t2 = (lo - o) / d, (hi - o) / d
+        near, far = max(near, min(t1, t2)), min(far, max(t1, t2))
+        if near > far:
+            return None
+    return near
+
+
 ###############################################################################
 # Simple primitives for easy use
 ###############################################################################
-def draw_highlight(xy, color):
-    center = Vector3(xy[0], xy[1], 0.01)
-    gl.glDisable(gl.GL_TEXTURE_2D)
-    gl.glDisable(gl.GL_LIGHTING)
-    gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
-    gl.glEnable(gl.GL_BLEND)
-    gl.glColor4f(*color)
-    points = ('v3f', (
-        center.x + .5, center.y - .5, center.z,
-        center.x + .5, center.y + .5, center.z,
-        center.x - .5, center.y + .5, center.z,
-        center.x - .5, center.y - .5, center.z,
-    ))
-    v = pyglet.graphics.vertex_list(len(points[1]) / 3, points)
-    v.draw(gl.GL_QUADS)
-    gl.glEnable(gl.GL_LIGHTING)
-    gl.glEnable(gl.GL_TEXTURE_2D)
+def blend_colors(under, over):
+    """The color of `over` drawn on top of `under` with alpha blending, so
+    overlapping highlights look the same as when drawn one after the other.
+    """
+    if under is None:
+        return over
+    alpha = over[3] + under[3] * (1 - over[3])
+    if not alpha:
+        return 0., 0., 0., 0.
+    return tuple((o * over[3] + u * under[3] * (1 - over[3])) / alpha
+                 for o, u in zip(over[:3], under[:3])) + (alpha,)
+
+
+class HighlightLayer(object):
+    """Colored quads over the highlighted squares of a board. Squares are
+    (x, y) with (0, 0) in a corner, like in `game.rules`; the board is
+    centered on the origin. The quads are split into square chunks like
+    `TiledBoard`'s, but only chunks with highlights have a vertex list, and
+    only those whose highlights changed are rebuilt.
+    """
+    chunk = 16  # squares on a side
+
+    def __init__(self, width, height, z=0.01):
+        self.width, self.height, self.z = width, height, z
+        self.highlights = {}
+        # (first x, first y) of a chunk: (low corner, high corner, vertices)
+        self.chunks = {}
+
+    def chunk_of(self, square):
+        x, y = square
+        return x - x % self.chunk, y - y % self.chunk
+
+    def set(self, highlights):
+        """Show exactly the given {square: color} highlights."""
+        if highlights == self.highlights:
+            return
+        changed = set(
+            self.chunk_of(square)
+            for square in set(self.highlights) | set(highlights)
+            if self.highlights.get(square) != highlights.get(square))
+        self.highlights = dict(highlights)
+        lit = {}
+        for square, color in self.highlights.items():
+            key = self.chunk_of(square)
+            if key in changed:
+                lit.setdefault(key, []).append((square, color))
+        for key in changed:
+            old = self.chunks.pop(key, None)
+            if old is not None:
+                old[2].delete()
+            if key in lit:
+                self.chunks[key] = self.build_chunk(key, lit[key])
+
+    def build_chunk(self, key, squares):
+        """The (low corner, high corner, vertex list) of a chunk with the
+        given (square, color) highlights.
+        """
+        z = self.z
+        left, bottom = -self.width / 2., -self.height / 2.
+        vertices, colors = [], []
+        for (x, y), color in squares:
+            sx, sy = left + x, bottom + y
+            vertices.extend((sx + 1, sy, z, sx + 1, sy + 1, z,
+                             sx, sy + 1, z, sx, sy, z))
+            colors.extend(tuple(color) * 4)
+        x0, y0 = key
+        x1 = min(x0 + self.chunk, self.width)
+        y1 = min(y0 + self.chunk, self.height)
+        vertex_list = pyglet.graphics.vertex_list(
+            len(squares) * 4, ('v3f/static', vertices),
+            ('c4f/static', colors))
+        return (Vector3(left + x0, bottom + y0, z),
+                Vector3(left + x1, bottom + y1, z), vertex_list)
+
+    def draw(self, frustum=None):
+        """Draw the chunks with highlights that may be visible, or all of
+        them.
+        """
+        if not self.chunks:
+            return
+        gl.glDisable(gl.GL_TEXTURE_2D)
+        gl.glDisable(gl.GL_LIGHTING)
+        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+        gl.glEnable(gl.GL_BLEND)
+        for low, high, vertex_list in self.chunks.values():
+            if frustum is None or frustum.intersects_box(low, high):
+                vertex_list.draw(gl.GL_QUADS)
+        gl.glEnable(gl.GL_LIGHTING)
+        gl.glEnable(gl.GL_TEXTURE_2D)
+
+    def delete(self):
+        for _, __, vertex_list in self.chunks.values():
+            vertex_list.delete()
+        self.chunks = {}
+
+
+class TiledBoard(object):
+    """A checkered board of any size, for boards the skin has no model of.
+    It's centered on the origin like `HighlightLayer`, and split into
+    square chunks, so only the chunks in view are drawn.
+    """
+    chunk = 16  # squares on a side
+    colors = ((.76, .6, .42), (.4, .26, .13))
+    border = (.25, .16, .08)
+
+    def __init__(self, width, height, z=0.):
+        self.width, self.height = width, height
+        self.chunks = []
+        left, bottom = -width / 2., -height / 2.
+        for y0 in range(0, height, self.chunk):
+            for x0 in range(0, width, self.chunk):
+                x1 = min(x0 + self.chunk, width)
+                y1 = min(y0 + self.chunk, height)
+                vertices, colors = [], []
+                for y in range(y0, y1):
+                    for x in range(x0, x1):
+                        sx, sy = left + x, bottom + y
+                        vertices.extend((sx + 1, sy, z, sx + 1, sy + 1, z,
+                                         sx, sy + 1, z, sx, sy, z))
+                        colors.extend(self.colors[(x + y) % 2] * 4)
+                vertex_list = pyglet.graphics.vertex_list(
+                    len(vertices) // 3, ('v3f/static', vertices),
+                    ('c3f/static', colors))
+                self.chunks.append((Vector3(left + x0, bottom + y0, z),
+                                    Vector3(left + x1, bottom + y1, z),
+                                    vertex_list))
+        # a frame around the squares, just under them
+        r, t, b = -left + .5, -bottom + .5, z - .01
+        self.frame = pyglet.graphics.vertex_list(
+            4, ('v3f/static', (r, -t, b, r, t, b, -r, t, b, -r, -t, b)),
+            ('c3f/static', self.border * 4))
+
+    def draw(self, frustum=None):
+        """Draw the chunks that may be visible, or all of them."""
+        gl.glDisable(gl.GL_TEXTURE_2D)
+        gl.glDisable(gl.GL_LIGHTING)
+        self.frame.draw(gl.GL_QUADS)
+        for low, high, vertex_list in self.chunks:
+            if frustum is None or frustum.intersects_box(low, high):
+                vertex_list.draw(gl.GL_QUADS)
+        gl.glEnable(gl.GL_LIGHTING)
+        gl.glEnable(gl.GL_TEXTURE_2D)
+
+    def delete(self):
+        self.frame.delete()
+        for _, __, vertex_list in self.chunks:
+            vertex_list.delete()
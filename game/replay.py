@@ -0,0 +1,290 @@
+"""Replays: every action of a game, appended to a file as it's played, with
+a keyframe (a snapshot of the whole game) every so often, so any point of
+the game can be shown by loading one snapshot and playing a few actions.
+
+    python -m game.replay info FILE       # what's in a replay
+    python -m game.replay verify FILE...  # replay, checking every keyframe
+    python -m game.replay bench FILE      # fast-forward and seek speed
+
+The file starts with `BNRP`, a version and a JSON header (the board, the
+seed and whatever else the recorder knows), then one record per action:
+
+    click     'c', piece (uint16)
+    pass      'p'
+    keyframe  'k', seconds since the start (double), length (uint32),
+              a snapshot in the format of `game.protocol`, whose sequence
+              number is the count of actions before it
+
+Pieces are numbered by their order in the first keyframe, like in
+`game.network`. Nothing is ever rewritten, so a game that crashed can
+still be replayed up to its last complete record.
+
+Playing a replay applies the rules again, instead of trusting the
+keyframes, so `verify` finds every replay whose game the rules would now
+play differently.
+"""
+from __future__ import division, print_function
+import bisect
+import json
+import struct
+import time
+
+from game.network import snapshot, game_from_snapshot
+from game.protocol import checksum, encode_snapshot, decode_snapshot
+
+MAGIC = b'BNRP'
+VERSION = 1
+KEYFRAME_INTERVAL = 64  # actions
+EXTENSION = '.replay'
+
+_HEADER = struct.Struct('<4sBI')
+_CLICK = struct.Struct('<cH')
+_KEYFRAME = struct.Struct('<cdI')
+
+
+class ReplayError(Exception):
+    """The replay is damaged, or the rules don't play it the same way."""
+    pass
+
+
+def play_action(game, pieces, action, pid=None):
+    """Play a recorded action ('click' or 'pass') on a game. Raises
+    ReplayError if the rules don't allow it.
+    """
+    if action == 'click':
+        piece = pieces[pid] if 0 <= pid < len(pieces) else None
+        if piece is None or piece.captured or not game.click(piece):
+            raise ReplayError("Piece {} can't be clicked".format(pid))
+    elif action == 'pass':
+        if game.game_over:
+            raise ReplayError("The game is over")
+        game.pass_turn()
+    else:
+        raise ReplayError("Unknown action `{}`".format(action))
+    game.check_victory()
+
+
+class ReplayWriter(object):
+    """Records the actions of a game to a file as they happen. It plays them
+    on a copy of the game of its own, to take keyframes from.
+    """
+    def __init__(self, filename, game, keyframe_interval=KEYFRAME_INTERVAL,
+                 **header):
+        self.filename = filename
+        self.keyframe_interval = keyframe_interval
+        # the pieces of the recorded game by number
+        self.ids = {piece: pid for pid, piece in enumerate(game.pieces)}
+        self.game, self.pieces = game_from_snapshot(
+            snapshot(game, game.pieces))
+        self.actions = 0
+        self.start = time.time()
+        header.setdefault('width', game.width)
+        header.setdefault('height', game.height)
+        header.setdefault('players', game.player_count)
+        header.setdefault('started', self.start)
+        data = json.dumps(header, sort_keys=True).encode('utf-8')
+        self._file = open(filename, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION, len(data)) + data)
+        self.keyframe()
+
+    def click(self, piece):
+        """Record a click on a piece of the recorded game."""
+        self.record('click', self.ids[piece])
+
+    def pass_turn(self):
+        self.record('pass')
+
+    def record(self, action, pid=None):
+        play_action(self.game, self.pieces, action, pid)
+        if action == 'click':
+            self._file.write(_CLICK.pack(b'c', pid))
+        else:
+            self._file.write(b'p')
+        self.actions += 1
+        if self.actions % self.keyframe_interval == 0:
+            self.keyframe()
+        self._file.flush()
+
+    def keyframe(self):
+        data = encode_snapshot(self.actions, snapshot(self.game,
+                                                      self.pieces))
+        self._file.write(_KEYFRAME.pack(b'k', time.time() - self.start,
+                                        len(data)) + data)
+        self._file.flush()
+
+    def close(self):
+        """End the replay with a keyframe of the final state."""
+        if self._file.closed:
+            return
+        if self.actions % self.keyframe_interval:
+            self.keyframe()
+        self._file.close()
+
+
+class Replay(object):
+    """A recorded game. `actions` are ('click', piece) and ('pass', None)
+    pairs; `turns` are the indices of the actions that start a turn.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as infile:
+            data = infile.read()
+        try:
+            magic, version, length = _HEADER.unpack_from(data)
+        except struct.error:
+            raise ReplayError("{} is not a replay".format(filename))
+        if magic != MAGIC:
+            raise ReplayError("{} is not a replay".format(filename))
+        if version != VERSION:
+            raise ReplayError("Unknown replay version {}".format(version))
+        offset = _HEADER.size + length
+        try:
+            self.header = json.loads(
+                data[_HEADER.size:offset].decode('utf-8'))
+        except ValueError as ex:
+            raise ReplayError("{} has a damaged header: {}".format(filename,
+                                                                  ex))
+        self.actions = []
+        self.turns = [0]
+        self.keyframes = []  # (action index, seconds, snapshot payload)
+        self.complete = self._read_records(data, offset)
+        if not self.keyframes or self.keyframes[0][0] != 0:
+            raise ReplayError("{} has no starting position".format(filename))
+        self._keyframe_indices = [_[0] for _ in self.keyframes]
+
+    def _read_records(self, data, offset):
+        """Read records up to the end, or up to a record cut off by a crash.
+        Returns whether the whole file was read.
+        """
+        while offset < len(data):
+            kind = data[offset:offset + 1]
+            if kind == b'c':
+                if offset + _CLICK.size > len(data):
+                    return False
+                self.actions.append(
+                    ('click', _CLICK.unpack_from(data, offset)[1]))
+                offset += _CLICK.size
+            elif kind == b'p':
+                self.actions.append(('pass', None))
+                self.turns.append(len(self.actions))
+                offset += 1
+            elif kind == b'k':
+                if offset + _KEYFRAME.size > len(data):
+                    return False
+                _, seconds, length = _KEYFRAME.unpack_from(data, offset)
+                start = offset + _KEYFRAME.size
+                if start + length > len(data):
+                    return False
+                self.keyframes.append((len(self.actions), seconds,
+                                       data[start:start + length]))
+                offset = start + length
+            else:
+                raise ReplayError("Bad record at byte {}".format(offset))
+        return True
+
+    def __len__(self):
+        return len(self.actions)
+
+    @property
+    def duration(self):
+        """Seconds from the start to the last keyframe."""
+        return self.keyframes[-1][1]
+
+    def keyframe(self, i):
+        """The game and pieces of the `i`th keyframe, and its checksum."""
+        index, _, payload = self.keyframes[i]
+        try:
+            state = decode_snapshot(payload)['snapshot']
+            # the checksum doesn't cover the size of the board or the players
+            game, pieces = game_from_snapshot(state)
+        except (struct.error, ValueError, IndexError, KeyError) as ex:
+            raise ReplayError("Keyframe at action {} is damaged: {}".format(
+                index, ex))
+        return game, pieces, checksum(state)
+
+    def seek(self, index):
+        """The game after the first `index` actions: from the last keyframe
+        before it, and at most a keyframe interval of actions.
+        """
+        if not 0 <= index <= len(self.actions):
+            raise IndexError("The replay has {} actions".format(
+                len(self.actions)))
+        i = bisect.bisect_right(self._keyframe_indices, index) - 1
+        game, pieces, _ = self.keyframe(i)
+        for action, pid in self.actions[self.keyframes[i][0]:index]:
+            play_action(game, pieces, action, pid)
+        return game, pieces
+
+    def seek_turn(self, turn):
+        """The game at the start of a turn (0 is the first)."""
+        return self.seek(self.turns[turn])
+
+    def play(self, verify=True):
+        """Fast-forward through the whole game from the start, and return
+        the game at the end. With `verify`, the game must match every
+        keyframe on the way.
+        """
+        game, pieces, _ = self.keyframe(0)
+        frames = iter(enumerate(self.keyframes[1:], 1) if verify else ())
+        frame = next(frames, None)
+        for index, (action, pid) in enumerate(self.actions, 1):
+            try:
+                play_action(game, pieces, action, pid)
+            except ReplayError as ex:
+                raise ReplayError("Action {}: {}".format(index, ex))
+            if frame is not None and frame[1][0] == index:
+                if checksum(snapshot(game, pieces)) != self.keyframe(
+                        frame[0])[2]:
+                    raise ReplayError(
+                        "The game differs from the keyframe after action "
+                        "{}".format(index))
+                frame = next(frames, None)
+        return game
+
+
+def bench(replay, repeat=5):
+    """Actions per second fast-forwarding, and the average seek time."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.time()
+        replay.play(verify=False)
+        best = min(best, time.time() - start)
+    indices = range(0, len(replay) + 1, max(1, len(replay) // 100))
+    start = time.time()
+    for index in indices:
+        replay.seek(index)
+    seek = (time.time() - start) / len(indices)
+    return len(replay) / max(best, 1e-9), seek
+
+
+if __name__ == "__main__":
+    import sys
+
+    command, filenames = sys.argv[1:2], sys.argv[2:]
+    if command == ['info'] and filenames:
+        for filename in filenames:
+            replay = Replay(filename)
+            print('{}: {} actions, {} turns, {} keyframes over {:.1f}s{}; '
+                  '{}'.format(filename, len(replay), len(replay.turns),
+                              len(replay.keyframes), replay.duration,
+                              '' if replay.complete else ' (cut off)',
+                              json.dumps(replay.header, sort_keys=True)))
+    elif command == ['verify'] and filenames:
+        failed = 0
+        for filename in filenames:
+            try:
+                Replay(filename).play()
+                print('{}: ok'.format(filename))
+            except ReplayError as ex:
+                failed += 1
+                print('{}: {}'.format(filename, ex))
+        sys.exit(1 if failed else 0)
+    elif command == ['bench'] and filenames:
+        replay = Replay(filenames[0])
+        rate, seek = bench(replay)
+        print('{} actions: {:.0f} actions/s fast-forwarding ({:.0f}x real '
+              'time); seeking {:.3f} ms'.format(
+                  len(replay), rate,
+                  rate * replay.duration / max(len(replay), 1), seek * 1000))
+    else:
+        print("Usage: {} info|verify|bench FILE...".format(sys.argv[0]))
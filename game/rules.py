@@ -0,0 +1,454 @@
+"""The rules of Banneret, independent of pyglet and OpenGL, so that games can
+be simulated without a window. The rendering classes in `game.board` and
+`game.pieces` draw whatever state lives in here.
+
+Squares are integer (x, y) pairs with (0, 0) in a corner of the board, and
+directions are octants: 0 is +x, and every step is 45 degrees
+counterclockwise.
+"""
+from __future__ import division, print_function
+from collections import namedtuple, OrderedDict
+import json
+import sys
+
+# dicts keep the order of their keys from Python 3.7 on
+OrderedSet = dict if sys.version_info >= (3, 7) else OrderedDict
+
+# (dx, dy) of a single step in each octant
+STEPS = [(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]
+
+PieceType = namedtuple('PieceType', ['command_count',  # pieces it commands
+                                     'speed',  # number of movement squares
+                                     'rotation_angle',  # rotation multiple
+                                     'rotation_offset'])  # model offset
+
+PIECE_TYPES = {
+    'B0': PieceType(command_count=1, speed=0, rotation_angle=360,
+                    rotation_offset=0),
+    'O1': PieceType(command_count=0, speed=1, rotation_angle=90,
+                    rotation_offset=0),
+    'O2': PieceType(command_count=0, speed=2, rotation_angle=90,
+                    rotation_offset=0),
+    'D1': PieceType(command_count=0, speed=1, rotation_angle=90,
+                    rotation_offset=45),
+    'D2': PieceType(command_count=0, speed=2, rotation_angle=90,
+                    rotation_offset=45),
+    'A1': PieceType(command_count=0, speed=1, rotation_angle=45,
+                    rotation_offset=0),
+    'A2': PieceType(command_count=0, speed=2, rotation_angle=45,
+                    rotation_offset=0),
+}
+
+
+# the events of a game (see `Game.subscribe`)
+EVENTS = (LOAD, RESET, MOVE, ROTATE, RESET_PIECE, CAPTURE, PASS_TURN,
+          GAME_OVER) = ('load', 'reset', 'move', 'rotate', 'reset_piece',
+                        'capture', 'pass_turn', 'game_over')
+
+
+DEFAULT_SIZE = (8, 8)
+MAX_SIZE = 1024  # squares on a side (coordinates are uint16 on the network)
+
+
+def parse_board(data):
+    """The (records, width, height) of the JSON of a `.board` file. That's
+    either the list of records of an 8x8 board, or an object with the
+    `width`, `height` and `pieces` of a board of any size.
+    """
+    if isinstance(data, list):
+        return (data,) + DEFAULT_SIZE
+    width, height = data.get('width', 8), data.get('height', 8)
+    if not (0 < width <= MAX_SIZE and 0 < height <= MAX_SIZE):
+        raise ValueError("Boards can't be {}x{}".format(width, height))
+    return data['pieces'], width, height
+
+
+def read_board_file(filename):
+    """Read the board stored in `resources/<filename>.board`: its records
+    and its size.
+    """
+    path = 'resources/' + filename + '.board'
+    with open(path, 'r') as infile:
+        return parse_board(json.load(infile))
+
+
+def read_board(filename):
+    """Read the starting position stored in `resources/<filename>.board`."""
+    return read_board_file(filename)[0]
+
+
+def angle_to_direction(angle):
+    if angle % 45:
+        raise ValueError("Rotations must be multiples of 45 degrees, not {}"
+                         "".format(angle))
+    return (angle // 45) % 8
+
+
+class Piece(object):
+    """The state of a single piece. `player` is the index of its owner."""
+    def __init__(self, kind, player, x, y, direction):
+        self.kind = kind
+        self.type = PIECE_TYPES[kind]
+        self.player = player
+        self.x, self.y = x, y
+        self.direction = direction
+        self.old_direction = direction
+        self._moved = False
+        self.remaining_move = self.speed
+        self.captured = False
+
+    def __repr__(self):
+        return '<{} of player {} at {}>'.format(self.kind, self.player,
+                                                self.square)
+
+    @property
+    def command_count(self):
+        return self.type.command_count
+
+    @property
+    def speed(self):
+        return self.type.speed
+
+    @property
+    def rotation_angle(self):
+        return self.type.rotation_angle
+
+    @property
+    def rotation_offset(self):
+        return self.type.rotation_offset
+
+    @property
+    def square(self):
+        return self.x, self.y
+
+    @property
+    def moved(self):
+        # If it has no speed, it can't be moved
+        return self._moved or self.speed == 0
+
+    @moved.setter
+    def moved(self, value):
+        self._moved = value
+
+    @property
+    def rotated(self):
+        return self.direction != self.old_direction
+
+    @property
+    def can_rotate(self):
+        return self.rotation_angle < 360
+
+    @property
+    def angle(self):
+        """The rotation of the model in degrees."""
+        return self.direction * 45 - self.rotation_offset
+
+    def engaged_with(self, other):
+        """Whether the two pieces face each other head on."""
+        return (self.direction - other.direction) % 8 == 4
+
+    def rotate(self):
+        self.direction = (self.direction + self.rotation_angle // 45) % 8
+
+    def reset(self):
+        self._moved = False
+        self.remaining_move = self.speed
+        self.old_direction = self.direction
+
+    def to_record(self):
+        """The piece in the format of the `.board` files."""
+        return {'class': self.kind, 'player': self.player,
+                'position': [self.x, self.y],
+                'rotation': self.direction * 45}
+
+
+class Game(object):
+    """A game of Banneret: the board, the pieces on it and whose turn it is.
+    A turn has two phases. First every piece of the active player must be
+    moved, then it may rotate as many pieces as its commanders allow.
+
+    Besides the list of pieces, the game keeps indices of the pieces by
+    square and, per player, ordered sets of all, commanding, unmoved and
+    rotated pieces. They are updated as pieces change, so the queries below
+    don't scan the board, and they keep the order of `pieces`. Change pieces
+    through the game, not directly, or the indices go stale.
+
+    Every change is also announced to the listeners (see `subscribe`), so
+    whatever shows the game only has to update when something happened.
+    """
+    def __init__(self, width=8, height=8, player_count=2):
+        self.width, self.height = width, height
+        self.player_count = player_count
+        self.pieces = []
+        self.active_player = 0
+        self.game_over = False
+        self.listeners = []
+        # whether anything that decides the victory changed since the last
+        # check: captures and the active player
+        self._victory_dirty = True
+        # the order the pieces were added in, which the indices keep
+        self._order = {}
+        self._clear_indices()
+
+    # events
+    def subscribe(self, listener):
+        """Call `listener(event, piece)` after every change. The events are
+        EVENTS; `piece` is the piece that changed, or None.
+        """
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def emit(self, event, piece=None):
+        for listener in list(self.listeners):
+            listener(event, piece)
+
+    # The per-player indices are dicts used as ordered sets (the values are
+    # None).
+    def _clear_indices(self):
+        self._squares = {}
+        self._players = [OrderedSet() for _ in range(self.player_count)]
+        self._commanders = [OrderedSet() for _ in range(self.player_count)]
+        self._unmoved = [OrderedSet() for _ in range(self.player_count)]
+        self._rotated = [OrderedSet() for _ in range(self.player_count)]
+        self._commands = [0] * self.player_count
+
+    def _index(self, piece):
+        """Add a piece to the indices. It goes after the pieces indexed
+        before it, so pieces are indexed in the order of `pieces`.
+        """
+        player = piece.player
+        self._squares[piece.square] = piece
+        self._players[player][piece] = None
+        if piece.command_count > 0:
+            self._commanders[player][piece] = None
+            self._commands[player] += piece.command_count
+        if not piece.moved:
+            self._unmoved[player][piece] = None
+        if piece.rotated:
+            self._rotated[player][piece] = None
+
+    def _unindex(self, piece):
+        player = piece.player
+        if self._squares.get(piece.square) is piece:
+            del self._squares[piece.square]
+        del self._players[player][piece]
+        if piece in self._commanders[player]:
+            del self._commanders[player][piece]
+            self._commands[player] -= piece.command_count
+        self._unmoved[player].pop(piece, None)
+        self._rotated[player].pop(piece, None)
+
+    def _reindex(self, piece, square):
+        """Update the indices after a piece that was on `square` moved,
+        turned or was reset. Its player and kind don't change.
+        """
+        if square != piece.square:
+            if self._squares.get(square) is piece:
+                del self._squares[square]
+            self._squares[piece.square] = piece
+        player = piece.player
+        self._include(self._unmoved[player], piece, not piece.moved)
+        self._include(self._rotated[player], piece, piece.rotated)
+
+    def _include(self, index, piece, member):
+        """Add the piece to or remove it from an ordered set, keeping the
+        order of `pieces`.
+        """
+        if not member:
+            if piece in index:
+                del index[piece]
+        elif piece not in index:
+            index[piece] = None
+            if len(index) > 1:
+                # Only rotations and resets add pieces back, and those are
+                # rare, so the set is simply sorted again.
+                pieces = sorted(index, key=self._order.get)
+                index.clear()
+                for _ in pieces:
+                    index[_] = None
+
+    def reset(self):
+        del self.pieces[:]
+        self.active_player = 0
+        self.game_over = False
+        self._victory_dirty = True
+        self._order = {}
+        self._clear_indices()
+        self.emit(RESET)
+
+    def load(self, records):
+        """Set up the pieces from the records of a `.board` file."""
+        self.reset()
+        for record in records:
+            x, y = record['position']
+            if not self.in_bounds(x, y):
+                raise ValueError("{} is off the {}x{} board".format(
+                    (x, y), self.width, self.height))
+            self.add(Piece(record['class'], record['player'], x, y,
+                           angle_to_direction(record['rotation'])))
+        self.emit(LOAD)
+
+    def load_file(self, filename):
+        """Load a `.board` file, taking on its size."""
+        records, self.width, self.height = read_board_file(filename)
+        self.load(records)
+
+    def to_records(self):
+        return [piece.to_record() for piece in self.pieces]
+
+    def add(self, piece):
+        self.pieces.append(piece)
+        self._order[piece] = len(self._order)
+        self._index(piece)
+        self._victory_dirty = True
+        return piece
+
+    def capture(self, piece):
+        piece.captured = True
+        self._unindex(piece)
+        del self._order[piece]
+        self.pieces.remove(piece)
+        self._victory_dirty = True
+        self.emit(CAPTURE, piece)
+
+    # queries
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def piece_at(self, x, y):
+        return self._squares.get((x, y))
+
+    def pieces_of(self, player):
+        return list(self._players[player])
+
+    def unmoved(self, player):
+        return list(self._unmoved[player])
+
+    def commanders(self, player):
+        return list(self._commanders[player])
+
+    def rotated(self, player):
+        return list(self._rotated[player])
+
+    def count(self, player):
+        return len(self._players[player])
+
+    def rotation_limit(self, player):
+        """How many pieces the player may rotate this turn."""
+        return self._commands[player]
+
+    def remaining_rotations(self, player):
+        return self._commands[player] - len(self._rotated[player])
+
+    @property
+    def phase(self):
+        return 'move' if self._unmoved[self.active_player] else 'rotate'
+
+    def can_move(self, piece):
+        return (not self.game_over and piece.player == self.active_player and
+                not piece.moved)
+
+    def can_rotate(self, piece):
+        player = self.active_player
+        if (self.game_over or piece.player != player or
+                self._unmoved[player]):
+            return False
+        return ((self.remaining_rotations(player) > 0 and piece.can_rotate) or
+                piece.rotated)
+
+    # actions
+    def move(self, piece):
+        """Slide the piece up to its speed, capturing enemy pieces in the
+        way. A piece stops at the edge of the board, in front of friendly
+        pieces and in front of rotatable enemies engaged with it head on.
+        """
+        square = piece.square
+        # This is always an *attempted* move, so it's marked such.
+        piece.moved = True
+        while piece.remaining_move:
+            piece.remaining_move -= 1
+            dx, dy = STEPS[piece.direction]
+            x, y = piece.x + dx, piece.y + dy
+            if not self.in_bounds(x, y):
+                break
+            other = self.piece_at(x, y)
+            if other is not None:
+                engaged = other.engaged_with(piece)
+                can_capture = not engaged or not other.can_rotate
+                if other.player != piece.player and can_capture:
+                    self.capture(other)
+                else:
+                    break
+            piece.x, piece.y = x, y
+        self._reindex(piece, square)
+        self.emit(MOVE, piece)
+
+    def rotate(self, piece):
+        piece.rotate()
+        self._reindex(piece, piece.square)
+        self.emit(ROTATE, piece)
+
+    def reset_piece(self, piece):
+        piece.reset()
+        self._reindex(piece, piece.square)
+        self.emit(RESET_PIECE, piece)
+
+    def place(self, piece, event, x, y, direction):
+        """Put a piece where an authoritative copy of the game (e.g. on a
+        server) says the action `event` (MOVE or ROTATE) left it, without
+        applying the rules.
+        """
+        square = piece.square
+        piece.x, piece.y, piece.direction = x, y, direction
+        if event == MOVE:
+            piece.moved = True
+            piece.remaining_move = 0
+        self._reindex(piece, square)
+        self.emit(event, piece)
+
+    def click(self, piece):
+        """Do whatever selecting the piece means in the current phase: move
+        it, or rotate it. Returns whether anything happened.
+        """
+        if self.game_over or piece is None:
+            return False
+        if self.can_move(piece):
+            self.move(piece)
+            return True
+        if self.can_rotate(piece):
+            self.rotate(piece)
+            return True
+        return False
+
+    def pass_turn(self):
+        self.active_player = (self.active_player + 1) % self.player_count
+        for piece in self.pieces:
+            piece.reset()
+        # every piece changed, so it's cheaper to start over
+        self._clear_indices()
+        for piece in self.pieces:
+            self._index(piece)
+        self._victory_dirty = True
+        self.emit(PASS_TURN)
+
+    def check_victory(self, force=False):
+        """Players without commanders lose all their pieces. The game is over
+        when only the active player has pieces left. Nothing is checked
+        unless pieces were captured or the turn passed since the last call
+        (or `force` is set).
+        """
+        if not self._victory_dirty and not force:
+            return self.game_over
+        for player in range(self.player_count):
+            if self._players[player] and not self._commanders[player]:
+                for piece in self.pieces_of(player):
+                    self.capture(piece)
+        self._victory_dirty = False
+        if (len(self.pieces) == self.count(self.active_player) and
+                not self.game_over):
+            self.game_over = True
+            self.emit(GAME_OVER)
+        return self.game_over
@@ -0,0 +1,157 @@
+"""Saved games: the whole state of a game in progress, down to which pieces
+moved or rotated this turn, so it can be picked up where it was left.
+
+A save file starts with `BNRS`, a version and a JSON header (the board it
+started from, when it was saved, ...), followed by a snapshot in the
+format of `game.protocol`, which has its own version and checksum.
+
+    python -m game.savegame FILE...     # what's in saves, and load times
+
+The `Autosaver` writes saves on a thread of its own. Only taking the
+snapshot (a list of small lists) happens on the caller's thread.
+"""
+from __future__ import division, print_function
+import json
+import os
+import struct
+import threading
+import time
+
+from game.network import snapshot, game_from_snapshot
+from game.protocol import encode_snapshot, decode_snapshot
+
+MAGIC = b'BNRS'
+VERSION = 1
+SAVE_DIRECTORY = 'saves'
+AUTOSAVE = os.path.join(SAVE_DIRECTORY, 'autosave.save')
+QUICKSAVE = os.path.join(SAVE_DIRECTORY, 'quicksave.save')
+
+_HEADER = struct.Struct('<4sBI')
+
+
+class SaveError(Exception):
+    """The file isn't a save, or it's damaged."""
+    pass
+
+
+def dumps(state, **header):
+    """A save of a snapshot (see `game.network.snapshot`) as bytes."""
+    header.setdefault('saved', time.time())
+    data = json.dumps(header, sort_keys=True).encode('utf-8')
+    return b''.join((_HEADER.pack(MAGIC, VERSION, len(data)), data,
+                     encode_snapshot(0, state)))
+
+
+def loads(data):
+    """The game in a save, and its header."""
+    try:
+        magic, version, length = _HEADER.unpack_from(data)
+    except struct.error:
+        raise SaveError("Not a save")
+    if magic != MAGIC:
+        raise SaveError("Not a save")
+    if version != VERSION:
+        raise SaveError("Unknown save version {}".format(version))
+    offset = _HEADER.size + length
+    try:
+        header = json.loads(data[_HEADER.size:offset].decode('utf-8'))
+        state = decode_snapshot(data[offset:])['snapshot']
+        # the checksum doesn't cover the size of the board or the players
+        game, _ = game_from_snapshot(state)
+    except (struct.error, ValueError, IndexError, KeyError) as ex:
+        raise SaveError("The save is damaged: {}".format(ex))
+    return game, header
+
+
+def write(filename, data):
+    """Replace the file all at once, so a crash never leaves half a save."""
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as outfile:
+        outfile.write(data)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)  # rename doesn't replace files on Windows
+    os.rename(temporary, filename)
+
+
+def save(filename, game, **header):
+    write(filename, dumps(snapshot(game, game.pieces), **header))
+
+
+def load(filename):
+    """The game in a save file, and its header."""
+    with open(filename, 'rb') as infile:
+        return loads(infile.read())
+
+
+class Autosaver(object):
+    """Saves a game to a file in the background. Saves asked for while one
+    is being written are coalesced: only the latest gets written. Games that
+    are over aren't worth resuming, so they remove the file instead.
+    """
+    def __init__(self, filename=AUTOSAVE):
+        self.filename = filename
+        self.saves = 0
+        self._pending = None
+        self._writing = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def save(self, game, **header):
+        state = None if game.game_over else snapshot(game, game.pieces)
+        with self._condition:
+            self._pending = state, header
+            self._condition.notify_all()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='autosave')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                (state, header), self._pending = self._pending, None
+                self._writing = True
+            try:
+                if state is not None:
+                    write(self.filename, dumps(state, **header))
+                    self.saves += 1
+                elif os.path.exists(self.filename):
+                    os.remove(self.filename)
+            except (IOError, OSError) as ex:
+                print('Could not autosave to {}: {}'.format(self.filename,
+                                                            ex))
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+    def wait(self, timeout=5.):
+        """Wait until every save asked for so far is written."""
+        end = time.time() + timeout
+        with self._condition:
+            while ((self._pending is not None or self._writing) and
+                   time.time() < end):
+                self._condition.wait(end - time.time())
+
+
+if __name__ == "__main__":
+    import sys
+
+    for filename in sys.argv[1:]:
+        with open(filename, 'rb') as infile:
+            data = infile.read()
+        start = time.time()
+        game, header = loads(data)
+        elapsed = time.time() - start
+        print('{}: {} pieces on {}x{}, player {} to move, {} bytes, loads in '
+              '{:.3f} ms; {}'.format(filename, len(game.pieces), game.width,
+                                     game.height, game.active_player,
+                                     len(data), elapsed * 1000,
+                                     json.dumps(header, sort_keys=True)))
@@ -3,26 +3,65 @@ where to put them.
 """
 from weakref import proxy
 from euclid import Vector3
+import math
+import os
 import pyglet
+import socket
 import sys
 from game.renderer import BaseGameState
-from game.board import Board
+from game.rules import MOVE, PASS_TURN, LOAD, GAME_OVER
+from game.network import Connection, RemoteGame, client_options
+from game.savegame import AUTOSAVE, QUICKSAVE, SaveError
 
 BOARD = None
+PRELOADER = None
+# how far the camera starts from the center of an 8x8 board; it backs off
+# in proportion on bigger boards
+CAMERA_DISTANCE = Vector3(8, 0, 4).magnitude()
+MIN_CAMERA_DISTANCE = 2.
+
+
+def board_option(argv, default='default'):
+    """The board to play (`board=name`, from resources/)."""
+    for arg in argv:
+        if arg.startswith('board='):
+            return arg[len('board='):]
+    return default
 
 
 class GameState(BaseGameState):
-    """The Banneret-specific base GameState."""
+    """The Banneret-specific base GameState. The board (and everything it
+    imports: the models, the AI, saves and replays) only comes with
+    `create_board`, so the menu can get on the screen first.
+    """
     def __init__(self, window):
         super(GameState, self).__init__(window)
+        self.board = proxy(BOARD) if BOARD else None
+
+    def create_board(self):
         global BOARD
         if not BOARD:
-            BOARD = Board(window)
+            from game.board import Board
+            BOARD = Board(self.window)
+            self.window.camera.looking_at = BOARD.position
         self.board = proxy(BOARD)
 
     def draw_3d(self):
         super(GameState, self).draw_3d()
-        self.board.draw()
+        if self.board is not None:
+            self.board.draw()
+
+    # The piece under the cursor only changes with the cursor, the camera or
+    # the window, so it's looked up on those events instead of every frame.
+    def on_mouse_motion(self, x, y, dx, dy):
+        self.window.mouse.x, self.window.mouse.y = x, y
+        if self.board is not None:
+            self.board.update()
+
+    def on_resize(self, width, height):
+        super(GameState, self).on_resize(width, height)
+        if self.board is not None:
+            self.board.update()
 
 
 class MainMenuState(GameState):
@@ -32,21 +71,167 @@ class MainMenuState(GameState):
         self.load_interface('main.interface')
         self.views.start_game.on_press = (
             lambda: self.window.set_state(PlayGameState))
+        self.views.continue_game.on_press = (
+            lambda: self.window.set_state(PlayGameState, resume=True))
+        self.views.continue_game.visible = os.path.exists(AUTOSAVE)
         # TODO this will eventually show a "Do you want to quit?" dialog
         self.views.exit.on_press = sys.exit
+        self.loading_label = pyglet.text.Label('', x=10, y=10)
+        if window.first_frame_time is not None:
+            self.on_first_frame()
+
+    def on_first_frame(self):
+        # once the menu is on the screen, create the board and load the game
+        # in the background while the menu shows
+        global PRELOADER
+        self.create_board()
+        if PRELOADER is None:
+            from game.preload import preload_game_assets
+            PRELOADER = preload_game_assets(board=BOARD, start=False)
+        PRELOADER.on_progress.append(self.on_load_progress)
+        PRELOADER.start()
+
+    def cleanup(self):
+        super(MainMenuState, self).cleanup()
+        if (PRELOADER is not None and
+                self.on_load_progress in PRELOADER.on_progress):
+            PRELOADER.on_progress.remove(self.on_load_progress)
+
+    def on_load_progress(self, done, total):
+        if done < total:
+            self.loading_label.text = 'Loading {:.0%}'.format(
+                done / float(total))
+        else:
+            self.loading_label.text = ''
+        self.window.invalidate()
+
+    def draw_2d(self):
+        super(MainMenuState, self).draw_2d()
+        if self.loading_label.text:
+            self.loading_label.draw()
 
 
 class PlayGameState(GameState):
-    """Handle the playing of the game."""
-    def __init__(self, window):
+    """Handle the playing of the game. With `resume`, the last game
+    (autosaved) goes on instead of a new one.
+    """
+    def __init__(self, window, resume=False):
         super(PlayGameState, self).__init__(window)
-        self.board.load_state('default')
+        self.create_board()
+        if PRELOADER is not None:
+            # upload whatever isn't yet, instead of loading it piece by piece
+            PRELOADER.start()
+            PRELOADER.finish()
+        if self.board.model is None:
+            self.board.load_model()
+        # `client` plays a match on a server (see server.py) instead
+        self.remote = None
+        if 'client' in sys.argv:
+            self.connect(*client_options(sys.argv))
+        if self.remote is None and not (resume and self.load(AUTOSAVE)):
+            self.board.load_state(board_option(sys.argv))
+        self.fit_camera()
         self.load_interface('play.interface')
         self.views.end_turn.on_press = self.board.pass_turn
         self.views.main_menu.on_press = (
             lambda: self.window.set_state(MainMenuState))
+        self.board.game.subscribe(self.on_game_event)
+        self.update_views()
+
+    def cleanup(self):
+        super(PlayGameState, self).cleanup()
+        self.board.game.unsubscribe(self.on_game_event)
+        self.board.close_players()
+        if self.remote is not None:
+            pyglet.clock.unschedule(self.remote.poll)
+            self.remote.connection.close()
+            self.board.set_remote(None)
+
+    def on_close(self):
+        # don't leave the computer players' processes behind
+        self.board.close_players()
+
+    def connect(self, address, match=None):
+        try:
+            connection = Connection(address)
+        except socket.error as ex:
+            print('Could not connect to {}:{}: {}'.format(
+                address[0], address[1], ex))
+            return
+        self.remote = RemoteGame(connection, match)
+        self.board.reset()
+        self.board.set_remote(self.remote)
+        pyglet.clock.schedule_interval(self.remote.poll, 1 / 30.)
+
+    def load(self, filename):
+        try:
+            self.board.load_game(filename)
+        except (IOError, OSError, SaveError) as ex:
+            print('Could not load {}: {}'.format(filename, ex))
+            return False
+        return True
+
+    def on_key_press(self, symbol, modifiers):
+        # quick save and load
+        if self.remote is not None:
+            return
+        if symbol == pyglet.window.key.F5:
+            self.board.save_game(QUICKSAVE)
+        elif symbol == pyglet.window.key.F9 and os.path.exists(QUICKSAVE):
+            self.load(QUICKSAVE)
+
+    def on_game_event(self, event, piece):
+        if event == LOAD:
+            self.fit_camera()
+        if event in (MOVE, PASS_TURN, LOAD, GAME_OVER):
+            self.update_views()
+
+    def update_views(self):
+        """Update widget visibility."""
+        self.views.end_turn.visible = (self.board.human_turn and
+                                       self.board.game.phase == 'rotate')
+
+    @property
+    def max_camera_distance(self):
+        return 2 * CAMERA_DISTANCE * max(
+            1., max(self.board.width, self.board.height) / 8.)
+
+    def fit_camera(self):
+        """Look at the center of the board, from far enough to see it all."""
+        camera = self.window.camera
+        offset = (camera.position - camera.looking_at).normalized()
+        camera.looking_at = self.board.position
+        camera.position = camera.looking_at + offset * (
+            self.max_camera_distance / 2)
+        self.board.update()
+
+    def on_mouse_scroll(self, x, y, scroll_x, scroll_y):
+        # zoom in and out
+        camera = self.window.camera
+        offset = camera.position - camera.looking_at
+        distance = min(max(abs(offset) * .9 ** scroll_y,
+                           MIN_CAMERA_DISTANCE), self.max_camera_distance)
+        camera.position = camera.looking_at + offset.normalized() * distance
+        self.board.update()
+
+    def pan(self, dx, dy):
+        """Slide the camera over the board, following the mouse."""
+        camera = self.window.camera
+        forward, right, up = camera.basis()
+        ahead = Vector3(0, 0, 1).cross(right)
+        scale = (2 * abs(camera.position - camera.looking_at) *
+                 math.tan(math.radians(camera.fov) / 2) / self.window.height)
+        target = camera.looking_at - (right * dx + ahead * dy) * scale
+        # stay over the board
+        center = self.board.position
+        target.x = min(max(target.x, center.x - self.board.width / 2.),
+                       center.x + self.board.width / 2.)
+        target.y = min(max(target.y, center.y - self.board.height / 2.),
+                       center.y + self.board.height / 2.)
+        camera.position = camera.position + (target - camera.looking_at)
+        camera.looking_at = target
+        self.board.update()
 
-    # TODO: Scroll to zoom
     def on_mouse_press(self, x, y, button, modifiers):
         if button in [pyglet.window.mouse.LEFT]:
             self.board.click()
@@ -57,13 +242,16 @@ class PlayGameState(GameState):
         # TODO: it's glitchy when at the very extremes
         if pyglet.window.mouse.RIGHT & buttons:
             cam = self.window.camera
-            cam.position = cam.position.rotate_around(z, -dx / 64.)
-            axis = cam.up.cross(cam.position)
-            cam.position = cam.position.rotate_around(axis, dy / 64.)
+            offset = cam.position - cam.looking_at
+            offset = offset.rotate_around(z, -dx / 64.)
+            axis = cam.up.cross(offset)
+            cam.position = cam.looking_at + offset.rotate_around(axis,
+                                                                 dy / 64.)
+            self.board.update()
+        # and pan over the board when dragging with the middle button
+        elif pyglet.window.mouse.MIDDLE & buttons:
+            self.pan(dx, dy)
 
     def draw_2d(self):
-        # Update widget visibility
-        self.views.end_turn.visible = not self.board.pieces.filter(
-            player=self.board.active_player, moved=False)
         # Draw the GUI
         super(PlayGameState, self).draw_2d()
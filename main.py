@@ -1,4 +1,7 @@
 #!/usr/bin/env python
+import time
+START = time.time()
+
 import sys
 from euclid import Vector3
 import pyglet
@@ -7,8 +10,26 @@ import pyglet
 if 'nogldebug' in sys.argv:
     pyglet.options['debug_gl'] = False
 
+from game.profiler import PROFILER
+# `timings` shows an overlay of frame timings, `trace` also writes every
+# timed scope to trace.json on exit (open it in chrome://tracing)
+if 'timings' in sys.argv or 'trace' in sys.argv:
+    PROFILER.enable(tracing='trace' in sys.argv)
+
 from game.renderer import GameWindow3d
 from game.states import MainMenuState
+IMPORTED = time.time()
+
+
+def report_startup(window, created):
+    """Print how long it took from starting up to the first frame."""
+    if PROFILER.tracing:
+        PROFILER.trace.append(('startup', START, window.first_frame_time))
+    print('First frame after {:.0f} ms (imports {:.0f} ms, window and menu '
+          '{:.0f} ms, drawing {:.0f} ms)'.format(
+              (window.first_frame_time - START) * 1000,
+              (IMPORTED - START) * 1000, (created - IMPORTED) * 1000,
+              (window.first_frame_time - created) * 1000))
 
 
 def main():
@@ -16,7 +37,9 @@ def main():
     window = GameWindow3d(MainMenuState, resizable=True)
     # TODO: camera should be set in the state
     window.camera.position = Vector3(8, 0, 4)
-    window.camera.looking_at = window.gamestate.board.position
+    created = time.time()
+    window.push_handlers(
+        on_first_frame=lambda: report_startup(window, created))
     pyglet.app.run()
 
 if __name__ == "__main__":
@@ -30,4 +53,7 @@ if __name__ == "__main__":
         stats = pstats.Stats(profiler)
         stats.strip_dirs().sort_stats('time').print_stats(20)
     else:
-        main()
\ No newline at end of file
+        main()
+    if PROFILER.tracing:
+        count = PROFILER.export_chrome_trace('trace.json')
+        print('Wrote {} trace events to trace.json'.format(count))
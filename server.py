@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""The authoritative game server: hosts any number of matches in one process
+and plays the actions of their clients by the rules (see `game.network` for
+the protocol).
+
+    python3 server.py                        # listen on port 7777
+    python3 server.py --host 0.0.0.0 --port 7000 --board default
+    python3 server.py bench --idle 1000 --active 100 --seconds 10
+
+`bench` runs a server and simulated clients in one process over localhost:
+`--idle` matches of two clients that only sit there, and `--active`
+matches of two random players that start a new match whenever one ends.
+It prints the actions per second, the round trip times of the actions and
+the bytes the players received per action (in JSON, or with `--binary`
+in the format of `game.protocol`).
+
+Clients play with `python main.py client [server=host:port]`. This needs
+Python 3.7+ (asyncio); the game itself doesn't.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import random
+import sys
+import time
+
+from game.network import (ActionError, Match, DEFAULT_PORT, MAX_MESSAGE,
+                          encode, encode_for, decode, game_from_snapshot,
+                          apply_events, checksum, snapshot)
+from game.protocol import FRAME
+from game.rules import read_board_file
+
+# bytes waiting to be sent before a client is too slow to keep
+MAX_BACKLOG = 1 << 20
+
+
+class Client(object):
+    """A connection to a player."""
+    def __init__(self, writer):
+        self.writer = writer
+        self.match = None
+        self.player = None
+        self.binary = False  # snapshots and deltas in `game.protocol`
+
+    def send(self, data):
+        """Queue a message (or bytes of an encoded one) without waiting."""
+        if not isinstance(data, bytes):
+            data = encode_for(data, self.binary)
+        transport = self.writer.transport
+        if transport.is_closing():
+            return
+        if transport.get_write_buffer_size() > MAX_BACKLOG:
+            transport.abort()
+            return
+        self.writer.write(data)
+
+
+class GameServer(object):
+    """Routes the messages of the clients to their matches. Matches are
+    made on the first join, by name or as the next one with a free seat, and
+    dropped once everybody left.
+    """
+    def __init__(self, board='default'):
+        self.records, self.width, self.height = read_board_file(board)
+        self.matches = {}
+        self.open_matches = collections.OrderedDict()  # with a free seat
+        self.clients = set()
+        self._names = ('match-{}'.format(_) for _ in itertools.count(1))
+        self.actions = 0
+
+    async def handle(self, reader, writer):
+        client = Client(writer)
+        self.clients.add(client)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:  # longer than the limit
+                    break
+                if not line:
+                    break
+                try:
+                    message = decode(line)
+                except ValueError:
+                    client.send({'type': 'error', 'message': "Bad message."})
+                    continue
+                self.dispatch(client, message)
+        except ConnectionError:
+            pass
+        finally:
+            self.leave(client)
+            self.clients.discard(client)
+            writer.close()
+
+    def dispatch(self, client, message):
+        kind = message.get('type')
+        if kind == 'join':
+            client.binary = bool(message.get('binary'))
+            self.join(client, message.get('match'))
+        elif client.match is None:
+            client.send({'type': 'error', 'message': "Join a match first."})
+        elif kind == 'action':
+            match = client.match
+            try:
+                delta = match.act(client.player, message)
+            except ActionError as ex:
+                client.send({'type': 'error', 'message': str(ex)})
+                return
+            self.actions += 1
+            self.broadcast(match, delta)
+        elif kind == 'resync':
+            client.send({'type': 'snapshot', 'seq': client.match.seq,
+                         'snapshot': client.match.snapshot()})
+        else:
+            client.send({'type': 'error',
+                         'message': "Unknown message `{}`.".format(kind)})
+
+    def broadcast(self, match, message):
+        # encoded once per format
+        data = {}
+        for client in match.seats:
+            if client is not None:
+                if client.binary not in data:
+                    data[client.binary] = encode_for(message, client.binary)
+                client.send(data[client.binary])
+
+    def join(self, client, name=None):
+        self.leave(client)
+        if name is None:
+            # the oldest match waiting for players, or a new one
+            match = next(iter(self.open_matches.values()), None)
+            if match is None:
+                name = next(self._names)
+        else:
+            name = str(name)
+            match = self.matches.get(name)
+        if match is None:
+            match = self.matches[name] = Match(name, self.records,
+                                               self.width, self.height)
+        player = match.join(client)
+        if player is None:
+            client.send({'type': 'error',
+                         'message': "Match `{}` is full.".format(name)})
+            return
+        client.match, client.player = match, player
+        self.update_open(match)
+        joined = {'type': 'joined', 'match': match.name, 'player': player,
+                  'seq': match.seq}
+        state = {'type': 'snapshot', 'seq': match.seq,
+                 'snapshot': match.snapshot()}
+        if client.binary:
+            client.send(joined)
+            client.send(state)
+        else:
+            joined['snapshot'] = state['snapshot']
+            client.send(joined)
+        self.broadcast(match, {'type': 'players',
+                               'seated': [_ is not None
+                                          for _ in match.seats]})
+
+    def leave(self, client):
+        match = client.match
+        if match is None:
+            return
+        match.leave(client)
+        client.match = client.player = None
+        if match.empty:
+            del self.matches[match.name]
+            self.open_matches.pop(match.name, None)
+            return
+        self.update_open(match)
+        self.broadcast(match, {'type': 'players',
+                               'seated': [_ is not None
+                                          for _ in match.seats]})
+
+    def update_open(self, match):
+        if match.full or match.game.game_over:
+            self.open_matches.pop(match.name, None)
+        elif match.name not in self.open_matches:
+            self.open_matches[match.name] = match
+
+    async def serve(self, host, port):
+        return await asyncio.start_server(self.handle, host, port,
+                                          limit=MAX_MESSAGE)
+
+
+# benchmark
+class Bot(object):
+    """A simulated client over a real connection. Active bots play random
+    legal actions and measure how long the server takes to answer them.
+    """
+    def __init__(self, reader, writer, rng=None, binary=False):
+        self.reader = reader
+        self.writer = writer
+        self.rng = rng
+        self.binary = binary
+        self.received = 0  # bytes
+        self.game = None
+        self.pieces = []
+        self.player = None
+        self.sent = None
+        self.round_trips = []
+
+    def send(self, message):
+        self.writer.write(encode(message))
+
+    async def receive(self):
+        start = await self.reader.read(1)
+        if start == FRAME:
+            header = await self.reader.readexactly(4)
+            line = start + header + await self.reader.readexactly(
+                int.from_bytes(header, 'little'))
+        else:
+            line = start + await self.reader.readline()
+        if not line:
+            raise ConnectionError("The server closed the connection")
+        self.received += len(line)
+        return decode(line)
+
+    async def join(self, name):
+        self.send({'type': 'join', 'match': name, 'binary': self.binary})
+        while True:
+            message = await self.receive()
+            if message['type'] == 'joined':
+                self.player = message['player']
+            if message['type'] in ('joined', 'snapshot') and \
+                    'snapshot' in message:
+                self.game, self.pieces = game_from_snapshot(
+                    message['snapshot'])
+                return
+
+    def choose(self):
+        """A random legal action, like `game.ai.RandomAgent` would."""
+        game, player = self.game, self.player
+        mine = [pid for pid, piece in enumerate(self.pieces)
+                if piece is not None and piece.player == player]
+        unmoved = [_ for _ in mine if not self.pieces[_].moved]
+        if unmoved:
+            return {'type': 'action', 'action': 'click',
+                    'piece': self.rng.choice(unmoved)}
+        rotatable = [_ for _ in mine if game.can_rotate(self.pieces[_])]
+        if rotatable and self.rng.random() < .5:
+            return {'type': 'action', 'action': 'click',
+                    'piece': self.rng.choice(rotatable)}
+        return {'type': 'action', 'action': 'pass'}
+
+    async def play(self, max_actions=2000):
+        """Play the match until it's over, or a draw after `max_actions`
+        (the other bot counts the same deltas, so they give up together).
+        """
+        actions = 0
+        while not self.game.game_over and actions < max_actions:
+            if (self.game.active_player == self.player and
+                    self.sent is None):
+                self.sent = time.time()
+                self.send(self.choose())
+            message = await self.receive()
+            if message['type'] == 'delta':
+                actions += 1
+                apply_events(self.game, self.pieces, message['events'])
+                if checksum(snapshot(self.game, self.pieces)) != \
+                        message['crc']:
+                    raise ValueError("Out of sync with the server")
+                if self.sent is not None:
+                    self.round_trips.append(time.time() - self.sent)
+                    self.sent = None
+            elif message['type'] == 'error':
+                # e.g. the other player hasn't joined yet
+                await asyncio.sleep(.01)
+                self.sent = None
+
+
+async def run_bench(idle, active, seconds, seed, binary=False):
+    server = GameServer()
+    listener = await server.serve('127.0.0.1', 0)
+    port = listener.sockets[0].getsockname()[1]
+
+    async def connect(rng=None):
+        reader, writer = await asyncio.open_connection(
+            '127.0.0.1', port, limit=MAX_MESSAGE)
+        return Bot(reader, writer, rng, binary)
+
+    start = time.time()
+    idlers = []
+    for i in range(idle):
+        for _ in range(2):
+            bot = await connect()
+            await bot.join('idle-{}'.format(i))
+            idlers.append(bot)
+    print('{} idle matches ({} connections) up in {:.2f}s'.format(
+        idle, 2 * idle, time.time() - start), file=sys.stderr)
+
+    deadline = time.time() + seconds
+    bots = []
+    games = [0]
+
+    async def play_matches(i):
+        rng = random.Random(seed + i)
+        pair = [await connect(rng) for _ in range(2)]
+        bots.extend(pair)
+        for round_ in itertools.count():
+            name = 'active-{}-{}'.format(i, round_)
+            for bot in pair:
+                await bot.join(name)
+            await asyncio.gather(*[bot.play() for bot in pair])
+            games[0] += 1
+            if time.time() > deadline:
+                return
+
+    start_actions = server.actions
+    start = time.time()
+    await asyncio.gather(*[play_matches(i) for i in range(active)])
+    elapsed = time.time() - start
+    round_trips = sorted(_ for bot in bots for _ in bot.round_trips)
+
+    def percentile(p):
+        return round_trips[min(len(round_trips) - 1,
+                               int(p / 100. * len(round_trips)))] * 1000
+    actions = server.actions - start_actions
+    print('{} active matches ({}): {} games, {} actions in {:.2f}s '
+          '({:.0f} actions/s); round trip p50 {:.2f} ms, p99 {:.2f} ms; '
+          '{:.1f} bytes received per action; {} matches open'.format(
+              active, 'binary' if binary else 'JSON', games[0], actions,
+              elapsed, actions / elapsed, percentile(50), percentile(99),
+              sum(_.received for _ in bots) / max(actions, 1),
+              len(server.matches)))
+    for bot in idlers + bots:
+        bot.writer.close()
+    while server.clients:
+        await asyncio.sleep(.01)
+    listener.close()
+    await listener.wait_closed()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('command', nargs='?', default='serve',
+                        choices=['serve', 'bench'])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--board', default='default',
+                        help="name of a board in resources/")
+    parser.add_argument('--idle', type=int, default=1000,
+                        help="idle matches to host in the benchmark")
+    parser.add_argument('--active', type=int, default=100,
+                        help="matches played in the benchmark")
+    parser.add_argument('--seconds', type=float, default=10.)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--binary', action='store_true',
+                        help="the bots get binary snapshots and deltas")
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        asyncio.run(run_bench(args.idle, args.active, args.seconds,
+                              args.seed, args.binary))
+        return
+
+    async def serve():
+        listener = await GameServer(args.board).serve(args.host, args.port)
+        print('Serving on {}'.format(', '.join(
+            str(_.getsockname()) for _ in listener.sockets)))
+        async with listener:
+            await listener.serve_forever()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
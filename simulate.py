@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""Play lots of headless games between computer agents, spread over all the
+CPU cores, and write one JSON line per game.
+
+    python simulate.py default --games 1000 --agents random alphabeta:2
+
+Agents are `random`, `alphabeta:<depth>` (deterministic, with the depth in
+whole turns) or `alphabeta:<depth>:<seconds per turn>`. Every game gets its
+own seed derived from --seed, so a run is reproducible regardless of the
+number of workers (time limited agents aside).
+
+With --expect, the exit status is 1 unless the given agent won more games
+than all the others together, which makes a regression check for the AI:
+
+    python simulate.py --games 40 --agents alphabeta:1 random \
+        --expect alphabeta:1 --out /dev/null
+
+Captures are recorded as [capturing kind, captured kind] pairs, with a
+capturing kind of null for pieces lost along with their last commander.
+
+With --replays, every game is also written to a replay in that directory
+(see `game.replay`), e.g. as training data for the agents.
+"""
+from __future__ import division, print_function
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from game.rules import Game, read_board_file
+from game.position import Position, KINDS, kind_of
+from game.movegen import make_captures, MOVE, ROTATE, PASS
+from game.ai import RandomAgent, AlphaBetaAgent
+from game.replay import ReplayWriter, EXTENSION
+
+
+def create_agent(spec, seed):
+    name, _, options = spec.partition(':')
+    if name == 'random':
+        return RandomAgent(seed)
+    if name == 'alphabeta':
+        options = options.split(':') if options else []
+        depth = int(options[0]) if options else 2
+        budget = float(options[1]) if len(options) > 1 else None
+        return AlphaBetaAgent(time_budget=budget, max_depth=depth)
+    raise ValueError("Unknown agent `{}`".format(spec))
+
+
+def play_game(task):
+    """Play a single game and return its record."""
+    index, seed, board, records, size, specs, max_actions, replays = task
+    position = Position.from_records(records, *size)
+    # alternate the sides, so no agent always moves first
+    specs = specs[index % len(specs):] + specs[:index % len(specs)]
+    agents = [create_agent(spec, seed * 7919 + i)
+              for i, spec in enumerate(specs)]
+    recorder = None
+    if replays:
+        # piece ids of the position follow the records, like the game's
+        game = Game(*size)
+        game.load(records)
+        recorder = ReplayWriter(
+            os.path.join(replays, 'game-{}{}'.format(index, EXTENSION)),
+            game, board=board, seed=seed, agents=specs)
+    captures = []
+    turns = actions = 0
+    while not position.game_over and actions < max_actions:
+        action = agents[position.active_player].choose(position)
+        if action is None:
+            break
+        _, taken, lost = make_captures(position, action)
+        if action[0] == PASS:
+            turns += 1
+        if recorder is not None:
+            if action[0] in (MOVE, ROTATE):
+                recorder.record('click', action[1])
+            else:
+                recorder.record('pass')
+        actions += 1
+        for pid in taken:
+            captures.append([KINDS[kind_of(position.codes[action[1]])],
+                             KINDS[kind_of(position.codes[pid])]])
+        for pid in lost:
+            captures.append([None, KINDS[kind_of(position.codes[pid])]])
+    if recorder is not None:
+        recorder.close()
+    winner = position.active_player if position.game_over else None
+    if winner is not None and not position.alive[winner]:
+        winner = None
+    return {
+        'game': index,
+        'seed': seed,
+        'agents': specs,
+        'winner': winner,
+        'winner_agent': None if winner is None else specs[winner],
+        'turns': turns,
+        'actions': actions,
+        'captures': captures,
+        'pieces_left': position.alive,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('board', nargs='?', default='default',
+                        help="name of a board in resources/")
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--agents', nargs='+', default=['random', 'random'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--max-actions', type=int, default=2000,
+                        help="call the game a draw after this many actions")
+    parser.add_argument('--out', default='-',
+                        help="JSONL file to write to (default: stdout)")
+    parser.add_argument('--replays',
+                        help="directory to write a replay of every game to")
+    parser.add_argument('--expect', metavar='AGENT',
+                        help="fail unless this agent wins most games")
+    args = parser.parse_args()
+    if args.replays and not os.path.isdir(args.replays):
+        os.makedirs(args.replays)
+
+    records, width, height = read_board_file(args.board)
+    size = (width, height)
+    tasks = [(i, args.seed + i, args.board, records, size, args.agents,
+              args.max_actions, args.replays) for i in range(args.games)]
+    outfile = sys.stdout if args.out == '-' else open(args.out, 'w')
+    wins = {}
+    start = time.time()
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        for result in pool.imap_unordered(play_game, tasks, chunksize=4):
+            outfile.write(json.dumps(result) + '\n')
+            wins[result['winner_agent']] = wins.get(
+                result['winner_agent'], 0) + 1
+    finally:
+        pool.close()
+        pool.join()
+        if outfile is not sys.stdout:
+            outfile.close()
+    elapsed = time.time() - start
+    print('{} games in {:.2f}s ({:.1f} games/s) on {} workers; wins: {}'
+          ''.format(args.games, elapsed, args.games / elapsed, args.workers,
+                    wins), file=sys.stderr)
+    if args.expect is not None:
+        won = wins.get(args.expect, 0)
+        lost = sum(wins.values()) - won - wins.get(None, 0)
+        if won <= lost:
+            print('{} won {} games and lost {}'.format(args.expect, won, lost),
+                  file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""The rules of `game.rules`, as the board played them before they were
+moved out of the rendering classes.
+
+    python -m pytest tests
+    python -m unittest discover tests
+"""
+from __future__ import division, print_function
+import unittest
+
+from game.rules import (Game, Piece, MOVE, CAPTURE, PASS_TURN, GAME_OVER,
+                        read_board_file)
+
+# directions
+EAST, NORTHEAST, NORTH, WEST = 0, 1, 2, 4
+
+
+def make_game(*pieces, **options):
+    """A game with the given (kind, player, x, y, direction) pieces. Unless
+    `commanders` is off, each player gets a commander in a corner, out of
+    everyone's way.
+    """
+    game = Game(options.get('width', 8), options.get('height', 8), 2)
+    if options.get('commanders', True):
+        game.add(Piece('B0', 0, 0, 0, EAST))
+        game.add(Piece('B0', 1, game.width - 1, game.height - 1, WEST))
+    return game, [game.add(Piece(*_)) for _ in pieces]
+
+
+def move_all(game, player=0):
+    for piece in game.unmoved(player):
+        game.move(piece)
+
+
+class TestSliding(unittest.TestCase):
+    def test_slides_up_to_its_speed(self):
+        game, (one, two) = make_game(('O1', 0, 2, 2, NORTH),
+                                     ('O2', 0, 4, 2, NORTH))
+        game.move(one)
+        game.move(two)
+        self.assertEqual(one.square, (2, 3))
+        self.assertEqual(two.square, (4, 4))
+        self.assertEqual((one.remaining_move, two.remaining_move), (0, 0))
+
+    def test_diagonal_pieces_slide_diagonally(self):
+        game, (piece,) = make_game(('D2', 0, 2, 2, NORTHEAST))
+        game.move(piece)
+        self.assertEqual(piece.square, (4, 4))
+
+    def test_stops_at_the_edge(self):
+        game, (piece,) = make_game(('O2', 0, 3, 6, NORTH))
+        game.move(piece)
+        self.assertEqual(piece.square, (3, 7))
+        self.assertTrue(piece.moved)
+
+    def test_stops_in_front_of_friendly_pieces(self):
+        game, (piece, friend) = make_game(('O2', 0, 3, 3, NORTH),
+                                          ('O1', 0, 3, 5, EAST))
+        game.move(piece)
+        self.assertEqual(piece.square, (3, 4))
+        game, (piece, friend) = make_game(('O2', 0, 3, 3, NORTH),
+                                          ('O1', 0, 3, 4, EAST))
+        game.move(piece)
+        self.assertEqual(piece.square, (3, 3))
+        self.assertTrue(piece.moved)  # it was an attempt all the same
+
+    def test_speed_zero_counts_as_moved(self):
+        game, _ = make_game()
+        commander = game.commanders(0)[0]
+        self.assertTrue(commander.moved)
+        self.assertEqual(game.unmoved(0), [])
+
+    def test_index_follows_the_piece(self):
+        game, (piece,) = make_game(('O1', 0, 2, 2, EAST))
+        game.move(piece)
+        self.assertIsNone(game.piece_at(2, 2))
+        self.assertIs(game.piece_at(3, 2), piece)
+
+
+class TestCapture(unittest.TestCase):
+    def test_captures_and_keeps_going(self):
+        game, (piece, enemy) = make_game(('O2', 0, 2, 2, EAST),
+                                         ('O1', 1, 3, 2, NORTH))
+        game.move(piece)
+        self.assertTrue(enemy.captured)
+        self.assertNotIn(enemy, game.pieces)
+        self.assertEqual(piece.square, (4, 2))
+
+    def test_rotatable_piece_head_on_blocks(self):
+        game, (piece, enemy) = make_game(('O2', 0, 2, 2, EAST),
+                                         ('O1', 1, 3, 2, WEST))
+        game.move(piece)
+        self.assertFalse(enemy.captured)
+        self.assertEqual(piece.square, (2, 2))
+
+    def test_engaged_only_head_on(self):
+        game, (piece, enemy) = make_game(('O1', 0, 2, 2, EAST),
+                                         ('O1', 1, 3, 2, EAST))
+        game.move(piece)
+        self.assertTrue(enemy.captured)
+
+    def test_commander_head_on_is_captured(self):
+        # commanders can't rotate, so facing an attacker doesn't save them
+        game, (piece, enemy) = make_game(('O1', 0, 2, 2, EAST),
+                                         ('B0', 1, 3, 2, WEST))
+        game.move(piece)
+        self.assertTrue(enemy.captured)
+        self.assertEqual(piece.square, (3, 2))
+
+    def test_capture_events(self):
+        game, (piece, enemy) = make_game(('O1', 0, 2, 2, EAST),
+                                         ('O1', 1, 3, 2, NORTH))
+        events = []
+        game.subscribe(lambda event, _: events.append((event, _)))
+        game.move(piece)
+        self.assertEqual(events, [(CAPTURE, enemy), (MOVE, piece)])
+
+
+class TestTurnPhases(unittest.TestCase):
+    def test_move_before_rotate(self):
+        game, (one, two) = make_game(('O1', 0, 2, 2, EAST),
+                                     ('O1', 0, 2, 4, EAST))
+        self.assertEqual(game.phase, 'move')
+        game.click(one)
+        self.assertTrue(one.moved)
+        # the other piece still has to move, so nothing rotates
+        self.assertFalse(game.can_rotate(one))
+        self.assertFalse(game.click(one))
+        self.assertEqual(one.direction, EAST)
+        game.click(two)
+        self.assertEqual(game.phase, 'rotate')
+        self.assertTrue(game.click(one))
+        self.assertEqual(one.direction, NORTH)
+
+    def test_only_the_active_player(self):
+        game, (mine, theirs) = make_game(('O1', 0, 2, 2, EAST),
+                                         ('O1', 1, 5, 5, WEST))
+        self.assertFalse(game.click(theirs))
+        self.assertEqual(theirs.square, (5, 5))
+
+    def test_rotation_steps(self):
+        game, pieces = make_game(('B0', 0, 0, 2, EAST),
+                                 ('B0', 0, 0, 4, EAST),
+                                 ('O1', 0, 2, 2, EAST),
+                                 ('D1', 0, 2, 4, NORTHEAST),
+                                 ('A1', 0, 2, 6, EAST))
+        move_all(game)
+        for piece in pieces[2:]:
+            self.assertTrue(game.click(piece))
+        self.assertEqual([_.direction for _ in pieces[2:]], [2, 3, 1])
+
+    def test_rotation_budget(self):
+        game, (one, two) = make_game(('O1', 0, 2, 2, EAST),
+                                     ('O1', 0, 2, 4, EAST))
+        move_all(game)
+        self.assertEqual(game.rotation_limit(0), 1)
+        self.assertTrue(game.click(one))
+        self.assertEqual(game.remaining_rotations(0), 0)
+        # the rotated piece may go on turning, but no other may start
+        self.assertFalse(game.click(two))
+        self.assertTrue(game.click(one))
+        self.assertEqual(one.direction, WEST)
+
+    def test_rotation_budget_adds_up(self):
+        game, (extra, one, two, three) = make_game(
+            ('B0', 0, 0, 2, EAST), ('O1', 0, 2, 2, EAST),
+            ('O1', 0, 2, 4, EAST), ('O1', 0, 2, 6, EAST))
+        move_all(game)
+        self.assertEqual(game.rotation_limit(0), 2)
+        self.assertTrue(game.click(one))
+        self.assertTrue(game.click(two))
+        self.assertFalse(game.click(three))
+
+    def test_rotating_back_frees_the_budget(self):
+        game, (one, two) = make_game(('O1', 0, 2, 2, EAST),
+                                     ('O1', 0, 2, 4, EAST))
+        move_all(game)
+        for _ in range(4):
+            game.click(one)
+        self.assertFalse(one.rotated)
+        self.assertTrue(game.click(two))
+
+    def test_commanders_dont_rotate(self):
+        game, _ = make_game()
+        commander = game.commanders(0)[0]
+        self.assertFalse(game.click(commander))
+        self.assertEqual(commander.direction, EAST)
+
+    def test_pass_turn_resets(self):
+        game, (one, two) = make_game(('O2', 0, 2, 2, EAST),
+                                     ('O1', 1, 5, 5, WEST))
+        events = []
+        game.subscribe(lambda event, _: events.append(event))
+        game.move(one)
+        game.rotate(one)
+        game.pass_turn()
+        self.assertEqual(events[-1], PASS_TURN)
+        self.assertEqual(game.active_player, 1)
+        self.assertFalse(one.moved)
+        self.assertFalse(one.rotated)
+        self.assertEqual(one.old_direction, NORTH)
+        self.assertEqual(one.remaining_move, 2)
+        self.assertEqual(game.unmoved(0), [one])
+        self.assertEqual(game.phase, 'move')
+        game.pass_turn()
+        self.assertEqual(game.active_player, 0)
+
+
+class TestIndices(unittest.TestCase):
+    def test_queries_keep_the_board_order(self):
+        game, pieces = make_game(*[('O1', 0, x, 3, NORTH) for x in range(6)])
+        mine = game.pieces_of(0)
+        self.assertEqual(mine, [_ for _ in game.pieces if _.player == 0])
+        for piece in pieces[::2]:
+            game.move(piece)
+        self.assertEqual(game.unmoved(0), pieces[1::2])
+        game.reset_piece(pieces[2])
+        self.assertEqual(game.unmoved(0), [pieces[1], pieces[2], pieces[3],
+                                           pieces[5]])
+        move_all(game)
+        for piece in (pieces[4], pieces[1]):
+            game.rotate(piece)
+        self.assertEqual(game.rotated(0), [pieces[1], pieces[4]])
+        game.pass_turn()
+        game.pass_turn()
+        self.assertEqual(game.pieces_of(0), mine)
+        self.assertEqual(game.unmoved(0), pieces)
+
+    def test_squares_follow_the_pieces(self):
+        game, (piece, enemy) = make_game(('O2', 0, 2, 2, EAST),
+                                         ('O1', 1, 3, 2, NORTH))
+        game.move(piece)
+        self.assertIsNone(game.piece_at(2, 2))
+        self.assertIsNone(game.piece_at(3, 2))
+        self.assertIs(game.piece_at(4, 2), piece)
+        game.place(piece, MOVE, 4, 5, NORTH)
+        self.assertIsNone(game.piece_at(4, 2))
+        self.assertIs(game.piece_at(4, 5), piece)
+
+
+class TestVictory(unittest.TestCase):
+    def test_losing_the_commander_loses_the_side(self):
+        game, (piece, guard) = make_game(('O1', 0, 6, 6, NORTHEAST),
+                                         ('O1', 1, 4, 4, WEST))
+        game.move(piece)
+        self.assertEqual(game.commanders(1), [])
+        self.assertIn(guard, game.pieces)
+        self.assertTrue(game.check_victory())
+        self.assertTrue(guard.captured)
+        self.assertEqual(game.count(1), 0)
+
+    def test_game_over(self):
+        game, (piece,) = make_game(('O1', 0, 6, 6, NORTHEAST))
+        events = []
+        game.subscribe(lambda event, _: events.append(event))
+        self.assertFalse(game.check_victory())
+        game.click(piece)
+        self.assertTrue(game.check_victory())
+        self.assertTrue(game.game_over)
+        self.assertEqual(events[-1], GAME_OVER)
+        self.assertFalse(game.click(game.commanders(0)[0]))
+
+    def test_only_the_active_player_can_win(self):
+        # a side with no pieces left doesn't end the game on the other's turn
+        game, _ = make_game()
+        game.capture(game.commanders(0)[0])
+        self.assertFalse(game.check_victory())
+        game.pass_turn()
+        self.assertTrue(game.check_victory())
+        self.assertEqual(game.active_player, 1)
+
+    def test_no_commanders_at_all(self):
+        game, (piece,) = make_game(('O1', 0, 2, 2, EAST), commanders=False)
+        self.assertTrue(game.check_victory())
+        self.assertEqual(game.pieces, [])
+
+
+class TestDefaultBoard(unittest.TestCase):
+    def test_first_turn(self):
+        records, width, height = read_board_file('default')
+        game = Game(width, height)
+        game.load(records)
+        self.assertEqual((game.count(0), game.count(1)), (10, 5))
+        self.assertEqual(game.rotation_limit(0), 2)
+        while game.unmoved(0):
+            self.assertTrue(game.click(game.unmoved(0)[0]))
+        self.assertEqual(game.phase, 'rotate')
+        self.assertEqual(sorted(_.to_record()['position'] for _ in
+                                game.pieces_of(0)),
+                         [[0, 0], [0, 1], [0, 2], [0, 3], [1, 1], [1, 4],
+                          [2, 1], [2, 3], [3, 4], [4, 0]])
+        self.assertFalse(game.check_victory())
+
+
+if __name__ == "__main__":
+    unittest.main()